@@ -1,10 +1,112 @@
 from django.contrib import admin
+from django.contrib.admin import widgets
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from . import models, orders, pricing, rollups, snapshots
+
+# option tables with more rows than this get an autocomplete (or raw id)
+# widget instead of a <select> listing every row
+CHOICES_LIMIT = 500
+
+# select_related() lookups needed to render the labels (__str__) of option models
+LABEL_RELATED = {
+    models.Flavor: ('category',),
+    models.ProductEspressoShot: ('espresso_shot',),
+    models.ProductSweetener: ('sweetener',),
+    models.ProductSize: ('size',),
+    models.ProductMilk: ('milk',),
+    models.ProductJuice: ('juice',),
+    models.ProductFlavor: ('flavor__category',),
+    models.ProductTopping: ('topping',),
+    models.ProductTea: ('tea',),
+}
+
+
+# unfiltered changelists of tables estimated above this many rows show the
+# estimate instead of running an exact COUNT(*)
+ESTIMATED_COUNT_THRESHOLD = 100000
+
+
+def estimated_count(model, using='default'):
+    """
+    Returns the planner's estimate of the table's row count, None when the database has none
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator counting unfiltered querysets of large tables from the table statistics
+    """
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = estimated_count(self.object_list.model, self.object_list.db)
+            if estimate is not None and estimate >= ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
+
+
+def label_queryset(model):
+    return model._default_manager.select_related(*LABEL_RELATED.get(model, ()))
+
+
+class SharedChoicesInline(admin.StackedInline):
+    """
+    Inline that loads the choices of each FK once per request and shares them between its rows
+
+    Without this every row's <select> runs its own query (plus one per label
+    for options like Flavor), for each inline on the page.
+    """
+    extra = 0
 
-from . import models
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(*LABEL_RELATED.get(self.model, ()))
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        model = db_field.remote_field.model
+        if model is self.parent_model:
+            return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+        kwargs.setdefault('queryset', label_queryset(model))
+        if 'widget' not in kwargs and self.is_large(request, model):
+            related_admin = self.admin_site._registry.get(model)
+            if related_admin is not None and related_admin.search_fields:
+                kwargs['widget'] = widgets.AutocompleteSelect(
+                    db_field.remote_field, self.admin_site, using=kwargs.get('using'))
+            else:
+                kwargs['widget'] = widgets.ForeignKeyRawIdWidget(
+                    db_field.remote_field, self.admin_site, using=kwargs.get('using'))
+            return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+        formfield = super().formfield_for_foreignkey(db_field, request, **kwargs)
+        if formfield is not None:
+            choices = request.__dict__.setdefault('_admin_choices', {})
+            if model not in choices:
+                # iterated rather than list()ed, which would run a COUNT first
+                choices[model] = [choice for choice in formfield.choices]
+            # copied by every row's form instead of re-running the queryset
+            formfield.choices = choices[model]
+        return formfield
+
+    def is_large(self, request, model):
+        counts = request.__dict__.setdefault('_admin_option_counts', {})
+        if model not in counts:
+            counts[model] = model._default_manager.count()
+        return counts[model] > CHOICES_LIMIT
 
 
 class EspressoShotAdmin(admin.ModelAdmin):
-    pass
+    search_fields = ('name',)
 
 
 class FlavorCategoryAdmin(admin.ModelAdmin):
@@ -12,15 +114,19 @@ class FlavorCategoryAdmin(admin.ModelAdmin):
 
 
 class FlavorAdmin(admin.ModelAdmin):
-    pass
+    search_fields = ('name', 'category__name')
+
+    def get_queryset(self, request):
+        # the labels include the category
+        return super().get_queryset(request).select_related('category')
 
 
 class JuiceAdmin(admin.ModelAdmin):
-    pass
+    search_fields = ('name',)
 
 
 class MilkAdmin(admin.ModelAdmin):
-    pass
+    search_fields = ('name',)
 
 
 class RoomChoiceAdmin(admin.ModelAdmin):
@@ -31,44 +137,36 @@ class IceChoiceAdmin(admin.ModelAdmin):
     pass
 
 
-class AllowedMilksInline(admin.StackedInline):
+class AllowedMilksInline(SharedChoicesInline):
     model = models.Product.allowed_milks.through
-    extra = 0
 
 
-class AllowedSizesInline(admin.StackedInline):
+class AllowedSizesInline(SharedChoicesInline):
     model = models.Product.allowed_sizes.through
-    extra = 0
 
 
-class AllowedFlavorsInline(admin.StackedInline):
+class AllowedFlavorsInline(SharedChoicesInline):
     model = models.Product.allowed_flavors.through
-    extra = 0
 
 
-class AllowedSweetenersInline(admin.StackedInline):
+class AllowedSweetenersInline(SharedChoicesInline):
     model = models.Product.allowed_sweeteners.through
-    extra = 0
 
 
-class AllowedEspressoShotsInline(admin.StackedInline):
+class AllowedEspressoShotsInline(SharedChoicesInline):
     model = models.Product.allowed_espresso_shots.through
-    extra = 0
 
 
-class AllowedJuicesInline(admin.StackedInline):
+class AllowedJuicesInline(SharedChoicesInline):
     model = models.Product.allowed_juices.through
-    extra = 0
 
 
-class AllowedToppingsInline(admin.StackedInline):
+class AllowedToppingsInline(SharedChoicesInline):
     model = models.Product.allowed_toppings.through
-    extra = 0
 
 
-class AllowedTeasInline(admin.StackedInline):
+class AllowedTeasInline(SharedChoicesInline):
     model = models.Product.allowed_teas.through
-    extra = 0
 
 
 class ProductAdmin(admin.ModelAdmin):
@@ -83,17 +181,36 @@ class ProductAdmin(admin.ModelAdmin):
         AllowedTeasInline,
     ]
 
+    def get_form(self, request, obj=None, **kwargs):
+        form = super().get_form(request, obj, **kwargs)
+        # defaults can only be the product's own rows (add them before picking
+        # defaults on a new product), which also keeps these lists short
+        for field_name in (
+                'default_size',
+                'default_milk',
+                'default_sweeteners',
+                'default_flavors',
+                'default_espresso_shots',
+                'default_juices',
+                'default_toppings',
+                'default_teas'):
+            field = form.base_fields.get(field_name)
+            if field is not None:
+                queryset = label_queryset(field.queryset.model)
+                field.queryset = queryset.filter(product=obj) if obj is not None else queryset.none()
+        return form
+
 
 class SizeAdmin(admin.ModelAdmin):
-    pass
+    search_fields = ('name',)
 
 
 class SweetenerAdmin(admin.ModelAdmin):
-    pass
+    search_fields = ('name',)
 
 
 class TeaAdmin(admin.ModelAdmin):
-    pass
+    search_fields = ('name',)
 
 
 class ToppingCategoryAdmin(admin.ModelAdmin):
@@ -101,40 +218,55 @@ class ToppingCategoryAdmin(admin.ModelAdmin):
 
 
 class ToppingAdmin(admin.ModelAdmin):
-    pass
+    search_fields = ('name',)
 
 
-class CustomizedProductFlavorsInline(admin.StackedInline):
+class CustomizedProductFlavorsInline(SharedChoicesInline):
     model = models.CustomizedProduct.flavors.through
-    extra = 0
+    fields = ('product_flavor', 'quantity')
 
 
-class CustomizedProductSweetenersInline(admin.StackedInline):
+class CustomizedProductSweetenersInline(SharedChoicesInline):
     model = models.CustomizedProduct.sweeteners.through
-    extra = 0
+    fields = ('product_sweetener', 'quantity')
 
 
-class CustomizedProductEspressoShotsInline(admin.StackedInline):
+class CustomizedProductEspressoShotsInline(SharedChoicesInline):
     model = models.CustomizedProduct.espresso_shots.through
-    extra = 0
+    fields = ('product_espresso_shot', 'quantity')
 
 
-class CustomizedProductJuicesInline(admin.StackedInline):
+class CustomizedProductJuicesInline(SharedChoicesInline):
     model = models.CustomizedProduct.juices.through
-    extra = 0
+    fields = ('product_juice', 'quantity')
 
 
-class CustomizedProductToppingsInline(admin.StackedInline):
+class CustomizedProductToppingsInline(SharedChoicesInline):
     model = models.CustomizedProduct.toppings.through
-    extra = 0
+    fields = ('product_topping', 'quantity')
 
 
-class CustomizedProductTeasInline(admin.StackedInline):
+class CustomizedProductTeasInline(SharedChoicesInline):
     model = models.CustomizedProduct.teas.through
-    extra = 0
+    fields = ('product_tea', 'quantity')
+
+
+class CustomizedProductChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        # the options column reads the snapshots, only rows written before them need queries
+        snapshots.attach(self.result_list)
 
 
 class CustomizedProductAdmin(admin.ModelAdmin):
+    list_display = ('id', 'created_at', 'product', 'size', 'milk', 'options', 'total')
+    list_select_related = ('product', 'size__size', 'milk__milk')
+    # the (created_at, id) index serves both the ordering and the date filter
+    list_filter = (('created_at', admin.DateFieldListFilter),)
+    ordering = ('-created_at', '-id')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    raw_id_fields = ('product', 'size', 'milk')
     inlines = [
         CustomizedProductFlavorsInline,
         CustomizedProductSweetenersInline,
@@ -143,6 +275,30 @@ class CustomizedProductAdmin(admin.ModelAdmin):
         CustomizedProductToppingsInline,
         CustomizedProductTeasInline,
     ]
+    readonly_fields = ('total', 'snapshot')
+
+    def get_changelist(self, request, **kwargs):
+        return CustomizedProductChangeList
+
+    def options(self, obj):
+        snapshot = obj.get_snapshot()
+        return '; '.join(
+            '{} x {}'.format(option['name'], option['quantity'])
+            for field_name, _, _, _ in orders.OPTION_FIELDS
+            for option in snapshot[field_name]
+        )
+
+    def save_model(self, request, obj, form, change):
+        # the rollups lose what the order added before, and get what it adds once saved
+        form.old_rollups = rollups.aggregate([obj.pk]) if change else ({}, {})
+        super().save_model(request, obj, form, change)
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # priced and snapshotted once the inline quantities are saved
+        pricing.update_totals([form.instance.pk])
+        snapshots.rewrite([form.instance])
+        rollups.replace(form.old_rollups, rollups.aggregate([form.instance.pk]))
 
 
 admin.site.register(models.Juice, JuiceAdmin)
@@ -2,4 +2,9 @@ from django.apps import AppConfig
 
 
 class AppConfig(AppConfig):
-    name = 'api'
+    name = 'backend.api'
+    label = 'api'
+
+    def ready(self):
+        from . import signals
+        signals.connect()
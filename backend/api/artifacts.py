@@ -0,0 +1,156 @@
+"""
+Menu artifacts: the rendered menu as hashed, precompressed static files
+
+With settings.MENU_ARTIFACTS on, the menu of each catalog version is written
+to STATIC_ROOT/MENU_ARTIFACT_DIR/products.<content hash>.json (plus .gz and,
+when the brotli package is installed, .br variants) after every catalog
+commit, and /api/products/ redirects to it. The files never change once
+written, so WhiteNoise serves them as immutable and a CDN can cache them
+forever; menu traffic then never reaches a view or the database.
+
+Only the server that committed writes the file, while the current URL is
+shared through the cache. A server without the file writes its own copy
+(from the cached menu) before redirecting to it or serving it.
+"""
+import hashlib
+import os
+import re
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from whitenoise import middleware
+from whitenoise.compress import Compressor
+
+from . import catalog
+
+ARTIFACT_KEY = 'catalog:menu:artifact'
+ARTIFACT_NAME_RE = re.compile(r'^products\.[0-9a-f]{12}\.json$')
+# artifacts each WhiteNoiseMiddleware keeps ready to serve, older ones are read again when requested
+SERVED_ARTIFACTS = 4
+
+
+def artifact_root():
+    return os.path.join(settings.STATIC_ROOT, settings.MENU_ARTIFACT_DIR)
+
+
+def artifact_prefix():
+    return '{}{}/'.format(settings.STATIC_URL, settings.MENU_ARTIFACT_DIR)
+
+
+def artifact_path(url):
+    return os.path.join(artifact_root(), url[len(artifact_prefix()):])
+
+
+def write_menu_artifact():
+    """
+    Writes the menu of the current catalog version (unless already written), returns its URL
+    """
+    version = catalog.get_version()
+    content = catalog.get_menu()
+    name = 'products.{}.json'.format(hashlib.sha256(content).hexdigest()[:12])
+    path = os.path.join(artifact_root(), name)
+
+    if not os.path.exists(path):
+        os.makedirs(artifact_root(), exist_ok=True)
+        # the compressed variants are renamed into place first, so the file
+        # is never visible without them
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        for compressed_path in Compressor(quiet=True).compress(temp_path):
+            os.replace(compressed_path, path + compressed_path[len(temp_path):])
+        os.replace(temp_path, path)
+
+    url = artifact_prefix() + name
+    cache.set(ARTIFACT_KEY, (version, url), timeout=None)
+    return url
+
+
+def current_artifact_url():
+    """
+    Returns the URL of the current catalog version's menu artifact, None if not written yet
+    """
+    cached = cache.get_many([catalog.VERSION_KEY, ARTIFACT_KEY])
+    entry = cached.get(ARTIFACT_KEY)
+    if entry is not None and entry[0] == cached.get(catalog.VERSION_KEY):
+        return entry[1]
+    return None
+
+
+def get_menu_artifact_url():
+    """
+    Returns the URL of the current catalog version's menu artifact, writing it if needed
+    """
+    url = current_artifact_url()
+    # another server may have written it
+    if url is not None and os.path.isfile(artifact_path(url)):
+        return url
+    return write_menu_artifact()
+
+
+def prune_menu_artifacts(keep):
+    """
+    Deletes all but the keep most recently written artifacts (and their variants), returns the deleted names
+    """
+    root = artifact_root()
+    if not os.path.isdir(root):
+        return []
+    names = sorted(
+        (name for name in os.listdir(root) if ARTIFACT_NAME_RE.match(name)),
+        key=lambda name: os.path.getmtime(os.path.join(root, name)),
+        reverse=True)
+    deleted = names[keep:]
+    for name in deleted:
+        for suffix in ('', '.gz', '.br'):
+            if os.path.exists(os.path.join(root, name + suffix)):
+                os.remove(os.path.join(root, name + suffix))
+    return deleted
+
+
+def catalog_committed(sender, **kwargs):
+    if settings.MENU_ARTIFACTS:
+        write_menu_artifact()
+
+
+class WhiteNoiseMiddleware(middleware.WhiteNoiseMiddleware):
+    """
+    WhiteNoiseMiddleware that also serves the menu artifacts written after startup, as immutable files
+
+    Artifacts are kept apart from self.files, which WhiteNoise ignores with
+    autorefresh on, and only the SERVED_ARTIFACTS most recently added
+    ones, so a long running worker doesn't keep one per catalog version.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # {url: StaticFile}, most recently added last
+        self.artifacts = OrderedDict()
+
+    def process_request(self, request):
+        url = request.path_info
+        prefix = artifact_prefix()
+        if url.startswith(prefix) and ARTIFACT_NAME_RE.match(url[len(prefix):]):
+            static_file = self.find_artifact(url)
+            if static_file is not None:
+                return self.serve(static_file, request)
+        return super().process_request(request)
+
+    def find_artifact(self, url):
+        path = artifact_path(url)
+        if not os.path.isfile(path):
+            if url != current_artifact_url():
+                # pruned, including from the files found at startup
+                self.artifacts.pop(url, None)
+                self.files.pop(url, None)
+                return None
+            # redirected here by a server that has it
+            write_menu_artifact()
+        static_file = self.artifacts.get(url)
+        if static_file is None:
+            static_file = self.artifacts[url] = self.get_static_file(path, url)
+            while len(self.artifacts) > SERVED_ARTIFACTS:
+                self.artifacts.popitem(last=False)
+        return static_file
+
+    def immutable_file_test(self, path, url):
+        return url.startswith(artifact_prefix()) or super().immutable_file_test(path, url)
@@ -0,0 +1,232 @@
+"""
+Native async handlers for the hot endpoints under ASGI
+
+Django 3.0 runs every view in a thread pool under ASGI, with a few more
+thread hops for the request signals. The handlers here answer the requests
+kiosks make the most straight from the event loop instead:
+
+* GET /api/products/ and /api/v2/menu/ (without query parameters) are served
+  from a per-process snapshot of the cached menus, refreshed at most every
+  MENU_MAX_AGE seconds, so a read needs no thread at all.
+* POST /api/customized-products/batch/ reads and parses the body on the event
+  loop and only hops to the thread pool to validate and write the batch.
+  With settings.ORDER_QUEUE, batches are queued by the DRF view instead.
+
+Everything else (and any request these can't answer the same way the DRF
+views would, e.g. a session cookie that needs CSRF checks) goes to Django.
+"""
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signals
+from django.http.cookie import parse_cookie
+from django.http.request import split_domain_port, validate_host
+from django.urls import reverse
+from rest_framework.renderers import JSONRenderer
+
+from . import artifacts, catalog, routers, serializers
+
+MENU_MAX_AGE = 1
+
+
+class MenuSnapshot:
+    """
+    Per-process copy of a rendered menu
+
+    Once older than max_age, the first request to notice refreshes it from
+    the catalog cache (in a thread) while concurrent requests keep getting
+    the previous copy. Without a previous copy (at startup or after clear())
+    they all wait for that one refresh.
+    """
+    def __init__(self, render, max_age=MENU_MAX_AGE):
+        self.render = render
+        self.max_age = max_age
+        self.content = None
+        self.loaded_at = None
+        self.refreshing = None
+
+    async def get(self):
+        if self.content is not None and time.monotonic() - self.loaded_at < self.max_age:
+            return self.content
+        if self.refreshing is None:
+            self.refreshing = asyncio.ensure_future(self.refresh())
+        elif self.content is not None:
+            return self.content
+        # a client that disconnects doesn't cancel the refresh the others wait for
+        return await asyncio.shield(self.refreshing)
+
+    async def refresh(self):
+        try:
+            content = await sync_to_async(self.load)()
+            self.content = content
+            self.loaded_at = time.monotonic()
+            return content
+        finally:
+            self.refreshing = None
+
+    def load(self):
+        """
+        Renders the menu in the thread pool, wrapped in the request signals like create_customized_products
+        """
+        signals.request_started.send(sender=self.__class__)
+        try:
+            return self.render()
+        finally:
+            signals.request_finished.send(sender=self.__class__)
+
+    def clear(self):
+        self.content = None
+
+
+menu = MenuSnapshot(catalog.get_menu)
+normalized_menu = MenuSnapshot(catalog.get_normalized_menu)
+menu_artifact_url = MenuSnapshot(artifacts.get_menu_artifact_url)
+
+
+def get_header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin1')
+    return None
+
+
+def is_allowed_host(scope):
+    """
+    Same check as HttpRequest.get_host(), Django answers the request (with a 400) otherwise
+    """
+    host = get_header(scope, b'host')
+    if host is None:
+        return False
+    allowed_hosts = settings.ALLOWED_HOSTS
+    if settings.DEBUG and not allowed_hosts:
+        allowed_hosts = ['.localhost', '127.0.0.1', '[::1]']
+    domain, _ = split_domain_port(host)
+    return bool(domain) and validate_host(domain, allowed_hosts)
+
+
+async def send_response(send, status, content, content_type='application/json', headers=()):
+    headers = [
+        (b'content-type', content_type.encode('latin1')),
+        (b'content-length', str(len(content)).encode('latin1')),
+    ] + list(headers)
+    if settings.SECURE_CONTENT_TYPE_NOSNIFF:
+        headers.append((b'x-content-type-options', b'nosniff'))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': content})
+
+
+async def read_body(receive):
+    """
+    Returns the request body, None if the client disconnected or it's larger than Django accepts
+    """
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if settings.DATA_UPLOAD_MAX_MEMORY_SIZE is not None and len(body) > settings.DATA_UPLOAD_MAX_MEMORY_SIZE:
+            return None
+        if not message.get('more_body', False):
+            return bytes(body)
+
+
+async def menu_view(scope, receive, send):
+    if settings.MENU_ARTIFACTS:
+        url = await menu_artifact_url.get()
+        return await send_response(send, 302, b'', headers=[(b'location', url.encode('latin1'))])
+    await send_response(send, 200, await menu.get())
+
+
+async def normalized_menu_view(scope, receive, send):
+    await send_response(send, 200, await normalized_menu.get())
+
+
+def create_customized_products(data):
+    """
+    Validates and writes a batch like CustomizedProductBatchAPIView, returns (status, content)
+
+    Runs in the thread pool, wrapped in the request signals that manage the
+    thread's database connection.
+    """
+    signals.request_started.send(sender=create_customized_products)
+    try:
+        serializer = serializers.CustomizedProductSerializer(data=data, many=True)
+        if not serializer.is_valid():
+            return 400, JSONRenderer().render(serializer.errors)
+        serializer.save()
+        return 201, JSONRenderer().render(serializer.data)
+    finally:
+        signals.request_finished.send(sender=create_customized_products)
+
+
+async def customized_product_batch_view(scope, receive, send):
+    body = await read_body(receive)
+    if body is None:
+        return await send_response(send, 400, b'{"detail":"Invalid request body."}')
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except ValueError as exc:
+        detail = JSONRenderer().render({'detail': 'JSON parse error - {}'.format(exc)})
+        return await send_response(send, 400, detail)
+
+    status, content = await sync_to_async(create_customized_products)(data)
+    headers = []
+    max_age = routers.pin_cookie_max_age()
+    if max_age:
+        # read-your-writes, like ReplicaPinningMiddleware
+        headers.append((b'set-cookie', '{}=1; HttpOnly; Max-Age={}; Path=/'.format(
+            routers.PIN_COOKIE, max_age).encode('latin1')))
+    await send_response(send, status, content, headers=headers)
+
+
+def get_routes():
+    """
+    Returns {(method, path): handler}, resolved from the URLconf so the paths stay in one place
+    """
+    return {
+        ('GET', reverse('vue_form_products')): menu_view,
+        ('GET', reverse('menu')): normalized_menu_view,
+        ('POST', reverse('customized_product_batch')): customized_product_batch_view,
+    }
+
+
+def get_handler(routes, scope):
+    """
+    Returns the native handler for an HTTP request, None when Django should answer it
+    """
+    handler = routes.get((scope['method'], scope['path']))
+    if handler is None or scope.get('query_string') or not is_allowed_host(scope):
+        return None
+    if handler is customized_product_batch_view:
+        # the view queues the batch under its Idempotency-Key, see order_queue.py
+        if settings.ORDER_QUEUE:
+            return None
+        content_type = get_header(scope, b'content-type') or ''
+        cookies = parse_cookie(get_header(scope, b'cookie') or '')
+        # sessions go through DRF's SessionAuthentication (and its CSRF check)
+        if content_type.split(';')[0].strip() != 'application/json' or settings.SESSION_COOKIE_NAME in cookies:
+            return None
+    return handler
+
+
+def get_application(django_application):
+    """
+    Returns an ASGI application answering the hot endpoints natively and everything else with Django
+    """
+    routes = None
+
+    async def application(scope, receive, send):
+        nonlocal routes
+        if scope['type'] == 'http':
+            if routes is None:
+                routes = get_routes()
+            handler = get_handler(routes, scope)
+            if handler is not None:
+                return await handler(scope, receive, send)
+        return await django_application(scope, receive, send)
+
+    return application
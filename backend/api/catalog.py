@@ -0,0 +1,493 @@
+"""
+Versioned cache of the rendered product menu
+
+The catalog version is a counter in Django's cache that is bumped whenever a
+Product, one of its through rows, or one of the option lookup tables changes
+(see signals.py). The rendered menu JSON is cached together with the version it
+was rendered for, so a menu request in steady state costs a single cache read.
+Every process has to share the cache (the production settings refuse a
+per-process one), or a worker would keep the version it first saw.
+
+The same writes are recorded in the CatalogChange log, whose latest id is the
+version kiosks pass to the menu changes endpoint to fetch only what changed
+since their last sync (build_menu_changes). Log rows are collected during the
+catalog write's transaction and inserted once it has committed (under a table
+lock on PostgreSQL), so their ids follow the order of the commits: a client
+that synced up to a version has seen every commit logged below it, even when
+an import and an admin edit overlap.
+"""
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Max, Min, Prefetch
+from django.dispatch import Signal
+from rest_framework.renderers import JSONRenderer
+
+from . import metrics, models, routers, serializers
+
+VERSION_KEY = 'catalog:version'
+MENU_KEY = 'catalog:menu'
+NORMALIZED_MENU_KEY = 'catalog:menu:normalized'
+MENU_CHANGES_KEY = 'catalog:menu:changes'
+# seconds the changes since a version stay cached
+MENU_CHANGES_TIMEOUT = 300
+
+# sent once the transaction that changed the catalog has committed
+catalog_committed = Signal()
+
+# everything ProductSerializer (depth=3) can render
+CATALOG_MODELS = (
+    models.Product,
+    models.ProductEspressoShot,
+    models.ProductSweetener,
+    models.ProductSize,
+    models.ProductMilk,
+    models.ProductJuice,
+    models.ProductFlavor,
+    models.ProductTopping,
+    models.ProductTea,
+    models.EspressoShot,
+    models.Sweetener,
+    models.Size,
+    models.Milk,
+    models.TempChoice,
+    models.FoamChoice,
+    models.Juice,
+    models.FlavorCategory,
+    models.Flavor,
+    models.ToppingCategory,
+    models.ToppingChoice,
+    models.Topping,
+    models.Tea,
+    models.IceChoice,
+    models.RoomChoice,
+)
+
+
+def menu_queryset(fields=None):
+    """
+    Returns the currently active products, ordered and loaded for the menu
+
+    Only the relations in fields are loaded when fields is given.
+    """
+    return models.Product.objects.filter(is_active=True).order_by('name').for_menu(fields)
+
+
+def render_json(data):
+    with metrics.timer('render'):
+        return JSONRenderer().render(data)
+
+
+def render_menu():
+    return render_json(serializers.ProductSerializer(menu_queryset(), many=True).data)
+
+
+# (key of a product's through rows in the normalized menu and of their options' table,
+#  through model, option field)
+MENU_ROWS = (
+    ('sizes', models.ProductSize, 'size'),
+    ('milks', models.ProductMilk, 'milk'),
+    ('sweeteners', models.ProductSweetener, 'sweetener'),
+    ('flavors', models.ProductFlavor, 'flavor'),
+    ('espresso_shots', models.ProductEspressoShot, 'espresso_shot'),
+    ('juices', models.ProductJuice, 'juice'),
+    ('toppings', models.ProductTopping, 'topping'),
+    ('teas', models.ProductTea, 'tea'),
+)
+
+
+def menu_rows_queryset(through_model, option_field):
+    """
+    Returns the through rows of through_model with the options the normalized menu lists for them
+    """
+    if through_model is models.ProductFlavor:
+        return through_model.objects.select_related('flavor__category')
+    if through_model is models.ProductTopping:
+        return through_model.objects.select_related(
+            'topping__category',
+            'topping__default_choice',
+        ).prefetch_related('topping__allowed_choices')
+    return through_model.objects.select_related(option_field)
+
+
+def normalized_menu_queryset():
+    """
+    Returns the active products with their through rows and options for the normalized menu
+    """
+    return models.Product.objects.filter(is_active=True).order_by('name').select_related(
+        'default_ice',
+        'default_room',
+        'default_milk_temp',
+        'default_milk_foam',
+    ).prefetch_related(
+        'allowed_ice',
+        'allowed_room',
+        'allowed_milk_temps',
+        'allowed_milk_foams',
+        *(
+            Prefetch('{}_set'.format(through._meta.model_name), queryset=menu_rows_queryset(through, option_field))
+            for _, through, option_field in MENU_ROWS
+        ),
+        # only the ids of the default rows are rendered
+        Prefetch('default_sweeteners', queryset=models.ProductSweetener.objects.only('id')),
+        Prefetch('default_flavors', queryset=models.ProductFlavor.objects.only('id')),
+        Prefetch('default_espresso_shots', queryset=models.ProductEspressoShot.objects.only('id')),
+        Prefetch('default_juices', queryset=models.ProductJuice.objects.only('id')),
+        Prefetch('default_toppings', queryset=models.ProductTopping.objects.only('id')),
+        Prefetch('default_teas', queryset=models.ProductTea.objects.only('id')),
+    )
+
+
+# (name of the id-keyed table in the normalized menu, option model)
+NORMALIZED_TABLES = (
+    ('ice_choices', models.IceChoice),
+    ('room_choices', models.RoomChoice),
+    ('temp_choices', models.TempChoice),
+    ('foam_choices', models.FoamChoice),
+    ('sizes', models.Size),
+    ('milks', models.Milk),
+    ('sweeteners', models.Sweetener),
+    ('flavor_categories', models.FlavorCategory),
+    ('flavors', models.Flavor),
+    ('espresso_shots', models.EspressoShot),
+    ('juices', models.Juice),
+    ('topping_categories', models.ToppingCategory),
+    ('topping_choices', models.ToppingChoice),
+    ('toppings', models.Topping),
+    ('teas', models.Tea),
+)
+
+
+def collect_options(products, rows=(), options=()):
+    """
+    Returns {table name: {pk: option}} of the options the products, (key, through row) and
+    (table name, option) pairs refer to
+    """
+    tables = {table_name: {} for table_name, _ in NORMALIZED_TABLES}
+    option_fields = {key: option_field for key, _, option_field in MENU_ROWS}
+
+    def add(table_name, *options):
+        for option in options:
+            if option is not None:
+                tables[table_name][option.pk] = option
+
+    def add_option(table_name, option):
+        add(table_name, option)
+        if table_name == 'flavors':
+            add('flavor_categories', option.category)
+        elif table_name == 'toppings':
+            add('topping_categories', option.category)
+            add('topping_choices', option.default_choice, *option.allowed_choices.all())
+
+    def add_row(key, row):
+        add_option(key, getattr(row, option_fields[key]))
+
+    for product in products:
+        add('ice_choices', product.default_ice, *product.allowed_ice.all())
+        add('room_choices', product.default_room, *product.allowed_room.all())
+        add('temp_choices', product.default_milk_temp, *product.allowed_milk_temps.all())
+        add('foam_choices', product.default_milk_foam, *product.allowed_milk_foams.all())
+        for key, through, _ in MENU_ROWS:
+            for row in getattr(product, '{}_set'.format(through._meta.model_name)).all():
+                add_row(key, row)
+    for key, row in rows:
+        add_row(key, row)
+    for table_name, option in options:
+        add_option(table_name, option)
+    return tables
+
+
+def serialize_tables(tables):
+    return {
+        table_name: {
+            pk: serializers.OptionSerializer.for_model(option_model)(option).data
+            for pk, option in sorted(tables[table_name].items())
+        }
+        for table_name, option_model in NORMALIZED_TABLES
+    }
+
+
+def build_normalized_menu():
+    """
+    Builds the normalized menu: products plus one id-keyed table per option type
+
+    Every option shared between products is emitted once, products refer to
+    options by id through their Product* rows. version is the catalog version
+    to sync changes from (see build_menu_changes).
+    """
+    # read first, changes logged while the menu is built are sent again
+    version = get_changes_version()
+    products = list(normalized_menu_queryset())
+    menu = {
+        'version': version,
+        'products': serializers.MenuProductSerializer(products, many=True).data,
+    }
+    menu.update(serialize_tables(collect_options(products)))
+    return menu
+
+
+def render_normalized_menu():
+    return render_json(build_normalized_menu())
+
+
+def options_queryset(option_model):
+    """
+    Returns the options of option_model with the options the normalized menu lists for them
+    """
+    if option_model is models.Flavor:
+        return option_model.objects.select_related('category')
+    if option_model is models.Topping:
+        return option_model.objects.select_related('category', 'default_choice').prefetch_related('allowed_choices')
+    return option_model.objects.all()
+
+
+def build_menu_changes(since):
+    """
+    Builds what changed in the normalized menu after catalog version since,
+    None when that isn't logged (anymore) and the client reloads the full menu
+
+    products are the added and changed active products in full, rows the
+    changed through rows of the other active products by menu key (with their
+    product's id). The option tables list the changed options and those the
+    products and rows refer to. deactivated_products, deleted_rows and deleted
+    (by table) are the ids the client drops.
+    """
+    logged = get_changes(since)
+    if logged is None:
+        return None
+    version, changed = logged
+
+    product_ids = changed.get(models.Product._meta.model_name, set())
+    products = list(normalized_menu_queryset().filter(pk__in=product_ids))
+    changes = {
+        'version': version,
+        'products': serializers.MenuProductSerializer(products, many=True).data,
+        'deactivated_products': sorted(product_ids - {product.pk for product in products}),
+        'rows': {},
+        'deleted_rows': {},
+        'deleted': {},
+    }
+
+    rows = []
+    for key, through, option_field in MENU_ROWS:
+        row_ids = changed.get(through._meta.model_name)
+        if not row_ids:
+            continue
+        found = list(menu_rows_queryset(through, option_field).filter(pk__in=row_ids).annotate(
+            product_is_active=F('product__is_active')))
+        deleted_ids = row_ids - {row.pk for row in found}
+        if deleted_ids:
+            changes['deleted_rows'][key] = sorted(deleted_ids)
+        # the re-sent products carry their rows, the client dropped those of inactive products
+        found = [row for row in found if row.product_is_active and row.product_id not in product_ids]
+        if found:
+            changes['rows'][key] = serializers.ProductRowSerializer.for_model(through)(found, many=True).data
+            rows.extend((key, row) for row in found)
+
+    options = []
+    for table_name, option_model in NORMALIZED_TABLES:
+        option_ids = changed.get(option_model._meta.model_name)
+        if not option_ids:
+            continue
+        found = options_queryset(option_model).in_bulk(option_ids)
+        if len(found) < len(option_ids):
+            changes['deleted'][table_name] = sorted(option_ids - set(found))
+        options.extend((table_name, option) for option in found.values())
+
+    changes.update(serialize_tables(collect_options(products, rows, options)))
+    return changes
+
+
+def render_menu_changes(since):
+    changes = build_menu_changes(since)
+    return None if changes is None else render_json(changes)
+
+
+def get_changes(since):
+    """
+    Returns (version, {model name: set of ids}) of the rows changed after catalog version since,
+    None when that isn't logged (anymore) or a bulk write didn't log its rows
+    """
+    log = models.CatalogChange.objects.aggregate(first=Min('pk'), version=Max('pk'))
+    version = log['version'] or 0
+    # a pruned log or a client ahead of a restored database
+    if since > version or (log['first'] is not None and since < log['first'] - 1):
+        return None
+
+    changed = {}
+    entries = models.CatalogChange.objects.filter(pk__gt=since, pk__lte=version)
+    for model_name, object_id in entries.values_list('model', 'object_id').distinct():
+        if object_id is None:
+            return None
+        changed.setdefault(model_name, set()).add(object_id)
+    return version, changed
+
+
+def get_changes_version():
+    """
+    Returns the catalog version clients sync from, the id of the latest change log row
+    """
+    return models.CatalogChange.objects.aggregate(version=Max('pk'))['version'] or 0
+
+
+def log_changes(model, pks):
+    """
+    Adds saved or deleted rows of a catalog model to the change log (see signals.py), once committed
+
+    Through rows are logged as such, the menu lists them under their product.
+    """
+    _log([models.CatalogChange(model=model._meta.model_name, object_id=pk) for pk in pks])
+
+
+def _log(changes):
+    if transaction.get_connection().in_atomic_block:
+        _commit_callback().changes.extend(changes)
+    else:
+        write_changes(changes)
+
+
+def write_changes(changes):
+    """
+    Inserts committed CatalogChange rows, their ids in commit order
+    """
+    with transaction.atomic():
+        connection = transaction.get_connection()
+        if connection.vendor == 'postgresql':
+            # ids are handed out and become visible in the same order, readers aren't blocked
+            with connection.cursor() as cursor:
+                cursor.execute('LOCK TABLE {} IN EXCLUSIVE MODE'.format(
+                    connection.ops.quote_name(models.CatalogChange._meta.db_table)))
+        models.CatalogChange.objects.bulk_create(changes)
+
+
+def prune_changes(before):
+    """
+    Deletes the change log rows created before the datetime before, except the latest one
+
+    Clients that synced before the oldest remaining row reload the full menu.
+    """
+    latest = get_changes_version()
+    return models.CatalogChange.objects.filter(created_at__lt=before, pk__lt=latest).delete()[0]
+
+
+def get_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = _init_version()
+    return version
+
+
+def _init_version():
+    # seeded from the clock so a flushed cache can't reuse an old version number
+    cache.add(VERSION_KEY, int(time.time() * 1000), timeout=None)
+    return cache.get(VERSION_KEY)
+
+
+def bump_version():
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        _init_version()
+        return cache.incr(VERSION_KEY)
+
+
+def catalog_changed():
+    """
+    Invalidates the cached menu after a catalog write
+
+    The version is bumped right away and again once the transaction commits, so
+    a menu rendered from the pre-commit state in between is never served
+    after the commit.
+    """
+    bump_version()
+    _commit_callback()
+
+
+def bulk_changed():
+    """
+    catalog_changed() for bulk writes, which send no signals
+
+    The changed rows aren't logged, clients that synced before reload the full menu.
+    """
+    _log([models.CatalogChange()])
+    catalog_changed()
+
+
+class CatalogCommit:
+    """
+    The commit callback of a transaction that changed the catalog, with the change log rows it writes
+    """
+    def __init__(self):
+        self.changes = []
+
+    def __call__(self):
+        if self.changes:
+            write_changes(self.changes)
+        bump_version()
+        catalog_committed.send(sender=None)
+
+
+def _commit_callback():
+    """
+    Returns the CatalogCommit of the current transaction, registered on first use
+
+    Outside of a transaction it runs right away. Changes made in a savepoint
+    that is rolled back stay in an outer callback, their rows are only sent
+    again.
+    """
+    connection = transaction.get_connection()
+    # one commit callback per transaction however many rows it changed
+    for _, callback in connection.run_on_commit:
+        if isinstance(callback, CatalogCommit):
+            return callback
+    callback = CatalogCommit()
+    transaction.on_commit(callback)
+    return callback
+
+
+def get_cached(key, render, timeout=None):
+    """
+    Returns the content cached under key for the current catalog version
+
+    render() is called (and its result cached, for timeout seconds or until
+    evicted) when the catalog changed since the content was cached.
+    """
+    cached = cache.get_many([VERSION_KEY, key])
+    version = cached.get(VERSION_KEY)
+    entry = cached.get(key)
+    if version is not None and entry is not None and entry[0] == version:
+        return entry[1]
+
+    if version is None:
+        version = _init_version()
+    # a lagging replica could cache the previous catalog under the new version
+    with routers.primary():
+        content = render()
+    cache.set(key, (version, content), timeout=timeout)
+    return content
+
+
+def get_menu():
+    """
+    Returns the rendered menu JSON (bytes) for the current catalog version
+    """
+    return get_cached(MENU_KEY, render_menu)
+
+
+def get_normalized_menu():
+    """
+    Returns the rendered normalized menu JSON (bytes) for the current catalog version
+    """
+    return get_cached(NORMALIZED_MENU_KEY, render_normalized_menu)
+
+
+def get_menu_changes(since):
+    """
+    Returns the rendered changes of the normalized menu since version since, None if not logged
+
+    Cached per since, devices that last synced at the same version share one render. These
+    entries expire after MENU_CHANGES_TIMEOUT, every old since would stay cached otherwise.
+    """
+    return get_cached(
+        '{}:{}'.format(MENU_CHANGES_KEY, since), lambda: render_menu_changes(since), timeout=MENU_CHANGES_TIMEOUT)
@@ -0,0 +1,498 @@
+"""
+Catalog import and export as a JSON document
+
+The document lists the option lookup tables and the products with their
+through rows (sizes, milks, flavors, ...) and defaults, everything referenced
+by natural key instead of by id:
+
+    {
+      "sizes": ["Small", "Large"],
+      "flavor_categories": ["Syrups"],
+      "flavors": [{"category": "Syrups", "name": "Vanilla"}],
+      "toppings": [{"category": "Drizzle", "name": "Caramel Drizzle",
+                    "default_choice": "Regular", "allowed_choices": ["No", "Regular"]}],
+      ...
+      "products": [{
+        "name": "Latte", "price": "3.50", "is_active": true,
+        "allowed_ice": ["No", "Light"], "default_ice": "No",
+        "sizes": [{"size": "Small", "price": "0.00", "default_espresso_shots": 1}],
+        "default_size": "Small",
+        "flavors": [{"flavor": ["Syrups", "Vanilla"], "price": "0.50"}],
+        "default_flavors": [["Syrups", "Vanilla"]],
+        ...
+      }]
+    }
+
+Defaults are the product's own rows, or another product's row given as
+{"product": "Mocha", "flavor": ["Syrups", "Vanilla"]}. Rows sharing a natural
+key (e.g. two sizes named "Small") all match the first one.
+
+import_catalog() matches options by name (flavors and toppings by category
+and name), products by name and through rows by product and option, then
+creates the missing rows and updates the changed ones with bulk writes (a
+few queries per table) in one transaction, so a seasonal menu with thousands
+of rows loads in seconds. Options and products missing from the document are
+left alone, as are the keys an entry leaves out; the through rows of an
+imported product missing from its list are deactivated (orders reference
+them, they can't be deleted). The written rows are added to the change log,
+kiosks sync them like admin edits.
+"""
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import catalog, models, synthetic
+
+# (document key, model) of the lookup tables matched by name
+NAMED_OPTIONS = (
+    ('ice_choices', models.IceChoice),
+    ('room_choices', models.RoomChoice),
+    ('temp_choices', models.TempChoice),
+    ('foam_choices', models.FoamChoice),
+    ('sizes', models.Size),
+    ('milks', models.Milk),
+    ('sweeteners', models.Sweetener),
+    ('espresso_shots', models.EspressoShot),
+    ('juices', models.Juice),
+    ('teas', models.Tea),
+    ('flavor_categories', models.FlavorCategory),
+    ('topping_categories', models.ToppingCategory),
+    ('topping_choices', models.ToppingChoice),
+)
+# (document key, model) of the options matched by [category name, name]
+CATEGORIZED_OPTIONS = (
+    ('flavors', models.Flavor),
+    ('toppings', models.Topping),
+)
+
+PRODUCT_FIELDS = ('price', 'is_active')
+# (Product M2M, Product FK to the default) of the lookup tables products use directly
+PRODUCT_CHOICES = (
+    ('allowed_ice', 'default_ice'),
+    ('allowed_room', 'default_room'),
+    ('allowed_milk_temps', 'default_milk_temp'),
+    ('allowed_milk_foams', 'default_milk_foam'),
+)
+# (document key, through model, its FK to the option, Product FK or M2M to the default rows)
+PRODUCT_ROWS = (
+    ('sizes', models.ProductSize, 'size', 'default_size'),
+    ('milks', models.ProductMilk, 'milk', 'default_milk'),
+    ('sweeteners', models.ProductSweetener, 'sweetener', 'default_sweeteners'),
+    ('flavors', models.ProductFlavor, 'flavor', 'default_flavors'),
+    ('espresso_shots', models.ProductEspressoShot, 'espresso_shot', 'default_espresso_shots'),
+    ('juices', models.ProductJuice, 'juice', 'default_juices'),
+    ('toppings', models.ProductTopping, 'topping', 'default_toppings'),
+    ('teas', models.ProductTea, 'tea', 'default_teas'),
+)
+ROW_MODELS = tuple(model for _, model, _, _ in PRODUCT_ROWS)
+
+BATCH_SIZE = 500
+
+
+def row_fields(model):
+    """
+    The fields of a Product* through row besides its product and option (price, is_active, ...)
+    """
+    return [field.name for field in model._meta.concrete_fields if not field.is_relation and not field.primary_key]
+
+
+def is_categorized(model):
+    return model in dict(CATEGORIZED_OPTIONS).values()
+
+
+def to_json(value):
+    return value if value is None or isinstance(value, (bool, int, str)) else str(value)
+
+
+def format_key(key):
+    if isinstance(key, (tuple, list)):
+        return '/'.join(format_key(part) for part in key)
+    return str(key)
+
+
+def export_catalog():
+    """
+    Returns the whole catalog as a document import_catalog() accepts, sorted so exports diff well
+    """
+    labels = {}
+    document = {}
+    for key, model in NAMED_OPTIONS:
+        labels[model] = dict(model.objects.order_by('-pk').values_list('pk', 'name'))
+        document[key] = sorted(set(labels[model].values()))
+    for key, model in CATEGORIZED_OPTIONS:
+        labels[model] = {
+            pk: (category, name)
+            for pk, category, name in model.objects.order_by('-pk').values_list('pk', 'category__name', 'name')
+        }
+    document['flavors'] = [
+        {'category': category, 'name': name}
+        for category, name in sorted(set(labels[models.Flavor].values()))
+    ]
+
+    allowed_choices = m2m_targets(models.Topping, 'allowed_choices')
+    toppings = {}
+    for pk, name, default_choice in models.Topping.objects.order_by('-pk').values_list(
+            'pk', 'name', 'default_choice'):
+        toppings[labels[models.Topping][pk]] = {
+            'category': labels[models.Topping][pk][0],
+            'name': name,
+            'default_choice': labels[models.ToppingChoice].get(default_choice),
+            'allowed_choices': sorted({labels[models.ToppingChoice][choice] for choice in allowed_choices[pk]}),
+        }
+    document['toppings'] = [entry for _, entry in sorted(toppings.items())]
+
+    products = {}
+    for product in models.Product.objects.order_by('name', 'pk'):
+        products[product.pk] = entry = {'name': product.name}
+        for field_name in PRODUCT_FIELDS:
+            entry[field_name] = to_json(getattr(product, field_name))
+        for m2m_name, fk_name in PRODUCT_CHOICES:
+            related_model = models.Product._meta.get_field(fk_name).related_model
+            entry[m2m_name] = []
+            entry[fk_name] = labels[related_model].get(getattr(product, fk_name + '_id'))
+
+    for m2m_name, fk_name in PRODUCT_CHOICES:
+        related_model = models.Product._meta.get_field(fk_name).related_model
+        for product_id, targets in m2m_targets(models.Product, m2m_name).items():
+            products[product_id][m2m_name] = sorted({labels[related_model][target] for target in targets})
+
+    for key, model, option_field_name, default_name in PRODUCT_ROWS:
+        option_model = model._meta.get_field(option_field_name).related_model
+        fields = row_fields(model)
+        row_labels = {}
+        row_products = {}
+        rows = defaultdict(dict)
+        for row in model.objects.order_by('-pk'):
+            row_labels[row.pk] = label = labels[option_model][getattr(row, option_field_name + '_id')]
+            row_products[row.pk] = row.product_id
+            # of duplicate rows, the first one (the one imports match)
+            rows[row.product_id][format_key(label)] = dict(
+                {option_field_name: label},
+                **{field_name: to_json(getattr(row, field_name)) for field_name in fields})
+
+        default_field = models.Product._meta.get_field(default_name)
+        if default_field.many_to_many:
+            defaults = m2m_targets(models.Product, default_name)
+        else:
+            defaults = dict(models.Product.objects.values_list('pk', default_field.attname))
+
+        def default_label(product_id, row_id):
+            if row_products[row_id] == product_id:
+                return row_labels[row_id]
+            # a default borrowed from another product's rows
+            return {'product': products[row_products[row_id]]['name'], option_field_name: row_labels[row_id]}
+
+        for product_id, entry in products.items():
+            entry[key] = [row for _, row in sorted(rows[product_id].items())]
+            if default_field.many_to_many:
+                entry[default_name] = sorted(
+                    (default_label(product_id, row_id) for row_id in defaults[product_id]), key=str)
+            elif defaults[product_id] is not None:
+                entry[default_name] = default_label(product_id, defaults[product_id])
+            else:
+                entry[default_name] = None
+
+    document['products'] = list(products.values())
+    return document
+
+
+def m2m_targets(model, field_name):
+    """
+    Returns {model pk: set of related pks} of a many-to-many field, in one query
+    """
+    field = model._meta.get_field(field_name)
+    targets = defaultdict(set)
+    for source, target in field.remote_field.through.objects.values_list(
+            field.m2m_field_name() + '_id', field.m2m_reverse_name()):
+        targets[source].add(target)
+    return targets
+
+
+def import_catalog(document, dry_run=False):
+    """
+    Imports a catalog document (see the module docstring), returns the changes as diff lines
+
+    With dry_run, the import is rolled back once the diff is computed. Raises
+    ValueError for documents that reference unknown options or rows.
+    """
+    importer = CatalogImporter()
+    with transaction.atomic():
+        importer.run(document)
+        if dry_run:
+            transaction.set_rollback(True)
+    return importer.diff
+
+
+class CatalogImporter:
+    def __init__(self):
+        # {model: {natural key: instance}}, the first (lowest pk) row of each key
+        self.objects = defaultdict(dict)
+        # {model: {pk: natural key}}, every row
+        self.labels = defaultdict(dict)
+        # {model: set of written pks}, for the change log
+        self.changed = defaultdict(set)
+        self.diff = []
+
+    def run(self, document):
+        if not isinstance(document, dict):
+            raise ValueError("The catalog document must be a JSON object")
+
+        for key, model in NAMED_OPTIONS:
+            self.load(model, model.objects.all(), lambda obj: obj.name)
+            self.save(model, {
+                name: {'name': self.clean(model, 'name', name, name)}
+                for name in self.entries(document, key, model, lambda name: name)
+            })
+        self.import_categorized(document)
+
+        self.load(models.Product, models.Product.objects.all(), lambda obj: obj.name)
+        entries = self.entries(document, 'products', models.Product, lambda entry: self.require(entry, 'name'))
+        wanted = {}
+        for name, entry in entries.items():
+            values = wanted[name] = {'name': self.clean(models.Product, 'name', name, name)}
+            if name not in self.objects[models.Product] and 'price' not in entry:
+                raise ValueError("product {}: new products need a price".format(name))
+            values.update(self.clean_values(models.Product, name, entry, PRODUCT_FIELDS))
+            for _, fk_name in PRODUCT_CHOICES:
+                if fk_name in entry:
+                    related_model = models.Product._meta.get_field(fk_name).related_model
+                    values[fk_name + '_id'] = self.pk(related_model, entry[fk_name], allow_none=True)
+        products = self.save(models.Product, wanted)
+        product_ids = [products[name].pk for name in entries]
+
+        for m2m_name, fk_name in PRODUCT_CHOICES:
+            related_model = models.Product._meta.get_field(fk_name).related_model
+            self.set_m2m(models.Product, m2m_name, {
+                products[name].pk: {self.pk(related_model, value) for value in entry[m2m_name]}
+                for name, entry in entries.items()
+                if m2m_name in entry
+            })
+
+        default_rows = {}
+        for key, model, option_field_name, default_name in PRODUCT_ROWS:
+            option_model = model._meta.get_field(option_field_name).related_model
+            many = models.Product._meta.get_field(default_name).many_to_many
+            defaults = {
+                name: [
+                    self.default_row_key(name, option_model, option_field_name, value)
+                    for value in (entry[default_name] if many else [entry[default_name]])
+                    if value is not None
+                ]
+                for name, entry in entries.items()
+                if default_name in entry
+            }
+            borrowed_ids = {
+                self.pk(models.Product, row_key[0]) for row_keys in defaults.values() for row_key in row_keys
+            }
+            self.import_rows(entries, set(product_ids) | borrowed_ids, key, model, option_field_name)
+
+            if many:
+                self.set_m2m(models.Product, default_name, {
+                    products[name].pk: {self.pk(model, row_key) for row_key in row_keys}
+                    for name, row_keys in defaults.items()
+                })
+            else:
+                for name, row_keys in defaults.items():
+                    default_rows.setdefault(name, {})[default_name + '_id'] = (
+                        self.pk(model, row_keys[0]) if row_keys else None)
+        # the default rows exist now
+        self.save(models.Product, default_rows)
+
+        for model, pks in self.changed.items():
+            catalog.log_changes(model, sorted(pks))
+        if self.changed:
+            catalog.catalog_changed()
+
+    def import_categorized(self, document):
+        for key, model in CATEGORIZED_OPTIONS:
+            category_model = model._meta.get_field('category').related_model
+            self.load(model, model.objects.all(), lambda obj: (self.labels[category_model][obj.category_id], obj.name))
+            entries = self.entries(
+                document, key, model, lambda entry: (self.require(entry, 'category'), self.require(entry, 'name')))
+            wanted = {}
+            for option_key, entry in entries.items():
+                values = wanted[option_key] = {
+                    'category_id': self.pk(category_model, option_key[0]),
+                    'name': self.clean(model, 'name', option_key, option_key[1]),
+                }
+                if model is models.Topping and 'default_choice' in entry:
+                    values['default_choice_id'] = self.pk(
+                        models.ToppingChoice, entry['default_choice'], allow_none=True)
+            objects = self.save(model, wanted)
+
+            if model is models.Topping:
+                self.set_m2m(model, 'allowed_choices', {
+                    objects[option_key].pk: {self.pk(models.ToppingChoice, name) for name in entry['allowed_choices']}
+                    for option_key, entry in entries.items()
+                    if 'allowed_choices' in entry
+                })
+
+    def import_rows(self, entries, product_ids, key, model, option_field_name):
+        option_model = model._meta.get_field(option_field_name).related_model
+        option_attname = option_field_name + '_id'
+        self.load(model, model.objects.filter(product__in=product_ids), lambda row: (
+            self.labels[models.Product][row.product_id], self.labels[option_model][getattr(row, option_attname)]))
+
+        listed = {name: entry[key] for name, entry in entries.items() if key in entry}
+        wanted = {}
+        for name, rows in listed.items():
+            for row in rows:
+                row_key = (name, self.key(option_model, self.require(row, option_field_name)))
+                if row_key in wanted:
+                    raise ValueError("{} {} is listed twice".format(model._meta.model_name, format_key(row_key)))
+                values = wanted[row_key] = {
+                    'product_id': self.objects[models.Product][name].pk,
+                    option_attname: self.pk(option_model, row_key[1]),
+                    'is_active': True,
+                }
+                values.update(self.clean_values(model, row_key, row, row_fields(model)))
+        for row_key, row in self.objects[model].items():
+            if row_key[0] in listed and row_key not in wanted and row.is_active:
+                wanted[row_key] = {'is_active': False}
+        self.save(model, wanted)
+
+    def default_row_key(self, name, option_model, option_field_name, value):
+        """
+        The (product name, option key) of a default row, another product's row when given as
+        {"product": name, "<option field>": option key}
+        """
+        if isinstance(value, dict):
+            return (self.require(value, 'product'), self.key(option_model, self.require(value, option_field_name)))
+        return (name, self.key(option_model, value))
+
+    def entries(self, document, key, model, get_key):
+        """
+        Returns {natural key: entry} of a document list
+        """
+        entries = {}
+        for entry in document.get(key, ()):
+            entry_key = get_key(entry)
+            if entry_key in entries:
+                raise ValueError("{} {} is listed twice".format(model._meta.model_name, format_key(entry_key)))
+            entries[entry_key] = entry
+        return entries
+
+    def require(self, entry, field_name):
+        if not isinstance(entry, dict) or field_name not in entry:
+            raise ValueError("{!r} has no {}".format(entry, field_name))
+        return entry[field_name]
+
+    def key(self, model, value):
+        # JSON has no tuples, categorized options are [category, name] lists
+        if is_categorized(model) and isinstance(value, list) and len(value) == 2:
+            return tuple(value)
+        return value
+
+    def pk(self, model, value, allow_none=False):
+        if value is None and allow_none:
+            return None
+        obj = self.objects[model].get(self.key(model, value))
+        if obj is None:
+            raise ValueError("Unknown {} {}".format(model._meta.model_name, format_key(value)))
+        return obj.pk
+
+    def clean(self, model, field_name, key, value):
+        try:
+            return model._meta.get_field(field_name).clean(value, None)
+        except ValidationError as exc:
+            raise ValueError("{} {}: {}: {}".format(
+                model._meta.model_name, format_key(key), field_name, ' '.join(exc.messages)))
+
+    def clean_values(self, model, key, entry, field_names):
+        return {
+            field_name: self.clean(model, field_name, key, entry[field_name])
+            for field_name in field_names
+            if field_name in entry
+        }
+
+    def load(self, model, queryset, get_key):
+        for obj in queryset.order_by('-pk'):
+            key = get_key(obj)
+            self.objects[model][key] = obj
+            self.labels[model][obj.pk] = key
+
+    def save(self, model, wanted):
+        """
+        Creates the rows of wanted ({natural key: {attname: value}}) that don't exist and updates the changed ones
+
+        Returns {natural key: instance} of every loaded row of model.
+        """
+        objects = self.objects[model]
+        created = []
+        updated = []
+        update_fields = set()
+        for key, values in wanted.items():
+            obj = objects.get(key)
+            if obj is None:
+                obj = objects[key] = model(**values)
+                created.append((key, obj))
+                self.diff.append('+ {} {}'.format(model._meta.model_name, format_key(key)))
+                continue
+            changes = [(attname, value) for attname, value in values.items() if getattr(obj, attname) != value]
+            if changes:
+                self.diff.append('~ {} {}: {}'.format(model._meta.model_name, format_key(key), ', '.join(
+                    '{} {} -> {}'.format(
+                        model._meta.get_field(attname).name,
+                        self.describe(model, attname, getattr(obj, attname)),
+                        self.describe(model, attname, value))
+                    for attname, value in changes)))
+                for attname, value in changes:
+                    setattr(obj, attname, value)
+                updated.append(obj)
+                update_fields.update(model._meta.get_field(attname).name for attname, _ in changes)
+
+        synthetic.bulk_create(model, [obj for _, obj in created], batch_size=BATCH_SIZE)
+        for key, obj in created:
+            self.labels[model][obj.pk] = key
+        if updated:
+            model.objects.bulk_update(updated, sorted(update_fields), batch_size=BATCH_SIZE)
+        self.changed[model].update(obj.pk for _, obj in created)
+        self.changed[model].update(obj.pk for obj in updated)
+        return objects
+
+    def describe(self, model, attname, value):
+        field = model._meta.get_field(attname)
+        if field.is_relation and value is not None:
+            return self.label(field.related_model, value)
+        return value
+
+    def label(self, model, pk):
+        key = self.labels[model].get(pk, pk)
+        # through rows are (product, option), the product is obvious from context
+        return format_key(key[1] if model in ROW_MODELS else key)
+
+    def set_m2m(self, model, field_name, wanted):
+        """
+        Makes the related rows of a many-to-many field those of wanted ({model pk: set of related pks})
+        """
+        if not wanted:
+            return
+        field = model._meta.get_field(field_name)
+        through = field.remote_field.through
+        source = field.m2m_field_name() + '_id'
+        target = field.m2m_reverse_name()
+        current = defaultdict(set)
+        link_ids = {}
+        for pk, source_id, target_id in through.objects.filter(**{source + '__in': list(wanted)}).values_list(
+                'pk', source, target):
+            current[source_id].add(target_id)
+            link_ids[source_id, target_id] = pk
+
+        added = []
+        removed = []
+        for source_id, targets in wanted.items():
+            label = '{} {}: {}'.format(
+                model._meta.model_name, format_key(self.labels[model][source_id]), field_name)
+            for target_id in sorted(targets - current[source_id]):
+                added.append(through(**{source: source_id, target: target_id}))
+                self.diff.append('+ {} {}'.format(label, self.label(field.related_model, target_id)))
+            for target_id in sorted(current[source_id] - targets):
+                removed.append(link_ids[source_id, target_id])
+                self.diff.append('- {} {}'.format(label, self.label(field.related_model, target_id)))
+            if targets != current[source_id]:
+                self.changed[model].add(source_id)
+
+        for start in range(0, len(removed), BATCH_SIZE):
+            through.objects.filter(pk__in=removed[start:start + BATCH_SIZE]).delete()
+        through.objects.bulk_create(added, batch_size=BATCH_SIZE)
@@ -0,0 +1,180 @@
+"""
+Default customizations of each product, precomputed per size
+
+A product's defaults are spread over its default_* FKs and M2Ms, and the
+quantities of its default flavors, espresso shots and teas depend on the
+size. Every active size of every active product gets a DefaultCustomization
+row with the resolved payload as a snapshot (see snapshots.py) and its
+price, so an "add as-is" is one indexed read. After every catalog commit
+(see signals.py) the products changed since the last refresh are rebuilt,
+per the catalog change log (everything when the log doesn't say).
+"""
+import operator
+from functools import reduce
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+from . import catalog, models, option_index, orders, pricing, snapshots
+
+VERSION_KEY = 'defaults:version'
+
+# products rebuilt per round of queries, keeps the IN (...) lists short
+CHUNK_SIZE = 200
+
+# options whose default quantity is on the ProductSize, the others default to 1:
+# {CustomizedProduct field: ProductSize field}
+SIZE_QUANTITIES = {
+    'flavors': 'default_flavor_pumps',
+    'espresso_shots': 'default_espresso_shots',
+    'teas': 'default_tea_quantity',
+}
+
+# {CustomizedProduct field: Product* through model}
+ROW_MODELS = dict(
+    list(orders.PRODUCT_ROW_FIELDS) + [(field_name, row_model) for field_name, _, _, row_model in orders.OPTION_FIELDS])
+
+
+def build_items(product_ids):
+    """
+    Returns (validated CustomizedProductSerializer payload, is the default size) of the defaults of each active size
+
+    Sizes whose defaults wouldn't pass order validation (e.g. a product
+    without a default milk) are left out, and so are the options whose
+    size's default quantity is 0. Reads the through tables directly, a fixed
+    number of queries.
+    """
+    index = option_index.get_index()
+    products = {
+        product['pk']: product
+        for product in models.Product.objects.filter(is_active=True, pk__in=product_ids).values(
+            'pk', 'default_size_id', 'default_milk_id',
+            *('default_{}_id'.format(field_name) for field_name, _ in orders.CHOICE_FIELDS))
+    }
+    default_rows = {}
+    for field_name, _, _, _ in orders.OPTION_FIELDS:
+        m2m_field = models.Product._meta.get_field('default_' + field_name)
+        rows = m2m_field.remote_field.through.objects.filter(product_id__in=products).order_by('pk').values_list(
+            'product_id', m2m_field.m2m_reverse_name())
+        for product_id, row_id in rows:
+            default_rows.setdefault((product_id, field_name), []).append(row_id)
+
+    items = []
+    product_sizes = models.ProductSize.objects.filter(product_id__in=products, is_active=True).order_by('pk').values(
+        'pk', 'product_id', *SIZE_QUANTITIES.values())
+    for product_size in product_sizes:
+        product = products[product_size['product_id']]
+        item = {'product': product['pk'], 'size': product_size['pk'], 'milk': product['default_milk_id']}
+        for field_name, _ in orders.CHOICE_FIELDS:
+            item[field_name] = product['default_{}_id'.format(field_name)]
+        for field_name, _, row_field_name, _ in orders.OPTION_FIELDS:
+            quantity = product_size[SIZE_QUANTITIES[field_name]] if field_name in SIZE_QUANTITIES else 1
+            item[field_name] = [
+                {row_field_name: row_id, 'quantity': quantity}
+                for row_id in default_rows.get((product['pk'], field_name), ())
+            ] if quantity else []
+        if not orders.validate_customized_product(item, index.get(product['pk'])):
+            items.append((item, product_size['pk'] == product['default_size_id']))
+    return items
+
+
+def refresh(product_ids=None):
+    """
+    Rebuilds the default customizations of the products (all of them when None), returns how many were written
+    """
+    with transaction.atomic():
+        if product_ids is None:
+            models.DefaultCustomization.objects.all().delete()
+            product_ids = list(models.Product.objects.filter(is_active=True).values_list('pk', flat=True))
+        else:
+            product_ids = list(product_ids)
+        written = 0
+        for start in range(0, len(product_ids), CHUNK_SIZE):
+            chunk = product_ids[start:start + CHUNK_SIZE]
+            items = build_items(chunk)
+            models.DefaultCustomization.objects.filter(product_id__in=chunk).delete()
+            models.DefaultCustomization.objects.bulk_create([
+                models.DefaultCustomization(
+                    product_id=item['product'],
+                    size_id=item['size'],
+                    is_default=is_default,
+                    total=snapshots.total(snapshot),
+                    snapshot=snapshots.dumps(snapshot),
+                )
+                for (item, is_default), snapshot in zip(items, snapshots.build_snapshots([item for item, _ in items]))
+            ], batch_size=pricing.BATCH_SIZE)
+            written += len(items)
+    return written
+
+
+def changed_products(changed):
+    """
+    Returns the ids of the products whose defaults the logged catalog changes ({model name: ids}) may affect
+
+    None (everything) when a changed through row was deleted, its product
+    isn't known anymore.
+    """
+    product_ids = set(changed.get(models.Product._meta.model_name, ()))
+
+    row_ids = {
+        field_name: changed[row_model._meta.model_name]
+        for field_name, row_model in ROW_MODELS.items() if row_model._meta.model_name in changed
+    }
+    option_ids = {}
+    for field_name, row_model in ROW_MODELS.items():
+        option_model = orders.option_field(row_model).related_model
+        if option_model._meta.model_name in changed:
+            option_ids[field_name] = changed[option_model._meta.model_name]
+    conditions = [Q(option_type=field_name, row_id__in=ids) for field_name, ids in row_ids.items()]
+    conditions += [Q(option_type=field_name, option_id__in=ids) for field_name, ids in option_ids.items()]
+    if conditions:
+        found_rows = set()
+        for option_type, row_id, product_id in models.ProductOption.objects.filter(
+                reduce(operator.or_, conditions)).values_list('option_type', 'row_id', 'product_id'):
+            found_rows.add((option_type, row_id))
+            product_ids.add(product_id)
+        if any((field_name, row_id) not in found_rows for field_name, ids in row_ids.items() for row_id in ids):
+            return None
+
+    # the choices are only in the snapshots of the products that default to them
+    choice_conditions = [
+        Q(**{'default_{}__in'.format(field_name): changed[model._meta.model_name]})
+        for field_name, model in snapshots.CHOICE_MODELS.items() if model._meta.model_name in changed
+    ]
+    if choice_conditions:
+        product_ids.update(
+            models.Product.objects.filter(reduce(operator.or_, choice_conditions)).values_list('pk', flat=True))
+    return product_ids
+
+
+def refresh_changes():
+    """
+    Refreshes the default customizations of the products changed since the last refresh, returns how many were written
+    """
+    since = cache.get(VERSION_KEY)
+    logged = None if since is None else catalog.get_changes(since)
+    if logged is None:
+        version = catalog.get_changes_version()
+        written = refresh()
+    else:
+        version, changed = logged
+        written = refresh(changed_products(changed))
+    cache.set(VERSION_KEY, version, timeout=None)
+    return written
+
+
+def get_default(product_id, size_id=None):
+    """
+    Returns the DefaultCustomization of a product in a size (ProductSize id, its default size when None), or None
+    """
+    queryset = models.DefaultCustomization.objects.filter(product_id=product_id)
+    if size_id is None:
+        queryset = queryset.filter(is_default=True)
+    else:
+        queryset = queryset.filter(size_id=size_id)
+    return queryset.first()
+
+
+def catalog_committed(sender, **kwargs):
+    refresh_changes()
@@ -0,0 +1,121 @@
+"""
+Streaming export of CustomizedProduct history as NDJSON or CSV
+
+Rows are read with QuerySet.iterator() and rendered from their snapshots
+(see snapshots.py), without joins. Memory use depends on the chunk size
+rather than on the size of the exported range.
+"""
+import csv
+import io
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import models, orders, snapshots
+
+CHUNK_SIZE = 2000
+
+CSV_COLUMNS = (
+    'id',
+    'created_at',
+    'updated_at',
+    'product_id',
+    'product',
+    'size',
+    'milk',
+    'milk_temp',
+    'milk_foam',
+    'ice',
+    'room',
+    'total',
+) + tuple(field_name for field_name, _, _, _ in orders.OPTION_FIELDS)
+
+
+def export_queryset(start=None, end=None):
+    """
+    Returns the CustomizedProducts created in [start, end), oldest first
+    """
+    queryset = models.CustomizedProduct.objects.order_by('created_at', 'pk')
+    if start is not None:
+        queryset = queryset.filter(created_at__gte=start)
+    if end is not None:
+        queryset = queryset.filter(created_at__lt=end)
+    return queryset
+
+
+def iter_chunks(queryset, chunk_size=CHUNK_SIZE):
+    """
+    Yields lists of at most chunk_size customized products
+
+    Rows written before snapshots get one built from their relational rows,
+    a few queries per chunk that has any.
+    """
+    chunk = []
+    for customized_product in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(customized_product)
+        if len(chunk) == chunk_size:
+            yield snapshots.attach(chunk)
+            chunk = []
+    if chunk:
+        yield snapshots.attach(chunk)
+
+
+def export_row(customized_product):
+    """
+    Returns the export record (a dict) for a customized product loaded by iter_chunks
+    """
+    snapshot = customized_product.get_snapshot()
+    row = {
+        'id': customized_product.pk,
+        'created_at': customized_product.created_at,
+        'updated_at': customized_product.updated_at,
+        'product_id': customized_product.product_id,
+        'product': snapshot['product']['name'],
+        'size': snapshot['size']['name'],
+        'milk': snapshot['milk']['name'],
+        'milk_temp': snapshot['milk_temp']['name'],
+        'milk_foam': snapshot['milk_foam']['name'],
+        'ice': snapshot['ice']['name'],
+        'room': snapshot['room']['name'],
+        'total': customized_product.total,
+    }
+    for field_name, _, _, _ in orders.OPTION_FIELDS:
+        row[field_name] = [
+            {'id': option['id'], 'name': option['name'], 'quantity': option['quantity']}
+            for option in snapshot[field_name]
+        ]
+    return row
+
+
+def iter_ndjson(queryset, chunk_size=CHUNK_SIZE):
+    """
+    Yields one JSON document per line
+    """
+    for chunk in iter_chunks(queryset, chunk_size):
+        yield ''.join(
+            json.dumps(export_row(customized_product), cls=DjangoJSONEncoder) + '\n'
+            for customized_product in chunk
+        )
+
+
+def iter_csv(queryset, chunk_size=CHUNK_SIZE):
+    """
+    Yields CSV text, options are flattened to "name x quantity" lists separated by "; "
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for chunk in iter_chunks(queryset, chunk_size):
+        for customized_product in chunk:
+            row = export_row(customized_product)
+            for field_name, _, _, _ in orders.OPTION_FIELDS:
+                row[field_name] = '; '.join(
+                    '{} x {}'.format(option['name'], option['quantity']) for option in row[field_name])
+            row['created_at'] = row['created_at'].isoformat()
+            row['updated_at'] = row['updated_at'].isoformat()
+            writer.writerow([row[column] for column in CSV_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,266 @@
+"""
+Load tests of the WSGI and ASGI entry points and of running servers
+
+Requests are made by concurrent client coroutines. In process, they call the
+applications directly (no sockets or HTTP server involved), so the numbers
+compare what each entry point costs per request and how it behaves with many
+requests in flight: WSGI requests are queued on a fixed pool of worker
+threads like a threaded WSGI server, ASGI requests run on the event loop.
+Over HTTP, each client has its own keep-alive connection to a server
+(runserver, gunicorn, uvicorn...), which is what sizing a fleet needs.
+
+A run sends a weighted mix of endpoints and reports throughput, latency
+percentiles and error rates per endpoint.
+"""
+import asyncio
+import http.client
+import io
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+HOST = 'localhost'
+
+
+def asgi_scope(method, path, headers=()):
+    return {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('latin1'),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [(b'host', HOST.encode('latin1'))] + [
+            (name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers],
+        'client': ('127.0.0.1', 0),
+        'server': (HOST, 80),
+    }
+
+
+async def call_asgi(application, method, path, body=b'', headers=()):
+    """
+    Makes one request to an ASGI application, returns (status, content)
+    """
+    request_sent = False
+    messages = []
+
+    async def receive():
+        nonlocal request_sent
+        if request_sent:
+            return {'type': 'http.disconnect'}
+        request_sent = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    headers = tuple(headers) + (('Content-Length', str(len(body))),)
+    await application(asgi_scope(method, path, headers), receive, send)
+    status = messages[0]['status']
+    return status, b''.join(message.get('body', b'') for message in messages[1:])
+
+
+def call_wsgi(application, method, path, body=b'', headers=()):
+    """
+    Makes one request to a WSGI application, returns (status, content)
+    """
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': HOST,
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': HOST,
+        'REMOTE_ADDR': '127.0.0.1',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers:
+        key = name.upper().replace('-', '_')
+        environ[key if key == 'CONTENT_TYPE' else 'HTTP_' + key] = value
+
+    response = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+
+    result = application(environ, start_response)
+    try:
+        content = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], content
+
+
+def asgi_client(application):
+    async def call(method, path, body=b'', headers=()):
+        return await call_asgi(application, method, path, body, headers)
+    return call
+
+
+def wsgi_client(application, threads):
+    executor = ThreadPoolExecutor(max_workers=threads)
+
+    async def call(method, path, body=b'', headers=()):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, call_wsgi, application, method, path, body, headers)
+    return call
+
+
+def http_client(url, concurrency):
+    """
+    Returns a client of the HTTP server at url, one keep-alive connection per client thread
+
+    Requests that get no response (refused, reset, timed out) have status 0.
+    """
+    url = urllib.parse.urlsplit(url)
+    connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+    prefix = url.path.rstrip('/')
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    connections = threading.local()
+
+    def request(method, path, body=b'', headers=()):
+        connection = getattr(connections, 'connection', None)
+        if connection is None:
+            connection = connections.connection = connection_class(url.netloc, timeout=60)
+        try:
+            connection.request(method, prefix + path, body=body, headers=dict(headers))
+            response = connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connections.connection = None
+            return 0, b''
+
+    async def call(method, path, body=b'', headers=()):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, request, method, path, body, headers)
+    return call
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def summarize(latencies, statuses, elapsed):
+    """
+    Returns the summary dict of requests that took latencies (ms) and got statuses
+    """
+    errors = sum(1 for status in statuses if status == 0 or status >= 400)
+    counts = {}
+    for status in statuses:
+        counts[str(status)] = counts.get(str(status), 0) + 1
+    return {
+        'requests': len(statuses),
+        'errors': errors,
+        'error_rate': round(errors / len(statuses), 4),
+        'statuses': counts,
+        'requests_per_second': round(len(statuses) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(statistics.median(latencies), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'max': round(max(latencies), 3),
+        },
+    }
+
+
+async def run(call, mix, requests, concurrency, seed=0):
+    """
+    Sends requests requests from concurrency clients, returns the summary dict, with one per endpoint
+
+    mix is a list of (endpoint name, weight, make_request), make_request()
+    returns the (method, path, body, headers) of the endpoint's next request.
+    The endpoint of each request is drawn by weight, in the same order for a
+    given seed.
+    """
+    rng = random.Random(seed)
+    endpoints = rng.choices([entry[0] for entry in mix], [entry[1] for entry in mix], k=requests)
+    make_requests = {name: make_request for name, _, make_request in mix}
+    results = {name: ([], []) for name in set(endpoints)}
+    remaining = iter(endpoints)
+
+    async def client():
+        for name in remaining:
+            start = time.perf_counter()
+            status, _ = await call(*make_requests[name]())
+            latencies, statuses = results[name]
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses.append(status)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(
+        [latency for latencies, _ in results.values() for latency in latencies],
+        [status for _, statuses in results.values() for status in statuses],
+        elapsed)
+    summary['concurrency'] = concurrency
+    summary['endpoints'] = {
+        name: summarize(latencies, statuses, elapsed) for name, (latencies, statuses) in results.items()
+    }
+    return summary
+
+
+# (summary key, label, higher is better) compare() reports
+COMPARED = (
+    ('requests_per_second', 'req/s', True),
+    ('p50', 'p50 ms', False),
+    ('p95', 'p95 ms', False),
+    ('p99', 'p99 ms', False),
+    ('error_rate', 'errors', False),
+)
+
+
+def compare(baseline, results):
+    """
+    Returns text lines comparing two result documents of the loadtest command, per run and endpoint
+    """
+    def rows(document):
+        found = {}
+        for result in document['results']:
+            key = (result['scenario'], result['target'])
+            found[key + ('all',)] = result
+            for name, endpoint in result.get('endpoints', {}).items():
+                found[key + (name,)] = endpoint
+        return found
+
+    def value(summary, key):
+        return summary['latency_ms'][key] if key in summary['latency_ms'] else summary.get(key)
+
+    baseline, results = rows(baseline), rows(results)
+    lines = []
+    for key in sorted(set(baseline) & set(results)):
+        changes = []
+        for summary_key, label, higher_is_better in COMPARED:
+            before, after = value(baseline[key], summary_key), value(results[key], summary_key)
+            if before is None or after is None:
+                continue
+            change = '{} {} -> {}'.format(label, before, after)
+            if before:
+                delta = (after - before) / before * 100
+                worse = delta < 0 if higher_is_better else delta > 0
+                change += ' ({:+.0f}%{})'.format(delta, ' worse' if worse and abs(delta) >= 10 else '')
+            changes.append(change)
+        lines.append('{}: {}'.format(' '.join(key), ', '.join(changes)))
+    for key in sorted(set(baseline) ^ set(results)):
+        lines.append('{}: only in the {}'.format(' '.join(key), 'baseline' if key in baseline else 'results'))
+    return lines
@@ -0,0 +1,143 @@
+import json
+import platform
+import random
+import statistics
+import time
+import uuid
+
+import django
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from ... import catalog, models, option_index, synthetic
+
+
+class QueryCounter:
+    """
+    Database execute wrapper counting queries, unlike connection.queries it
+    isn't capped at 9000 entries
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the menu, order creation and admin pages on synthetic catalogs of several sizes. "
+        "Everything is generated inside a transaction that is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scales', default='10,100,1000',
+            help="comma separated numbers of products to benchmark with")
+        parser.add_argument('--orders-per-product', type=int, default=10)
+        parser.add_argument('--batch-size', type=int, default=50, help="customized products per order POST")
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--output', '-o', help="write the JSON results to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        results = {
+            'meta': {
+                'created_at': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'repeat': options['repeat'],
+            },
+            'results': [],
+        }
+        for scale in [int(scale) for scale in options['scales'].split(',')]:
+            self.stderr.write("Benchmarking {} products".format(scale))
+            results['results'].extend(self.run_scale(scale, options))
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run_scale(self, scale, options):
+        with transaction.atomic():
+            synthetic.generate_catalog(products=scale)
+            synthetic.generate_orders(scale * options['orders_per_product'])
+            # rolled back with the rest, but an existing user may have the name
+            user = User.objects.create_superuser('benchmark-{}'.format(uuid.uuid4().hex[:8]), None, None)
+            client = Client(HTTP_HOST='localhost')
+            client.force_login(user)
+
+            product = models.Product.objects.order_by('pk').last()
+            index = option_index.get_index()
+            product_ids = synthetic.orderable_products(index)
+            rng = random.Random(0)
+
+            def order_batch():
+                return json.dumps([
+                    synthetic.random_customization(product_id, index.get(product_id), rng)
+                    for product_id in rng.choices(product_ids, k=options['batch_size'])
+                ])
+
+            cases = (
+                ('products_cold', lambda: client.get(reverse('vue_form_products')), self.clear_menus),
+                ('products_warm', lambda: client.get(reverse('vue_form_products')), None),
+                ('menu_v2_cold', lambda: client.get(reverse('menu')), self.clear_menus),
+                ('products_sparse_page', lambda: client.get(
+                    reverse('vue_form_products'), {'fields': 'default_size', 'page_size': 50}), None),
+                ('order_create', lambda: client.post(
+                    reverse('customized_product_batch'), order_batch(), content_type='application/json'), None),
+                ('order_history', lambda: client.get(reverse('order_history')), None),
+                ('admin_product_change', lambda: client.get(
+                    reverse('admin:api_product_change', args=[product.pk])), None),
+                ('admin_customizedproduct_changelist', lambda: client.get(
+                    reverse('admin:api_customizedproduct_changelist')), None),
+            )
+            results = [
+                self.measure(scale, name, request, setup, options['repeat'])
+                for name, request, setup in cases
+            ]
+            transaction.set_rollback(True)
+
+        # the menus were cached from rows that no longer exist, a new catalog version drops them
+        catalog.bump_version()
+        return results
+
+    def clear_menus(self):
+        # only the rendered menus, the cache may be shared with running servers
+        cache.delete_many([catalog.MENU_KEY, catalog.NORMALIZED_MENU_KEY])
+
+    def measure(self, scale, name, request, setup, repeat):
+        latencies = []
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            queries = QueryCounter()
+            with connection.execute_wrapper(queries):
+                start = time.perf_counter()
+                response = request()
+                content = b''.join(response.streaming_content) if response.streaming else response.content
+                latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                raise CommandError("{} returned {}: {}".format(name, response.status_code, content[:500]))
+
+        return {
+            'scale': scale,
+            'name': name,
+            'status': response.status_code,
+            'queries': queries.count,
+            'bytes': len(content),
+            'latency_ms': {
+                'min': round(min(latencies), 3),
+                'median': round(statistics.median(latencies), 3),
+                'max': round(max(latencies), 3),
+            },
+        }
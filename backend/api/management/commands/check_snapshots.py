@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import models, snapshots
+
+
+class Command(BaseCommand):
+    help = "Checks the CustomizedProduct snapshots (see api/snapshots.py) against the relational rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=snapshots.CHUNK_SIZE)
+        parser.add_argument(
+            '--repair',
+            action='store_true',
+            help="rebuild missing and mismatched snapshots from the relational rows and the current catalog")
+
+    def handle(self, *args, **options):
+        queryset = models.CustomizedProduct.objects.all()
+        problems = repaired = 0
+        for customized_product, problem in snapshots.check(queryset, options['chunk_size'], options['repair']):
+            problems += 1
+            if options['repair'] and problem in snapshots.REPAIRABLE:
+                repaired += 1
+            self.stdout.write("{} {}".format(customized_product.pk, problem))
+
+        summary = "{} of {} snapshots didn't match".format(problems, queryset.count())
+        if options['repair']:
+            summary += ", {} repaired".format(repaired)
+        if problems > repaired:
+            raise CommandError(summary)
+        self.stdout.write(summary)
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import order_queue
+
+
+class Command(BaseCommand):
+    help = "Writes the order batches queued by the batch endpoint with settings.ORDER_QUEUE (see api/order_queue.py)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help="queued batches written per transaction (default settings.ORDER_QUEUE_BATCH_SIZE)")
+        parser.add_argument('--once', action='store_true', help="stop once the queue is empty")
+        parser.add_argument('--interval', type=float, default=1, help="seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        batches = items = failed = 0
+        while True:
+            drained = order_queue.drain(options['batch_size'])
+            batches += drained[0]
+            items += drained[1]
+            failed += drained[2]
+            if not drained[0]:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write("Drained {} batches ({} customized products, {} batches failed)".format(
+            batches, items, failed))
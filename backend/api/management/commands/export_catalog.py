@@ -0,0 +1,20 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from ... import catalog_io
+
+
+class Command(BaseCommand):
+    help = "Writes the products, their options and defaults as a catalog JSON document (see catalog_io.py)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', help="file to write to, defaults to stdout")
+
+    def handle(self, *args, **options):
+        content = json.dumps(catalog_io.export_catalog(), indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                output.write(content + '\n')
+        else:
+            self.stdout.write(content)
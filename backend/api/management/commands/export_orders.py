@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import export, serializers
+
+
+class Command(BaseCommand):
+    help = "Streams the customized products created in a date range as NDJSON or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help="first day/time to export (inclusive), ISO 8601")
+        parser.add_argument('--end', help="last day/time to export (exclusive), ISO 8601")
+        parser.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE)
+        parser.add_argument('--output', '-o', help="file to write to, defaults to stdout")
+
+    def handle(self, *args, **options):
+        params = serializers.ExportParamsSerializer(data={
+            key: options[key] for key in ('start', 'end') if options[key]
+        })
+        if not params.is_valid():
+            raise CommandError(params.errors)
+
+        queryset = export.export_queryset(**params.validated_data)
+        if options['format'] == 'csv':
+            rows = export.iter_csv(queryset, options['chunk_size'])
+        else:
+            rows = export.iter_ndjson(queryset, options['chunk_size'])
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                for text in rows:
+                    output.write(text)
+        else:
+            for text in rows:
+                self.stdout.write(text, ending='')
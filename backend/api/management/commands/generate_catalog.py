@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import synthetic
+
+
+class Command(BaseCommand):
+    help = "Generates a synthetic catalog (and optionally order history) with bulk inserts"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100)
+        parser.add_argument('--sizes', type=int, default=4)
+        parser.add_argument('--milks', type=int, default=8)
+        parser.add_argument('--flavors', type=int, default=20)
+        parser.add_argument('--toppings', type=int, default=20)
+        parser.add_argument('--flavor-categories', type=int, default=3)
+        parser.add_argument('--topping-categories', type=int, default=4)
+        parser.add_argument('--orders', type=int, default=0, help="number of customized products to generate")
+        parser.add_argument('--days', type=int, default=30, help="spread the orders over this many days")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        # every generated flavor and topping goes into one of the categories
+        for options_name, categories_name in (('flavors', 'flavor_categories'), ('toppings', 'topping_categories')):
+            if options[options_name] > 0 and options[categories_name] < 1:
+                raise CommandError("--{} needs at least one of --{}".format(
+                    options_name, categories_name.replace('_', '-')))
+
+        products = synthetic.generate_catalog(
+            products=options['products'],
+            sizes=options['sizes'],
+            milks=options['milks'],
+            flavors=options['flavors'],
+            toppings=options['toppings'],
+            flavor_categories=options['flavor_categories'],
+            topping_categories=options['topping_categories'],
+            seed=options['seed'])
+        self.stdout.write("Created {} products".format(len(products)))
+
+        if options['orders']:
+            created = synthetic.generate_orders(options['orders'], days=options['days'], seed=options['seed'])
+            self.stdout.write("Created {} customized products".format(len(created)))
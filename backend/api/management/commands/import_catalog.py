@@ -0,0 +1,30 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import catalog_io
+
+
+class Command(BaseCommand):
+    help = "Creates and updates products, their options and defaults from a catalog JSON document (see catalog_io.py)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="catalog document to import, - for stdin")
+        parser.add_argument('--dry-run', action='store_true', help="print the changes without saving them")
+
+    def handle(self, *args, **options):
+        try:
+            if options['path'] == '-':
+                document = json.load(sys.stdin)
+            else:
+                with open(options['path'], encoding='utf-8') as f:
+                    document = json.load(f)
+            diff = catalog_io.import_catalog(document, dry_run=options['dry_run'])
+        except (OSError, ValueError) as exc:
+            raise CommandError(exc)
+
+        if options['dry_run'] or options['verbosity'] > 1:
+            for line in diff:
+                self.stdout.write(line)
+        self.stdout.write("{} changes{}".format(len(diff), " (dry run, nothing saved)" if options['dry_run'] else ""))
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import random
+import uuid
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from ... import loadtest, models, option_index, synthetic
+
+TARGETS = ('wsgi', 'asgi-django', 'asgi', 'http')
+SCENARIOS = ('products', 'menu', 'orders', 'admin')
+
+
+def parse_mix(value):
+    """
+    Parses "products=70,orders=25,admin=5" into [(scenario, weight)]
+    """
+    mix = []
+    for entry in value.split(','):
+        name, _, weight = entry.partition('=')
+        try:
+            mix.append((name, float(weight or 1)))
+        except ValueError:
+            raise CommandError("Invalid mix entry: {}".format(entry))
+    return mix
+
+
+class Command(BaseCommand):
+    help = (
+        "Load tests the menu, order and admin endpoints with concurrent requests, in process (comparing "
+        "backend/wsgi.py, Django's own ASGI handler and backend/asgi.py) or against a server running on "
+        "the same database with --url. Reports throughput and p50/p95/p99 latency and error rates per "
+        "endpoint. Runs against the current database, the orders scenario writes customized products."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--targets', help="comma separated, from {} (default http with --url, the others without)".format(
+                TARGETS))
+        parser.add_argument('--url', help="server to load for the http target, e.g. http://127.0.0.1:8000")
+        parser.add_argument(
+            '--scenarios', default='products,menu', help="comma separated, from {}, each run alone".format(
+                SCENARIOS))
+        parser.add_argument(
+            '--mix',
+            help="weighted scenarios run together instead of --scenarios, e.g. products=70,orders=25,admin=5")
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument('--threads', type=int, default=8, help="WSGI worker threads")
+        parser.add_argument('--batch-size', type=int, default=5, help="customized products per order POST")
+        parser.add_argument('--admin-user', help="staff user browsing the admin (default the first superuser)")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', '-o', help="write the JSON results to this file instead of stdout")
+        parser.add_argument('--compare', help="results file of an earlier run to compare with, on stderr")
+
+    def handle(self, *args, **options):
+        targets = (options['targets'] or ('http' if options['url'] else 'wsgi,asgi-django,asgi')).split(',')
+        if options['mix']:
+            runs = [('mix', parse_mix(options['mix']))]
+        else:
+            runs = [(scenario, [(scenario, 1)]) for scenario in options['scenarios'].split(',')]
+        scenarios = {name for _, mix in runs for name, _ in mix}
+        unknown = (set(targets) - set(TARGETS)) | (scenarios - set(SCENARIOS))
+        if unknown:
+            raise CommandError("Unknown targets/scenarios: {}".format(', '.join(sorted(unknown))))
+        if 'http' in targets and not options['url']:
+            raise CommandError("The http target needs --url")
+
+        from backend import asgi, wsgi
+
+        clients = {
+            'wsgi': lambda: loadtest.wsgi_client(wsgi.application, options['threads']),
+            'asgi-django': lambda: loadtest.asgi_client(asgi.django_application),
+            'asgi': lambda: loadtest.asgi_client(asgi.application),
+            'http': lambda: loadtest.http_client(options['url'], options['concurrency']),
+        }
+        session = self.login(options['admin_user']) if 'admin' in scenarios else None
+        rng = random.Random(options['seed'])
+        make_requests = {
+            scenario: self.get_scenario(scenario, options['batch_size'], rng, session) for scenario in scenarios}
+
+        results = []
+        try:
+            for name, mix in runs:
+                mix = [(scenario, weight, make_requests[scenario]) for scenario, weight in mix]
+                for target in targets:
+                    self.stderr.write("{} {}".format(name, target))
+                    call = clients[target]()
+                    # one warm-up request per endpoint fills the caches
+                    for entry in mix:
+                        asyncio.run(loadtest.run(call, [entry], 1, 1))
+                    result = asyncio.run(loadtest.run(
+                        call, mix, options['requests'], options['concurrency'], options['seed']))
+                    result.update(scenario=name, target=target)
+                    results.append(result)
+        finally:
+            if session is not None:
+                session.delete()
+
+        document = {'threads': options['threads'], 'batch_size': options['batch_size'], 'results': results}
+        output = json.dumps(document, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            for line in loadtest.compare(baseline, document):
+                self.stderr.write(line)
+
+    def login(self, username):
+        """
+        Returns a session of a staff user for the admin scenario, saved where the server reads it
+        """
+        users = get_user_model().objects.filter(is_active=True, is_staff=True)
+        user = users.filter(username=username).first() if username else users.filter(
+            is_superuser=True).order_by('pk').first()
+        if user is None:
+            raise CommandError("The admin scenario needs a staff user, see --admin-user and createsuperuser")
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        return session
+
+    def get_scenario(self, scenario, batch_size, rng, session=None):
+        """
+        Returns the make_request() callable of a scenario
+        """
+        if scenario == 'products':
+            path = reverse('vue_form_products')
+            return lambda: ('GET', path, b'', ())
+        if scenario == 'menu':
+            path = reverse('menu')
+            return lambda: ('GET', path, b'', ())
+        if scenario == 'admin':
+            return self.get_admin_scenario(rng, session)
+
+        index = option_index.get_index()
+        product_ids = synthetic.orderable_products(index)
+        if not product_ids:
+            raise CommandError("The catalog has no products that can be ordered, see generate_catalog")
+        path = reverse('customized_product_batch')
+
+        def make_request():
+            body = json.dumps([
+                synthetic.random_customization(product_id, index.get(product_id), rng)
+                for product_id in rng.choices(product_ids, k=batch_size)
+            ]).encode('utf-8')
+            # required with settings.ORDER_QUEUE, ignored otherwise
+            return 'POST', path, body, (('Content-Type', 'application/json'), ('Idempotency-Key', str(uuid.uuid4())))
+        return make_request
+
+    def get_admin_scenario(self, rng, session):
+        """
+        Staff browsing the order and product lists and opening products and orders
+        """
+        headers = (('Cookie', '{}={}'.format(settings.SESSION_COOKIE_NAME, session.session_key)),)
+        product_ids = list(models.Product.objects.order_by('pk').values_list('pk', flat=True)[:1000])
+        order_ids = list(models.CustomizedProduct.objects.order_by('-pk').values_list('pk', flat=True)[:1000])
+        pages = [
+            lambda: reverse('admin:api_customizedproduct_changelist'),
+            lambda: reverse('admin:api_product_changelist'),
+        ]
+        if product_ids:
+            pages.append(lambda: reverse('admin:api_product_change', args=[rng.choice(product_ids)]))
+        if order_ids:
+            pages.append(lambda: reverse('admin:api_customizedproduct_change', args=[rng.choice(order_ids)]))
+        return lambda: ('GET', rng.choice(pages)(), b'', headers)
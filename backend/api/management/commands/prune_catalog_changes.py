@@ -0,0 +1,20 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ... import catalog
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes old rows of the catalog change log behind menu delta sync, devices that last "
+        "synced before the oldest remaining row reload the full menu"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help="keep the changes of this many days")
+
+    def handle(self, *args, **options):
+        deleted = catalog.prune_changes(timezone.now() - datetime.timedelta(days=options['days']))
+        self.stdout.write("Deleted {} catalog changes".format(deleted))
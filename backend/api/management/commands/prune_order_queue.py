@@ -0,0 +1,20 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ... import order_queue
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes the written batches of the order queue, a client retrying one of their "
+        "Idempotency-Keys afterwards queues it again"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24, help="keep the batches written in this many hours")
+
+    def handle(self, *args, **options):
+        deleted = order_queue.prune(timezone.now() - datetime.timedelta(hours=options['hours']))
+        self.stdout.write("Deleted {} queued batches".format(deleted))
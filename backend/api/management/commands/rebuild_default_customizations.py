@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ... import defaults
+
+
+class Command(BaseCommand):
+    help = "Recomputes the default customization of every product and size (see api/defaults.py)"
+
+    def handle(self, *args, **options):
+        written = defaults.refresh()
+        self.stdout.write("{} default customizations".format(written))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ... import rollups
+
+
+class Command(BaseCommand):
+    help = "Recomputes the hourly sales rollups (see api/rollups.py) from the order tables"
+
+    def handle(self, *args, **options):
+        product_rows, option_rows = rollups.rebuild()
+        self.stdout.write("{} product and {} option rollup rows".format(product_rows, option_rows))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from ... import artifacts
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes the menu of the current catalog version as a hashed, precompressed static file "
+        "(see api/artifacts.py), e.g. after collectstatic --clear or a deploy"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prune', type=int, help="then delete all but this many of the most recent artifacts")
+
+    def handle(self, *args, **options):
+        self.stdout.write(artifacts.write_menu_artifact())
+        if options['prune'] is not None:
+            for name in artifacts.prune_menu_artifacts(options['prune']):
+                self.stdout.write("Deleted {}".format(name))
@@ -0,0 +1,215 @@
+"""
+Per-request performance instrumentation
+
+ServerTimingMiddleware counts and times the SQL queries of every request (on
+all database connections, see record_query), and collects the time spent
+serializing (the timer('serialize') blocks, see serializers.TimedDataMixin)
+and rendering (DRF responses and the timer('render') blocks) with the SQL time
+taken out.
+Every response gets a Server-Timing header with these, and they are added to
+per-endpoint histograms that /api/metrics exposes in the Prometheus text
+format. The histograms are per process, scrape every worker.
+
+Requests answered by the native ASGI handlers (see asgi.py) don't go through
+the middleware and aren't measured.
+"""
+import bisect
+import contextlib
+import threading
+import time
+from contextvars import ContextVar
+
+# in seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# not measured, so scrapes don't skew the numbers
+UNMEASURED_URL_NAMES = ('metrics',)
+
+_timings = ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """
+    SQL query count and the db, serialize and render durations (seconds) of a request
+    """
+    def __init__(self):
+        self.queries = 0
+        self.durations = {'db': 0.0, 'serialize': 0.0, 'render': 0.0}
+        self.running = set()
+
+    def start(self):
+        return time.perf_counter(), self.durations['db']
+
+    def stop(self, name, started):
+        start, db = started
+        self.durations[name] += time.perf_counter() - start - (self.durations['db'] - db)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper adding every query to the current request's timings
+    """
+    timings = _timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.queries += 1
+        timings.durations['db'] += time.perf_counter() - start
+
+
+def connection_created(sender, connection, **kwargs):
+    """
+    Installs record_query() on every database connection for good
+
+    Cheaper than entering connection.execute_wrapper() on each connection for every request.
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextlib.contextmanager
+def timer(name):
+    """
+    Adds the time spent in the block, without its SQL queries, to the current request's name duration
+
+    Nested blocks of the same name count once, outside of a request this does nothing.
+    """
+    timings = _timings.get()
+    if timings is None or name in timings.running:
+        yield
+        return
+    timings.running.add(name)
+    started = timings.start()
+    try:
+        yield
+    finally:
+        timings.stop(name, started)
+        timings.running.discard(name)
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        # {labels: [count per bucket..., count, sum]}
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self, label_names):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} histogram'.format(self.name),
+        ]
+        for labels, series in sorted(self.series.items()):
+            label_pairs = ['{}="{}"'.format(name, escape_label(value)) for name, value in zip(label_names, labels)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    self.name, ','.join(label_pairs + ['le="{}"'.format(bound)]), cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, ','.join(label_pairs), repr(series[-1])))
+            lines.append('{}_count{{{}}} {}'.format(self.name, ','.join(label_pairs), cumulative))
+        return lines
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Registry:
+    """
+    The request histograms of this process, labelled by endpoint (URL name) and method
+    """
+    label_names = ('endpoint', 'method')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.duration = Histogram(
+            'http_request_duration_seconds', 'Time to respond, in seconds.', DURATION_BUCKETS)
+        self.queries = Histogram(
+            'http_request_db_queries', 'SQL queries per request.', QUERY_BUCKETS)
+        self.phases = {
+            name: Histogram(
+                'http_request_{}_seconds'.format(name), documentation, DURATION_BUCKETS)
+            for name, documentation in (
+                ('db', 'Time spent in SQL queries, in seconds.'),
+                ('serialize', 'Time spent serializing, without SQL queries, in seconds.'),
+                ('render', 'Time spent rendering the response, in seconds.'),
+            )
+        }
+
+    def observe(self, endpoint, method, duration, timings):
+        labels = (endpoint, method)
+        with self.lock:
+            self.duration.observe(labels, duration)
+            self.queries.observe(labels, timings.queries)
+            for name, histogram in self.phases.items():
+                histogram.observe(labels, timings.durations[name])
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for histogram in (self.duration, self.queries, *self.phases.values()):
+                lines.extend(histogram.render(self.label_names))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def server_timing(timings, duration):
+    """
+    Returns the Server-Timing header value of a request, durations in milliseconds
+    """
+    return ', '.join([
+        'db;dur={:.2f};desc="{} queries"'.format(timings.durations['db'] * 1000, timings.queries),
+        'serialize;dur={:.2f}'.format(timings.durations['serialize'] * 1000),
+        'render;dur={:.2f}'.format(timings.durations['render'] * 1000),
+        'total;dur={:.2f}'.format(duration * 1000),
+    ])
+
+
+class ServerTimingMiddleware:
+    """
+    Measures every request, see the module docstring
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _timings.reset(token)
+        duration = time.perf_counter() - start
+
+        response['Server-Timing'] = server_timing(timings, duration)
+        match = request.resolver_match
+        url_name = match.url_name if match is not None else None
+        if url_name not in UNMEASURED_URL_NAMES:
+            registry.observe(url_name or 'unresolved', request.method, duration, timings)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this, the callback runs once they are
+        timings = _timings.get()
+        if timings is not None:
+            started = timings.start()
+            response.add_post_render_callback(lambda response: timings.stop('render', started))
+        return response
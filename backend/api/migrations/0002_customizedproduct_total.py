@@ -0,0 +1,53 @@
+# Generated by Django 3.0.5 on 2026-10-18 14:12
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+def backfill_totals(apps, schema_editor):
+    CustomizedProduct = apps.get_model('api', 'CustomizedProduct')
+    priced_options = (
+        (apps.get_model('api', 'CustomizedProductFlavor'), 'product_flavor'),
+        (apps.get_model('api', 'CustomizedProductTopping'), 'product_topping'),
+        (apps.get_model('api', 'CustomizedProductJuice'), 'product_juice'),
+        (apps.get_model('api', 'CustomizedProductTea'), 'product_tea'),
+    )
+    price_field = models.DecimalField(max_digits=10, decimal_places=2)
+
+    ids = list(CustomizedProduct.objects.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(ids), 500):
+        batch = ids[start:start + 500]
+        totals = dict(
+            CustomizedProduct.objects.filter(pk__in=batch).annotate(
+                base_price=F('product__price') + F('size__price') + F('milk__price'),
+            ).values_list('pk', 'base_price')
+        )
+        for through, row_field_name in priced_options:
+            option_totals = through.objects.filter(customized_product_id__in=batch).order_by().values(
+                'customized_product_id',
+            ).annotate(
+                amount=Sum(F('quantity') * F(row_field_name + '__price'), output_field=price_field),
+            ).values_list('customized_product_id', 'amount')
+            for customized_product_id, amount in option_totals:
+                totals[customized_product_id] += amount
+        CustomizedProduct.objects.bulk_update(
+            [CustomizedProduct(pk=pk, total=Decimal(total).quantize(Decimal('0.01'))) for pk, total in totals.items()],
+            ['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customizedproduct',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, help_text='price at the time of the order, maintained by pricing.update_totals', max_digits=8),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.0.5 on 2026-10-18 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_customizedproduct_total'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customizedproduct',
+            index=models.Index(fields=['created_at', 'id'], name='cp_created_at_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customizedproduct',
+            index=models.Index(fields=['product', 'created_at', 'id'], name='cp_product_created_at_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customizedproductespressoshot',
+            index=models.Index(fields=['customized_product', 'product_espresso_shot', 'quantity'], name='cp_espresso_shot_cp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customizedproductflavor',
+            index=models.Index(fields=['customized_product', 'product_flavor', 'quantity'], name='cp_flavor_cp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customizedproductjuice',
+            index=models.Index(fields=['customized_product', 'product_juice', 'quantity'], name='cp_juice_cp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customizedproductsweetener',
+            index=models.Index(fields=['customized_product', 'product_sweetener', 'quantity'], name='cp_sweetener_cp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customizedproducttea',
+            index=models.Index(fields=['customized_product', 'product_tea', 'quantity'], name='cp_tea_cp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customizedproducttopping',
+            index=models.Index(fields=['customized_product', 'product_topping', 'quantity'], name='cp_topping_cp_idx'),
+        ),
+    ]
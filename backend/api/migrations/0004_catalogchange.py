@@ -0,0 +1,23 @@
+# Generated by Django 3.0.5 on 2026-10-18 14:39
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_order_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(blank=True, help_text='model_name of the changed row', max_length=100)),
+                ('object_id', models.PositiveIntegerField(blank=True, help_text='empty when the whole catalog may have changed (bulk writes), clients reload the full menu', null=True)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
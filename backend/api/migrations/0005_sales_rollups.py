@@ -0,0 +1,47 @@
+# Generated by Django 3.0.5 on 2026-10-18 14:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    # the tables start empty, existing orders are added with `manage.py rebuild_rollups`
+
+    dependencies = [
+        ('api', '0004_catalogchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSalesRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total', models.DecimalField(decimal_places=2, default=0, help_text='sum of the totals', max_digits=12)),
+                ('espresso_shots', models.PositiveIntegerField(default=0, help_text='sum of the espresso shot quantities')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='api.Product')),
+                ('size', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='api.ProductSize')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OptionSalesRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('option_type', models.CharField(max_length=20)),
+                ('option_id', models.PositiveIntegerField()),
+                ('count', models.PositiveIntegerField(default=0, help_text='customized products with the option')),
+                ('quantity', models.PositiveIntegerField(default=0, help_text="sum of the option's quantities")),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='api.Product')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='productsalesrollup',
+            constraint=models.UniqueConstraint(fields=('hour', 'product', 'size'), name='product_sales_rollup_key'),
+        ),
+        migrations.AddConstraint(
+            model_name='optionsalesrollup',
+            constraint=models.UniqueConstraint(fields=('hour', 'option_type', 'option_id', 'product'), name='option_sales_rollup_key'),
+        ),
+    ]
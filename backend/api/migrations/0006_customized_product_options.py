@@ -0,0 +1,152 @@
+# Generated by Django 3.0.5 on 2026-10-18 14:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# (option type, per-type model, its FK to the Product* row)
+OPTION_TYPES = (
+    ('sweeteners', 'CustomizedProductSweetener', 'product_sweetener'),
+    ('espresso_shots', 'CustomizedProductEspressoShot', 'product_espresso_shot'),
+    ('toppings', 'CustomizedProductTopping', 'product_topping'),
+    ('flavors', 'CustomizedProductFlavor', 'product_flavor'),
+    ('juices', 'CustomizedProductJuice', 'product_juice'),
+    ('teas', 'CustomizedProductTea', 'product_tea'),
+)
+
+
+def copy_to_options(apps, schema_editor):
+    quote_name = schema_editor.quote_name
+    options_table = apps.get_model('api', 'CustomizedProductOption')._meta.db_table
+    for option_type, model_name, row_field_name in OPTION_TYPES:
+        columns = ', '.join(map(quote_name, ('customized_product_id', 'quantity', row_field_name + '_id')))
+        schema_editor.execute(
+            'INSERT INTO {} ({}, option_type) SELECT {}, %s FROM {} ORDER BY id'.format(
+                quote_name(options_table), columns, columns,
+                quote_name(apps.get_model('api', model_name)._meta.db_table)),
+            [option_type])
+
+
+def copy_from_options(apps, schema_editor):
+    quote_name = schema_editor.quote_name
+    options_table = apps.get_model('api', 'CustomizedProductOption')._meta.db_table
+    for option_type, model_name, row_field_name in OPTION_TYPES:
+        columns = ', '.join(map(quote_name, ('customized_product_id', 'quantity', row_field_name + '_id')))
+        schema_editor.execute(
+            'INSERT INTO {} ({}) SELECT {} FROM {} WHERE option_type = %s ORDER BY id'.format(
+                quote_name(apps.get_model('api', model_name)._meta.db_table), columns, columns,
+                quote_name(options_table)),
+            [option_type])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomizedProductOption',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('option_type', models.CharField(help_text='CustomizedProduct field: sweeteners, flavors, ...', max_length=20)),
+                ('quantity', models.IntegerField()),
+                ('customized_product', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='options', to='api.CustomizedProduct')),
+                ('product_espresso_shot', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='api.ProductEspressoShot')),
+                ('product_flavor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='api.ProductFlavor')),
+                ('product_juice', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='api.ProductJuice')),
+                ('product_sweetener', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='api.ProductSweetener')),
+                ('product_tea', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='api.ProductTea')),
+                ('product_topping', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='api.ProductTopping')),
+            ],
+        ),
+        migrations.RunPython(copy_to_options, copy_from_options),
+        migrations.DeleteModel(
+            name='CustomizedProductEspressoShot',
+        ),
+        migrations.DeleteModel(
+            name='CustomizedProductFlavor',
+        ),
+        migrations.DeleteModel(
+            name='CustomizedProductJuice',
+        ),
+        migrations.DeleteModel(
+            name='CustomizedProductSweetener',
+        ),
+        migrations.DeleteModel(
+            name='CustomizedProductTea',
+        ),
+        migrations.DeleteModel(
+            name='CustomizedProductTopping',
+        ),
+        migrations.AddIndex(
+            model_name='customizedproductoption',
+            index=models.Index(fields=['customized_product', 'option_type'], name='cp_option_cp_idx'),
+        ),
+        migrations.CreateModel(
+            name='CustomizedProductEspressoShot',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('api.customizedproductoption',),
+        ),
+        migrations.CreateModel(
+            name='CustomizedProductFlavor',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('api.customizedproductoption',),
+        ),
+        migrations.CreateModel(
+            name='CustomizedProductJuice',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('api.customizedproductoption',),
+        ),
+        migrations.CreateModel(
+            name='CustomizedProductSweetener',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('api.customizedproductoption',),
+        ),
+        migrations.CreateModel(
+            name='CustomizedProductTea',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('api.customizedproductoption',),
+        ),
+        migrations.CreateModel(
+            name='CustomizedProductTopping',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('api.customizedproductoption',),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.0.5 on 2026-10-18 15:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# (option type, Product* table, its FK to the option, whether it has a price)
+ROW_TABLES = (
+    ('size', 'api_productsize', 'size_id', True),
+    ('milk', 'api_productmilk', 'milk_id', True),
+    ('sweeteners', 'api_productsweetener', 'sweetener_id', False),
+    ('espresso_shots', 'api_productespressoshot', 'espresso_shot_id', False),
+    ('toppings', 'api_producttopping', 'topping_id', True),
+    ('flavors', 'api_productflavor', 'flavor_id', True),
+    ('juices', 'api_productjuice', 'juice_id', True),
+    ('teas', 'api_producttea', 'tea_id', True),
+)
+
+CREATE_VIEW = 'CREATE VIEW api_productoption AS ' + ' UNION ALL '.join(
+    "SELECT '{option_type}:' || CAST(id AS VARCHAR(20)) AS id, '{option_type}' AS option_type, id AS row_id, "
+    "product_id, {option_column} AS option_id, {price} AS price, is_active FROM {table}".format(
+        option_type=option_type,
+        option_column=option_column,
+        price='price' if priced else 'CAST(0 AS DECIMAL(4, 2))',
+        table=table)
+    for option_type, table, option_column, priced in ROW_TABLES
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_customized_product_options'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_VIEW, 'DROP VIEW api_productoption'),
+        migrations.CreateModel(
+            name='ProductOption',
+            fields=[
+                ('id', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('option_type', models.CharField(max_length=20)),
+                ('row_id', models.IntegerField()),
+                ('product', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.Product')),
+                ('option_id', models.IntegerField(help_text='id of the Size, Milk, Sweetener, ... row')),
+                ('price', models.DecimalField(decimal_places=2, help_text='0 for the unpriced types', max_digits=4)),
+                ('is_active', models.BooleanField()),
+            ],
+            options={
+                'db_table': 'api_productoption',
+                'managed': False,
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 3.0.5 on 2026-10-18 15:07
+
+from django.db import migrations, models
+
+# (option type, Product* table, its FK to the option, the option table, whether it has a price)
+ROW_TABLES = (
+    ('size', 'api_productsize', 'size_id', 'api_size', True),
+    ('milk', 'api_productmilk', 'milk_id', 'api_milk', True),
+    ('sweeteners', 'api_productsweetener', 'sweetener_id', 'api_sweetener', False),
+    ('espresso_shots', 'api_productespressoshot', 'espresso_shot_id', 'api_espressoshot', False),
+    ('toppings', 'api_producttopping', 'topping_id', 'api_topping', True),
+    ('flavors', 'api_productflavor', 'flavor_id', 'api_flavor', True),
+    ('juices', 'api_productjuice', 'juice_id', 'api_juice', True),
+    ('teas', 'api_producttea', 'tea_id', 'api_tea', True),
+)
+
+
+def create_view(with_names):
+    return 'CREATE VIEW api_productoption AS ' + ' UNION ALL '.join(
+        "SELECT '{option_type}:' || CAST(r.id AS VARCHAR(20)) AS id, '{option_type}' AS option_type, "
+        "r.id AS row_id, r.product_id, r.{option_column} AS option_id, {name}"
+        "{price} AS price, r.is_active FROM {table} r{join}".format(
+            option_type=option_type,
+            option_column=option_column,
+            name='o.name AS name, ' if with_names else '',
+            price='r.price' if priced else 'CAST(0 AS DECIMAL(4, 2))',
+            table=table,
+            join=' INNER JOIN {} o ON o.id = r.{}'.format(option_table, option_column)
+            if with_names else '')
+        for option_type, table, option_column, option_table, priced in ROW_TABLES
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_product_option_view'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customizedproduct',
+            name='snapshot',
+            field=models.TextField(blank=True, editable=False, help_text='JSON of the options with their names and unit prices at the time of the order, see snapshots.py'),
+        ),
+        migrations.RunSQL(
+            ['DROP VIEW api_productoption', create_view(with_names=True)],
+            ['DROP VIEW api_productoption', create_view(with_names=False)],
+        ),
+        migrations.AddField(
+            model_name='productoption',
+            name='name',
+            field=models.CharField(help_text='name of the Size, Milk, Sweetener, ...', max_length=200),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.0.5 on 2026-10-18 15:13
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_customized_product_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedOrder',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text="the client's Idempotency-Key", max_length=100, unique=True)),
+                ('items', models.TextField(help_text='JSON list of validated CustomizedProductSerializer payloads')),
+                ('item_count', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, help_text='order time of the customized products')),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('result', models.TextField(blank=True, help_text='JSON list of the ids of the written customized products')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='queuedorder',
+            index=models.Index(fields=['processed_at', 'id'], name='queued_order_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.0.5 on 2026-10-18 15:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_queued_order'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DefaultCustomization',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_default', models.BooleanField(help_text="the product's default size")),
+                ('total', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('snapshot', models.TextField()),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='default_customizations', to='api.Product')),
+                ('size', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.ProductSize')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='defaultcustomization',
+            constraint=models.UniqueConstraint(fields=('product', 'size'), name='default_customization_key'),
+        ),
+    ]
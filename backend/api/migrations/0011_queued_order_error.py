@@ -0,0 +1,18 @@
+# Generated by Django 3.0.5 on 2026-10-18 15:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_default_customization'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedorder',
+            name='error',
+            field=models.TextField(blank=True, help_text="JSON of why the batch couldn't be written (e.g. an option deleted since), if it failed"),
+        ),
+    ]
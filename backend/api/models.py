@@ -1,3 +1,5 @@
+import json
+
 from django.db import models
 from django.utils import timezone
 
@@ -27,17 +29,6 @@ class ProductEspressoShot(models.Model):
         return str(self.espresso_shot)
 
 
-class CustomizedProductEspressoShot(models.Model):
-    """
-    Intermediate model for OrderItem <-> ProductEspressoShot, stores quantity
-
-    Allows an OrderItem to have multiple types of EspressoShots with their own quantity
-    """
-    product_espresso_shot = models.ForeignKey(ProductEspressoShot, on_delete=models.PROTECT)
-    customized_product = models.ForeignKey('CustomizedProduct', on_delete=models.PROTECT)
-    quantity = models.IntegerField()
-
-
 class Sweetener(models.Model):
     """
     Allows adding new types of sweeteners through the database
@@ -62,17 +53,6 @@ class ProductSweetener(models.Model):
         return str(self.sweetener)
 
 
-class CustomizedProductSweetener(models.Model):
-    """
-    Intermediate model for OrderItem <-> ProductSweetener, stores quantity
-
-    Allows an OrderItem to have multiple types of Sweeteners with their own quantity
-    """
-    product_sweetener = models.ForeignKey(ProductSweetener, on_delete=models.PROTECT)
-    customized_product = models.ForeignKey('CustomizedProduct', on_delete=models.PROTECT)
-    quantity = models.IntegerField()
-
-
 class Size(models.Model):
     """
     Allows adding new sizes through the database
@@ -183,17 +163,6 @@ class ProductJuice(models.Model):
         return str(self.juice)
 
 
-class CustomizedProductJuice(models.Model):
-    """
-    Intermediate model for OrderItem <-> ProductJuice, stores quantity
-
-    Allows an OrderItem to have multiple types of Juice with their own quantity
-    """
-    product_juice = models.ForeignKey(ProductJuice, on_delete=models.PROTECT)
-    customized_product = models.ForeignKey('CustomizedProduct', on_delete=models.PROTECT)
-    quantity = models.IntegerField()
-
-
 class FlavorCategory(models.Model):
     """
     Used for labels on sections of flavors
@@ -234,17 +203,6 @@ class ProductFlavor(models.Model):
         return str(self.flavor)
 
 
-class CustomizedProductFlavor(models.Model):
-    """
-    Intermediate model for OrderItem <-> ProductFlavor, stores quantity
-
-    Allows an OrderItem to have multiple types of Flavor with their own quantity
-    """
-    product_flavor = models.ForeignKey(ProductFlavor, on_delete=models.PROTECT)
-    customized_product = models.ForeignKey('CustomizedProduct', on_delete=models.PROTECT)
-    quantity = models.IntegerField()
-
-
 class ToppingCategory(models.Model):
     """
     Used for labels on sections of toppings
@@ -302,17 +260,6 @@ class ProductTopping(models.Model):
         return str(self.topping)
 
 
-class CustomizedProductTopping(models.Model):
-    """
-    Intermediate model for OrderItem <-> ProductTopping, stores quantity
-
-    Allows an OrderItem to have multiple types of Topping with their own quantity
-    """
-    product_topping = models.ForeignKey(ProductTopping, on_delete=models.PROTECT)
-    customized_product = models.ForeignKey('CustomizedProduct', on_delete=models.PROTECT)
-    quantity = models.IntegerField()
-
-
 class Tea(models.Model):
     """
     Allows adding new types of teas through the database
@@ -338,17 +285,6 @@ class ProductTea(models.Model):
         return str(self.tea)
 
 
-class CustomizedProductTea(models.Model):
-    """
-    Intermediate model for OrderItem <-> ProductTea, stores quantity
-
-    Allows an OrderItem to have multiple types of Tea with their own quantity
-    """
-    product_tea = models.ForeignKey(ProductTea, on_delete=models.PROTECT)
-    customized_product = models.ForeignKey('CustomizedProduct', on_delete=models.PROTECT)
-    quantity = models.IntegerField()
-
-
 class IceChoice(models.Model):
     """
     Stores choices for Product ice levels
@@ -373,11 +309,149 @@ class RoomChoice(models.Model):
         return self.name
 
 
+DEFAULT_FK_FIELDS = (
+    'default_ice',
+    'default_room',
+    'default_milk',
+    'default_milk_temp',
+    'default_milk_foam',
+    'default_size',
+)
+# Product.default_* relations that point at Product* through rows, the serialized
+# through rows nest their product again (see ProductQuerySet._link_default_products)
+DEFAULT_ROW_FIELDS = ('default_milk', 'default_size')
+DEFAULT_ROWS_FIELDS = (
+    'default_sweeteners',
+    'default_flavors',
+    'default_espresso_shots',
+    'default_juices',
+    'default_toppings',
+    'default_teas',
+)
+
+
+class ProductQuerySet(models.QuerySet):
+    def for_menu(self, fields=None):
+        """
+        Loads everything ProductSerializer renders with a fixed number of queries
+
+        One query for the products (with the FK defaults joined in) plus one per
+        prefetched relation, no matter how many products are in the catalog.
+        Only the relations in fields are loaded when fields is given.
+        """
+        select_related = {
+            'default_ice': 'default_ice',
+            'default_room': 'default_room',
+            'default_milk': 'default_milk__milk',
+            'default_milk_temp': 'default_milk_temp',
+            'default_milk_foam': 'default_milk_foam',
+            'default_size': 'default_size__size',
+        }
+        prefetch_related = {
+            'allowed_ice': 'allowed_ice',
+            'allowed_room': 'allowed_room',
+            'allowed_milks': 'allowed_milks',
+            'allowed_milk_temps': 'allowed_milk_temps',
+            'allowed_milk_foams': 'allowed_milk_foams',
+            'allowed_sizes': 'allowed_sizes',
+            'allowed_sweeteners': 'allowed_sweeteners',
+            'allowed_espresso_shots': 'allowed_espresso_shots',
+            'allowed_juices': 'allowed_juices',
+            'allowed_teas': 'allowed_teas',
+            'allowed_flavors': models.Prefetch(
+                'allowed_flavors',
+                queryset=Flavor.objects.select_related('category')),
+            'allowed_toppings': models.Prefetch(
+                'allowed_toppings',
+                queryset=Topping.objects.select_related(
+                    'category', 'default_choice').prefetch_related('allowed_choices')),
+            'default_sweeteners': models.Prefetch(
+                'default_sweeteners',
+                queryset=ProductSweetener.objects.select_related('sweetener')),
+            'default_flavors': models.Prefetch(
+                'default_flavors',
+                queryset=ProductFlavor.objects.select_related('flavor__category')),
+            'default_espresso_shots': models.Prefetch(
+                'default_espresso_shots',
+                queryset=ProductEspressoShot.objects.select_related('espresso_shot')),
+            'default_juices': models.Prefetch(
+                'default_juices',
+                queryset=ProductJuice.objects.select_related('juice')),
+            'default_toppings': models.Prefetch(
+                'default_toppings',
+                queryset=ProductTopping.objects.select_related(
+                    'topping__category',
+                    'topping__default_choice',
+                ).prefetch_related('topping__allowed_choices')),
+            'default_teas': models.Prefetch(
+                'default_teas',
+                queryset=ProductTea.objects.select_related('tea')),
+        }
+        if fields is not None:
+            select_related = {name: path for name, path in select_related.items() if name in fields}
+            prefetch_related = {name: lookup for name, lookup in prefetch_related.items() if name in fields}
+        queryset = self.prefetch_related(*prefetch_related.values())
+        if select_related:
+            # an empty select_related() would follow every FK
+            queryset = queryset.select_related(*select_related.values())
+        return queryset
+
+    def _prefetch_related_objects(self):
+        super()._prefetch_related_objects()
+        if self._iterable_class is models.query.ModelIterable:
+            self._link_default_products()
+
+    def _link_default_products(self):
+        """
+        Points each loaded default through row back at its already loaded product
+
+        The serialized through rows (ProductMilk, ProductFlavor, ...) nest their
+        product, so without this every default row would lazily load its product
+        and all of that product's relations again.
+        """
+        products = {product.pk: product for product in self._result_cache}
+        unlinked = []
+        for product in products.values():
+            rows = [
+                getattr(product, field_name)
+                for field_name in DEFAULT_ROW_FIELDS
+                if Product._meta.get_field(field_name).is_cached(product)
+            ]
+            for field_name in DEFAULT_ROWS_FIELDS:
+                rows.extend(getattr(product, '_prefetched_objects_cache', {}).get(field_name, ()))
+            for row in rows:
+                if row is None:
+                    continue
+                owner = products.get(row.product_id)
+                if owner is not None:
+                    row.product = owner
+                else:
+                    unlinked.append(row)
+
+        if unlinked:
+            # defaults borrowed from another product's through rows, only their
+            # flat (depth=0) relations are rendered so load those in one batch
+            others = {
+                product.pk: product
+                for product in Product._base_manager.filter(
+                    pk__in={row.product_id for row in unlinked}
+                ).select_related(*DEFAULT_FK_FIELDS)
+            }
+            models.prefetch_related_objects(
+                list(others.values()),
+                *(field.name for field in Product._meta.many_to_many),
+                'allowed_toppings__allowed_choices')
+            for row in unlinked:
+                row.product = others[row.product_id]
+
+
 class Product(models.Model):
     """
     Stores the allowed and default ingredients for a menu product, like a recipe
     but with the allowed modifications too.
     """
+    objects = ProductQuerySet.as_manager()
+
     name = models.CharField(max_length=200)
     price = models.DecimalField(
         max_digits=4,
@@ -453,10 +527,182 @@ class Product(models.Model):
         return self.name
 
 
+class ProductOption(models.Model):
+    """
+    Read-only view over every Product* through row (sizes, milks, sweeteners, ...) of every product
+
+    option_type is the CustomizedProduct field the row is chosen for, row_id
+    the id of the Product* row. The through tables keep their own ids (menus,
+    orders and the catalog change log refer to them), the view lets the whole
+    catalog be read in one query. Created by migration 0007, with the option
+    names since 0008.
+    """
+    class Meta:
+        managed = False
+        db_table = 'api_productoption'
+
+    # option type:row id
+    id = models.CharField(max_length=40, primary_key=True)
+    option_type = models.CharField(max_length=20)
+    row_id = models.IntegerField()
+    product = models.ForeignKey(
+        Product, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    option_id = models.IntegerField(help_text="id of the Size, Milk, Sweetener, ... row")
+    name = models.CharField(max_length=200, help_text="name of the Size, Milk, Sweetener, ...")
+    price = models.DecimalField(max_digits=4, decimal_places=2, help_text="0 for the unpriced types")
+    is_active = models.BooleanField()
+
+    def __str__(self):
+        return self.id
+
+
+class CatalogChange(models.Model):
+    """
+    Change log of the catalog, one row per saved or deleted Product, through row
+    or option (see signals.py), read by menu delta sync (catalog.build_menu_changes)
+
+    The id of the latest row is the catalog version clients sync from.
+    """
+    model = models.CharField(max_length=100, blank=True, help_text="model_name of the changed row")
+    object_id = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="empty when the whole catalog may have changed (bulk writes), clients reload the full menu")
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return '{} {}'.format(self.model, self.object_id)
+
+
+class CustomizedProductOption(models.Model):
+    """
+    The options with a quantity (sweeteners, espresso shots, ...) of customized products, all in one table
+
+    option_type is the CustomizedProduct field the row belongs to and tells
+    which of the product_* FKs is set, so writing or loading every option of
+    a batch is a single statement whatever the number of option types. The
+    CustomizedProduct* proxies below keep the per-type models (and the
+    CustomizedProduct M2Ms going through them) working.
+    """
+    class Meta:
+        indexes = [
+            # reading an order's rows
+            models.Index(fields=['customized_product', 'option_type'], name='cp_option_cp_idx'),
+        ]
+
+    # set by the per-type proxies
+    OPTION_TYPE = ''
+
+    customized_product = models.ForeignKey('CustomizedProduct', on_delete=models.PROTECT, related_name='options')
+    option_type = models.CharField(max_length=20, help_text="CustomizedProduct field: sweeteners, flavors, ...")
+    quantity = models.IntegerField()
+    product_sweetener = models.ForeignKey(ProductSweetener, on_delete=models.PROTECT, null=True, blank=True)
+    product_espresso_shot = models.ForeignKey(ProductEspressoShot, on_delete=models.PROTECT, null=True, blank=True)
+    product_topping = models.ForeignKey(ProductTopping, on_delete=models.PROTECT, null=True, blank=True)
+    product_flavor = models.ForeignKey(ProductFlavor, on_delete=models.PROTECT, null=True, blank=True)
+    product_juice = models.ForeignKey(ProductJuice, on_delete=models.PROTECT, null=True, blank=True)
+    product_tea = models.ForeignKey(ProductTea, on_delete=models.PROTECT, null=True, blank=True)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.option_type:
+            self.option_type = self.OPTION_TYPE
+
+
+class OptionTypeManager(models.Manager):
+    """
+    Manager of a CustomizedProductOption proxy, only sees the proxy's option type
+    """
+    def get_queryset(self):
+        return super().get_queryset().filter(option_type=self.model.OPTION_TYPE)
+
+
+class CustomizedProductSweetener(CustomizedProductOption):
+    """
+    A customized product's sweetener with its quantity
+    """
+    class Meta:
+        proxy = True
+
+    OPTION_TYPE = 'sweeteners'
+    objects = OptionTypeManager()
+
+
+class CustomizedProductEspressoShot(CustomizedProductOption):
+    """
+    A customized product's espresso shot with its quantity
+    """
+    class Meta:
+        proxy = True
+
+    OPTION_TYPE = 'espresso_shots'
+    objects = OptionTypeManager()
+
+
+class CustomizedProductTopping(CustomizedProductOption):
+    """
+    A customized product's topping with its quantity
+    """
+    class Meta:
+        proxy = True
+
+    OPTION_TYPE = 'toppings'
+    objects = OptionTypeManager()
+
+
+class CustomizedProductFlavor(CustomizedProductOption):
+    """
+    A customized product's flavor with its quantity (pumps)
+    """
+    class Meta:
+        proxy = True
+
+    OPTION_TYPE = 'flavors'
+    objects = OptionTypeManager()
+
+
+class CustomizedProductJuice(CustomizedProductOption):
+    """
+    A customized product's juice with its quantity
+    """
+    class Meta:
+        proxy = True
+
+    OPTION_TYPE = 'juices'
+    objects = OptionTypeManager()
+
+
+class CustomizedProductTea(CustomizedProductOption):
+    """
+    A customized product's tea with its quantity
+    """
+    class Meta:
+        proxy = True
+
+    OPTION_TYPE = 'teas'
+    objects = OptionTypeManager()
+
+
 class CustomizedProduct(models.Model):
+    class Meta:
+        indexes = [
+            # order history, newest first with (created_at, id) keyset pagination
+            models.Index(fields=['created_at', 'id'], name='cp_created_at_id_idx'),
+            models.Index(fields=['product', 'created_at', 'id'], name='cp_product_created_at_id_idx'),
+        ]
+
     product = models.ForeignKey(Product, on_delete=models.PROTECT)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(default=timezone.now)
+    total = models.DecimalField(
+        default=0,
+        max_digits=8,
+        decimal_places=2,
+        help_text="price at the time of the order, maintained by pricing.update_totals")
+    snapshot = models.TextField(
+        blank=True,
+        editable=False,
+        help_text="JSON of the options with their names and unit prices at the time of the order, see snapshots.py")
 
     ice = models.ForeignKey(IceChoice, on_delete=models.PROTECT)
     room = models.ForeignKey(RoomChoice, on_delete=models.PROTECT)
@@ -471,3 +717,102 @@ class CustomizedProduct(models.Model):
     flavors = models.ManyToManyField(ProductFlavor, through=CustomizedProductFlavor)
     juices = models.ManyToManyField(ProductJuice, through=CustomizedProductJuice)
     teas = models.ManyToManyField(ProductTea, through=CustomizedProductTea)
+
+    def get_options(self, option_type):
+        """
+        Returns the options of one type (sweeteners, flavors, ...), from the prefetched options when loaded
+        """
+        return [option for option in self.options.all() if option.option_type == option_type]
+
+    def get_snapshot(self):
+        """
+        Returns the parsed snapshot, None for customized products written before snapshots
+        """
+        return json.loads(self.snapshot) if self.snapshot else None
+
+
+class DefaultCustomization(models.Model):
+    """
+    A product's default customization in one of its sizes, maintained by defaults.py
+
+    snapshot is in the format of CustomizedProduct.snapshot (see
+    snapshots.py), with the current names and prices.
+    """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'size'], name='default_customization_key'),
+        ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='default_customizations')
+    size = models.ForeignKey(ProductSize, on_delete=models.CASCADE, related_name='+')
+    is_default = models.BooleanField(help_text="the product's default size")
+    total = models.DecimalField(max_digits=8, decimal_places=2)
+    snapshot = models.TextField()
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def get_snapshot(self):
+        return json.loads(self.snapshot)
+
+
+class ProductSalesRollup(models.Model):
+    """
+    Customized products ordered per hour (UTC), product and size, maintained by rollups.py
+    """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['hour', 'product', 'size'], name='product_sales_rollup_key'),
+        ]
+
+    hour = models.DateTimeField()
+    product = models.ForeignKey(Product, on_delete=models.PROTECT)
+    size = models.ForeignKey(ProductSize, on_delete=models.PROTECT)
+    count = models.PositiveIntegerField(default=0)
+    total = models.DecimalField(default=0, max_digits=12, decimal_places=2, help_text="sum of the totals")
+    espresso_shots = models.PositiveIntegerField(default=0, help_text="sum of the espresso shot quantities")
+
+
+class OptionSalesRollup(models.Model):
+    """
+    Customized products ordered with an option per hour (UTC), option and product, maintained by rollups.py
+
+    Options are identified by type (the CustomizedProduct field: milk, flavors,
+    ...) and the id of the Milk, Flavor, ... row.
+    """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['hour', 'option_type', 'option_id', 'product'], name='option_sales_rollup_key'),
+        ]
+
+    hour = models.DateTimeField()
+    option_type = models.CharField(max_length=20)
+    option_id = models.PositiveIntegerField()
+    product = models.ForeignKey(Product, on_delete=models.PROTECT)
+    count = models.PositiveIntegerField(default=0, help_text="customized products with the option")
+    quantity = models.PositiveIntegerField(default=0, help_text="sum of the option's quantities")
+
+
+class QueuedOrder(models.Model):
+    """
+    A validated batch of customized products waiting to be written, see order_queue.py
+
+    Kept after it is written so retries with the same key get its result
+    instead of ordering again, until pruned.
+    """
+    class Meta:
+        indexes = [
+            # the pending entries, oldest first
+            models.Index(fields=['processed_at', 'id'], name='queued_order_pending_idx'),
+        ]
+
+    key = models.CharField(max_length=100, unique=True, help_text="the client's Idempotency-Key")
+    items = models.TextField(help_text="JSON list of validated CustomizedProductSerializer payloads")
+    item_count = models.PositiveIntegerField()
+    created_at = models.DateTimeField(default=timezone.now, help_text="order time of the customized products")
+    processed_at = models.DateTimeField(null=True, blank=True)
+    result = models.TextField(blank=True, help_text="JSON list of the ids of the written customized products")
+    error = models.TextField(
+        blank=True, help_text="JSON of why the batch couldn't be written (e.g. an option deleted since), if it failed")
+
+    def __str__(self):
+        return self.key
@@ -0,0 +1,104 @@
+"""
+In-memory index of the options each active product allows
+
+The index is built for the whole catalog at once (one query per option group,
+one for all the Product* through rows) and kept per process until the catalog
+version changes, so validating a customization is set membership instead of a
+query per field.
+"""
+from types import MappingProxyType
+
+from . import catalog, models, orders
+
+
+class OptionIndex:
+    """
+    Immutable snapshot of the allowed options of every active product
+
+    products maps a product id to {CustomizedProduct field name: frozenset of
+    allowed ids}, using the ids of the Product* rows for the through options.
+    topping_choices maps a ProductTopping id to the frozenset of its
+    topping's allowed ToppingChoice ids. row_options maps a through option's
+    CustomizedProduct field name to {Product* row id: option id}.
+    """
+    __slots__ = ('version', 'products', 'topping_choices', 'row_options')
+
+    def __init__(self, version, products, topping_choices, row_options=None):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'products', MappingProxyType({
+            product_id: MappingProxyType({
+                field_name: frozenset(ids) for field_name, ids in product_options.items()
+            })
+            for product_id, product_options in products.items()
+        }))
+        object.__setattr__(self, 'topping_choices', MappingProxyType({
+            product_topping_id: frozenset(choice_ids)
+            for product_topping_id, choice_ids in topping_choices.items()
+        }))
+        object.__setattr__(self, 'row_options', MappingProxyType({
+            field_name: MappingProxyType(options) for field_name, options in (row_options or {}).items()
+        }))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("OptionIndex is immutable")
+
+    def get(self, product_id):
+        return self.products.get(product_id)
+
+
+def build_index(version=None):
+    """
+    Builds the index from the through tables, a fixed number of queries
+    """
+    products = {
+        product_id: {}
+        for product_id in models.Product.objects.filter(is_active=True).values_list('pk', flat=True)
+    }
+    row_field_names = [field_name for field_name, _ in orders.PRODUCT_ROW_FIELDS]
+    row_field_names += [field_name for field_name, _, _, _ in orders.OPTION_FIELDS]
+    for product_options in products.values():
+        for field_name in [field_name for field_name, _ in orders.CHOICE_FIELDS] + row_field_names:
+            product_options[field_name] = set()
+
+    for field_name, m2m_name in orders.CHOICE_FIELDS:
+        m2m_field = models.Product._meta.get_field(m2m_name)
+        rows = m2m_field.remote_field.through.objects.filter(product_id__in=products).values_list(
+            'product_id', m2m_field.m2m_reverse_name())
+        for product_id, option_id in rows:
+            products[product_id][field_name].add(option_id)
+
+    row_options = {field_name: {} for field_name in row_field_names}
+    # every through row type in one query, the option type is the CustomizedProduct field name
+    rows = models.ProductOption.objects.filter(
+        product__is_active=True, is_active=True, option_type__in=row_options,
+    ).values_list('option_type', 'product_id', 'row_id', 'option_id')
+    for field_name, product_id, row_id, option_id in rows:
+        products[product_id][field_name].add(row_id)
+        row_options[field_name][row_id] = option_id
+
+    choices_by_topping = {}
+    for topping_id, choice_id in models.Topping.allowed_choices.through.objects.values_list(
+            'topping_id', 'toppingchoice_id'):
+        choices_by_topping.setdefault(topping_id, set()).add(choice_id)
+    topping_choices = {
+        product_topping_id: choices_by_topping.get(topping_id, ())
+        for product_topping_id, topping_id in models.ProductTopping.objects.filter(
+            product__is_active=True, is_active=True).values_list('pk', 'topping_id')
+    }
+
+    return OptionIndex(version, products, topping_choices, row_options)
+
+
+_index = None
+
+
+def get_index():
+    """
+    Returns the index for the current catalog version, rebuilding it after catalog changes
+    """
+    global _index
+    version = catalog.get_version()
+    index = _index
+    if index is None or index.version != version:
+        index = _index = build_index(version)
+    return index
@@ -0,0 +1,180 @@
+"""
+Write-behind ingestion of order batches (settings.ORDER_QUEUE)
+
+With the queue on, the batch endpoint validates a batch as usual, stores it
+in the QueuedOrder staging table under the client's Idempotency-Key (a
+single INSERT) and answers 202 at once. The drain_order_queue worker takes
+the oldest pending batches, writes all of their customized products with
+one orders.create_customized_products call and marks them processed in the
+same transaction, so each batch is written exactly once: a retried POST with
+the same key gets the same entry back, and a worker that dies mid-drain
+leaves its batches pending. Batches that aren't valid anymore when they are
+drained are marked failed with their errors. Batches are refused while
+settings.ORDER_QUEUE_MAX_DEPTH of them are pending.
+"""
+import datetime
+import json
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import Count, Min, Sum
+from django.utils import timezone
+
+from . import models, option_index, orders
+
+# seconds of processed batches the drain rate is averaged over
+DRAIN_RATE_WINDOW = 60
+# seconds clients are told to wait when the queue is full
+RETRY_AFTER = 5
+
+
+class QueueFull(Exception):
+    """
+    settings.ORDER_QUEUE_MAX_DEPTH batches are already pending
+    """
+
+
+class KeyReused(Exception):
+    """
+    The idempotency key was already used for a different batch
+    """
+
+
+def pending():
+    return models.QueuedOrder.objects.filter(processed_at__isnull=True)
+
+
+def enqueue(key, items):
+    """
+    Queues validated CustomizedProductSerializer payloads, returns (QueuedOrder, created)
+
+    A key that was already used returns its entry, processed or not, as long
+    as the items are the same (KeyReused otherwise). QueueFull is raised
+    instead of queueing more than settings.ORDER_QUEUE_MAX_DEPTH batches.
+    """
+    item_count = len(items)
+    items = json.dumps(items, sort_keys=True)
+    entry = models.QueuedOrder.objects.filter(key=key).first()
+    if entry is None:
+        if pending().count() >= settings.ORDER_QUEUE_MAX_DEPTH:
+            raise QueueFull()
+        try:
+            with transaction.atomic():
+                return models.QueuedOrder.objects.create(key=key, items=items, item_count=item_count), True
+        except IntegrityError:
+            # a concurrent retry queued it first
+            entry = models.QueuedOrder.objects.get(key=key)
+    if entry.items != items:
+        raise KeyReused()
+    return entry, False
+
+
+def drain(batch_size=None):
+    """
+    Writes the oldest pending batches, returns the number of (batches, customized products written, failed batches)
+
+    Up to batch_size batches (settings.ORDER_QUEUE_BATCH_SIZE) in one
+    transaction. Rows are locked with SKIP LOCKED where the database has it,
+    so several workers can drain together. Batches are validated again, the
+    catalog may have changed since they were queued, and the invalid ones
+    are marked failed with their errors instead of blocking the queue.
+    """
+    batch_size = batch_size or settings.ORDER_QUEUE_BATCH_SIZE
+    with transaction.atomic():
+        entries = pending().order_by('pk')
+        if connection.features.has_select_for_update_skip_locked:
+            entries = entries.select_for_update(skip_locked=True)
+        entries = list(entries[:batch_size])
+        if not entries:
+            return 0, 0, 0
+
+        index = option_index.get_index()
+        now = timezone.now()
+        valid = []
+        for entry in entries:
+            entry.processed_at = now
+            entry.loaded_items = json.loads(entry.items)
+            errors = [
+                orders.validate_customized_product(item, index.get(item['product'])) for item in entry.loaded_items]
+            if any(errors):
+                entry.error = json.dumps(errors)
+            else:
+                valid.append(entry)
+
+        # all together, one by one if that fails (e.g. a row deleted after the index was built)
+        if valid and not write(valid):
+            for entry in valid:
+                write([entry])
+
+        models.QueuedOrder.objects.bulk_update(entries, ['processed_at', 'result', 'error'])
+    written = sum(entry.item_count for entry in entries if not entry.error)
+    return len(entries), written, sum(1 for entry in entries if entry.error)
+
+
+def write(entries):
+    """
+    Writes the customized products of entries in a savepoint and sets their results, False if it failed
+
+    A single entry that fails gets the error.
+    """
+    items = []
+    for entry in entries:
+        for item in entry.loaded_items:
+            # ordered when it was queued
+            items.append(dict(item, created_at=entry.created_at))
+    try:
+        with transaction.atomic():
+            customized_products = orders.create_customized_products(items)
+    except (KeyError, DatabaseError) as exc:
+        if len(entries) == 1:
+            entries[0].error = json.dumps({'detail': '{}: {}'.format(type(exc).__name__, exc)})
+        return False
+
+    ids = iter([customized_product.pk for customized_product in customized_products])
+    for entry in entries:
+        entry.result = json.dumps([next(ids) for _ in range(entry.item_count)])
+    return True
+
+
+def prune(before):
+    """
+    Deletes the batches processed before the datetime before, their keys can be reused afterwards
+    """
+    return models.QueuedOrder.objects.filter(processed_at__lt=before).delete()[0]
+
+
+def get_stats():
+    """
+    Returns the queue's depth (pending batches and customized products), lag and drain rate
+    """
+    now = timezone.now()
+    depth = pending().aggregate(batches=Count('pk'), items=Sum('item_count'), oldest=Min('created_at'))
+    drained = models.QueuedOrder.objects.filter(
+        processed_at__gte=now - datetime.timedelta(seconds=DRAIN_RATE_WINDOW)).aggregate(items=Sum('item_count'))
+    return {
+        'pending_batches': depth['batches'] or 0,
+        'pending_items': depth['items'] or 0,
+        'oldest_pending_seconds': (now - depth['oldest']).total_seconds() if depth['oldest'] else 0,
+        'drained_items_per_second': (drained['items'] or 0) / DRAIN_RATE_WINDOW,
+    }
+
+
+def render_metrics():
+    """
+    Returns get_stats() as Prometheus gauges, computed from the table so any process can serve them
+    """
+    stats = get_stats()
+    lines = []
+    for name, documentation in (
+            ('pending_batches', 'Order batches waiting to be written.'),
+            ('pending_items', 'Customized products waiting to be written.'),
+            ('oldest_pending_seconds', 'Age of the oldest waiting batch, in seconds.'),
+            ('drained_items_per_second',
+             'Customized products written per second over the last {} seconds.'.format(DRAIN_RATE_WINDOW)),
+    ):
+        lines += [
+            '# HELP order_queue_{} {}'.format(name, documentation),
+            '# TYPE order_queue_{} gauge'.format(name),
+            'order_queue_{} {}'.format(name, stats[name]),
+        ]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,114 @@
+"""
+Batch validation and bulk writes for CustomizedProducts
+"""
+from django.db import connection, transaction
+
+from . import models, rollups, snapshots
+
+# CustomizedProduct FKs that must be one of the product's allowed options:
+# (CustomizedProduct field, Product M2M holding the allowed choices)
+CHOICE_FIELDS = (
+    ('ice', 'allowed_ice'),
+    ('room', 'allowed_room'),
+    ('milk_temp', 'allowed_milk_temps'),
+    ('milk_foam', 'allowed_milk_foams'),
+)
+
+# CustomizedProduct FKs to the product's own through rows:
+# (CustomizedProduct field, Product* through model)
+PRODUCT_ROW_FIELDS = (
+    ('size', models.ProductSize),
+    ('milk', models.ProductMilk),
+)
+
+# CustomizedProduct M2Ms with a quantity:
+# (CustomizedProduct field, CustomizedProduct* through model, its FK to the Product* row, Product* model)
+OPTION_FIELDS = (
+    ('sweeteners', models.CustomizedProductSweetener, 'product_sweetener', models.ProductSweetener),
+    ('espresso_shots', models.CustomizedProductEspressoShot, 'product_espresso_shot',
+     models.ProductEspressoShot),
+    ('toppings', models.CustomizedProductTopping, 'product_topping', models.ProductTopping),
+    ('flavors', models.CustomizedProductFlavor, 'product_flavor', models.ProductFlavor),
+    ('juices', models.CustomizedProductJuice, 'product_juice', models.ProductJuice),
+    ('teas', models.CustomizedProductTea, 'product_tea', models.ProductTea),
+)
+
+
+def option_field(row_model):
+    """
+    Returns a Product* through row's FK to its option, e.g. ProductFlavor.flavor
+    """
+    return next(field for field in row_model._meta.fields if field.is_relation and field.name != 'product')
+
+
+def validate_customized_product(item, product_rules):
+    """
+    Checks one customized product against its product's allowed options
+
+    product_rules is the product's entry in the option index (see
+    option_index.py), returns a dict of errors.
+    """
+    if product_rules is None:
+        return {'product': ['Invalid pk "{}" - product is not available.'.format(item['product'])]}
+
+    errors = {}
+    for field_name in [name for name, _ in CHOICE_FIELDS] + [name for name, _ in PRODUCT_ROW_FIELDS]:
+        if item[field_name] not in product_rules[field_name]:
+            errors[field_name] = ['Invalid pk "{}" - not allowed for this product.'.format(item[field_name])]
+
+    for field_name, _, row_field_name, _ in OPTION_FIELDS:
+        option_errors = [
+            {row_field_name: ['Invalid pk "{}" - not allowed for this product.'.format(option[row_field_name])]}
+            if option[row_field_name] not in product_rules[field_name] else {}
+            for option in item[field_name]
+        ]
+        if any(option_errors):
+            errors[field_name] = option_errors
+    return errors
+
+
+def create_customized_products(items):
+    """
+    Writes validated customized products in one transaction with bulk inserts
+
+    The snapshots (see snapshots.py) are built first and the totals priced
+    from them, then one INSERT writes the CustomizedProducts with both (on
+    backends that can return the new ids from a bulk insert, row by row
+    otherwise) plus one for all their options, and the batch is added to the
+    sales rollups.
+    """
+    with transaction.atomic():
+        customized_products = []
+        for item, snapshot in zip(items, snapshots.build_snapshots(items)):
+            customized_products.append(models.CustomizedProduct(
+                product_id=item['product'],
+                ice_id=item['ice'],
+                room_id=item['room'],
+                size_id=item['size'],
+                milk_id=item['milk'],
+                milk_temp_id=item['milk_temp'],
+                milk_foam_id=item['milk_foam'],
+                total=snapshots.total(snapshot),
+                snapshot=snapshots.dumps(snapshot),
+                # imported/generated history keeps its original time
+                **({'created_at': item['created_at']} if 'created_at' in item else {})
+            ))
+        if connection.features.can_return_rows_from_bulk_insert:
+            models.CustomizedProduct.objects.bulk_create(customized_products)
+        else:
+            for customized_product in customized_products:
+                customized_product.save(force_insert=True)
+
+        models.CustomizedProductOption.objects.bulk_create([
+            models.CustomizedProductOption(
+                customized_product=customized_product,
+                option_type=field_name,
+                quantity=option['quantity'],
+                **{row_field_name + '_id': option[row_field_name]})
+            for customized_product, item in zip(customized_products, items)
+            for field_name, _, row_field_name, _ in OPTION_FIELDS
+            for option in item[field_name]
+        ])
+
+        rollups.add_customized_products(customized_products, items)
+    return customized_products
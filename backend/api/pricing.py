@@ -0,0 +1,79 @@
+"""
+Batched price computation for CustomizedProducts
+
+A customized product's total is the product's base price plus the price of
+its size and milk, plus the per-unit price of each priced option times its
+quantity. Totals are computed for many customized products at once with one
+aggregate query for the products and one for their options, and stored on
+CustomizedProduct.total, so later reads don't need the joins. New orders are
+priced from their snapshots (snapshots.total) as they are written, these
+recompute the stored totals, e.g. after an order is edited in the admin.
+"""
+from decimal import Decimal
+
+from django.db.models import DecimalField, F, Sum
+from django.db.models.functions import Coalesce
+
+from . import models
+
+# CustomizedProductOption types whose Product* row has a per-unit price:
+# (option type, FK to the Product* row)
+PRICED_OPTION_FIELDS = (
+    ('flavors', 'product_flavor'),
+    ('toppings', 'product_topping'),
+    ('juices', 'product_juice'),
+    ('teas', 'product_tea'),
+)
+
+# keeps IN (...) lists under SQLite's host parameter limit
+BATCH_SIZE = 500
+
+CENTS = Decimal('0.01')
+
+
+def compute_totals(customized_product_ids):
+    """
+    Returns {customized product id: total} computed from the current prices
+
+    Costs two aggregate queries per BATCH_SIZE ids, never one per item.
+    """
+    customized_product_ids = list(customized_product_ids)
+    totals = {}
+    for start in range(0, len(customized_product_ids), BATCH_SIZE):
+        totals.update(_compute_batch(customized_product_ids[start:start + BATCH_SIZE]))
+    return totals
+
+
+def _compute_batch(customized_product_ids):
+    price_field = DecimalField(max_digits=10, decimal_places=2)
+    totals = dict(
+        models.CustomizedProduct.objects.filter(pk__in=customized_product_ids).annotate(
+            base_price=F('product__price') + F('size__price') + F('milk__price'),
+        ).values_list('pk', 'base_price')
+    )
+    # only the row FK of the option's type is set
+    unit_price = Coalesce(*(F(row_field_name + '__price') for _, row_field_name in PRICED_OPTION_FIELDS))
+    option_totals = models.CustomizedProductOption.objects.filter(
+        customized_product_id__in=customized_product_ids,
+        option_type__in=[option_type for option_type, _ in PRICED_OPTION_FIELDS],
+    ).order_by().values('customized_product_id').annotate(
+        amount=Sum(F('quantity') * unit_price, output_field=price_field),
+    ).values_list('customized_product_id', 'amount')
+    for customized_product_id, amount in option_totals:
+        totals[customized_product_id] += amount
+    return {
+        customized_product_id: Decimal(total).quantize(CENTS)
+        for customized_product_id, total in totals.items()
+    }
+
+
+def update_totals(customized_product_ids):
+    """
+    Recomputes and stores CustomizedProduct.total for the given ids
+    """
+    totals = compute_totals(customized_product_ids)
+    models.CustomizedProduct.objects.bulk_update(
+        [models.CustomizedProduct(pk=pk, total=total) for pk, total in totals.items()],
+        ['total'],
+        batch_size=BATCH_SIZE)
+    return totals
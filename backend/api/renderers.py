@@ -0,0 +1,19 @@
+from rest_framework import renderers
+
+
+class NDJSONRenderer(renderers.JSONRenderer):
+    """
+    Newline delimited JSON, views stream the rows themselves and only error
+    responses are rendered here (as a single JSON document)
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+class CSVRenderer(renderers.JSONRenderer):
+    """
+    CSV, views stream the rows themselves and only error responses are
+    rendered here (as JSON)
+    """
+    media_type = 'text/csv'
+    format = 'csv'
@@ -0,0 +1,150 @@
+"""
+Ops reports over the sales rollups (see rollups.py)
+
+Each report is one aggregate query over the rollup tables: option names come
+from subqueries, ranks and shares from window functions. Results are cached
+per report and parameters for settings.REPORTS_CACHE_TIMEOUT seconds, so
+dashboards refreshing every minute don't query the database every time.
+Days are in the current time zone, from the UTC hours of the rollups.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import ExpressionWrapper, F, FloatField, Func, OuterRef, Subquery, Sum, Window
+from django.db.models.functions import Rank, TruncDay
+
+from . import models, pricing
+
+# the option table of each OptionSalesRollup.option_type
+OPTION_MODELS = {
+    'milk': models.Milk,
+    'sweeteners': models.Sweetener,
+    'espresso_shots': models.EspressoShot,
+    'toppings': models.Topping,
+    'flavors': models.Flavor,
+    'juices': models.Juice,
+    'teas': models.Tea,
+}
+
+CACHE_KEY_PREFIX = 'reports'
+
+
+class WindowSum(Func):
+    """
+    SUM() that can run over an aggregate, e.g. SUM(SUM(count)) OVER ()
+    """
+    function = 'SUM'
+    window_compatible = True
+
+
+def share(aggregate):
+    """
+    The aggregate of each row over its sum on all the rows
+    """
+    return ExpressionWrapper(
+        aggregate * 1.0 / Window(WindowSum(aggregate.copy(), output_field=FloatField())), output_field=FloatField())
+
+
+def filter_rollups(queryset, params):
+    if 'start' in params:
+        queryset = queryset.filter(hour__gte=params['start'])
+    if 'end' in params:
+        queryset = queryset.filter(hour__lt=params['end'])
+    if 'product' in params:
+        queryset = queryset.filter(product_id=params['product'])
+    return queryset
+
+
+def option_name(option_type):
+    return Subquery(OPTION_MODELS[option_type].objects.filter(pk=OuterRef('option_id')).values('name')[:1])
+
+
+def top_options(params):
+    """
+    The params['option_type'] options with the highest quantities of each day, params['limit'] per day
+    """
+    option_type = params['option_type']
+    rows = filter_rollups(models.OptionSalesRollup.objects.filter(option_type=option_type), params).values(
+        'option_id',
+        day=TruncDay('hour'),
+    ).annotate(
+        customized_products=Sum('count'),
+        units=Sum('quantity'),
+    ).annotate(
+        name=option_name(option_type),
+        rank=Window(Rank(), partition_by=[TruncDay('hour')], order_by=F('units').desc()),
+    ).order_by('day', 'rank', 'option_id')
+    # window functions can't be filtered on, the rows past the limit are dropped here
+    return [row for row in rows if row['rank'] <= params['limit']]
+
+
+def revenue_by_size(params):
+    """
+    Customized products and revenue per ProductSize, with its share of the revenue
+    """
+    rows = list(filter_rollups(models.ProductSalesRollup.objects, params).values(
+        'size',
+        product_name=F('size__product__name'),
+        size_name=F('size__size__name'),
+    ).annotate(
+        customized_products=Sum('count'),
+        revenue=Sum('total'),
+        revenue_share=share(Sum('total')),
+    ).order_by('-revenue', 'size'))
+    # SQLite sums decimals without their scale
+    for row in rows:
+        row['revenue'] = row['revenue'].quantize(pricing.CENTS)
+    return rows
+
+
+def milk_mix(params):
+    """
+    Customized products per milk, with their share of all of them
+    """
+    return list(filter_rollups(models.OptionSalesRollup.objects.filter(option_type='milk'), params).values(
+        'option_id',
+    ).annotate(
+        customized_products=Sum('count'),
+        customized_products_share=share(Sum('count')),
+    ).annotate(
+        name=option_name('milk'),
+    ).order_by('-customized_products', 'option_id'))
+
+
+def espresso_shots(params):
+    """
+    Average espresso shots per customized product of each ProductSize, next to the size's default
+    """
+    return list(filter_rollups(models.ProductSalesRollup.objects, params).values(
+        'size',
+        product_name=F('size__product__name'),
+        size_name=F('size__size__name'),
+        default_espresso_shots=F('size__default_espresso_shots'),
+    ).annotate(
+        customized_products=Sum('count'),
+        average_espresso_shots=ExpressionWrapper(
+            Sum('espresso_shots') * 1.0 / Sum('count'), output_field=FloatField()),
+    ).order_by('product_name', 'size'))
+
+
+REPORTS = {
+    'top-options': top_options,
+    'revenue-by-size': revenue_by_size,
+    'milk-mix': milk_mix,
+    'espresso-shots': espresso_shots,
+}
+
+
+def get_report(name, params):
+    """
+    Returns the rows of a report for validated params (see ReportParamsSerializer), cached
+    """
+    signature = json.dumps(params, sort_keys=True, default=str)
+    key = '{}:{}:{}'.format(CACHE_KEY_PREFIX, name, hashlib.sha1(signature.encode()).hexdigest())
+    rows = cache.get(key)
+    if rows is None:
+        rows = REPORTS[name](params)
+        cache.set(key, rows, settings.REPORTS_CACHE_TIMEOUT)
+    return rows
@@ -0,0 +1,237 @@
+"""
+Hourly sales rollups
+
+ProductSalesRollup counts the customized products (with their totals and
+espresso shots) per hour, product and size, OptionSalesRollup counts them
+(with the option quantities) per hour, option and product for the milk and
+the quantity options. Reports read these few pre-aggregated rows instead of
+scanning the order tables.
+
+orders.create_customized_products adds each batch to the rollups in its own
+transaction, with one upsert statement per rollup table so concurrent
+batches never lose each other's counts, and the admin replaces an order's
+contribution when it edits one. rebuild() (the rebuild_rollups
+command) recomputes them from the order tables with aggregate queries.
+Hours are truncated in UTC.
+"""
+import operator
+from decimal import Decimal
+from functools import reduce
+
+from django.db import connections, router, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from . import models, option_index, orders
+
+# OptionSalesRollup.option_type of the milk, the other types are the orders.OPTION_FIELDS fields
+MILK_TYPE = 'milk'
+
+PRODUCT_KEY = ('hour', 'product_id', 'size_id')
+OPTION_KEY = ('hour', 'option_type', 'option_id', 'product_id')
+
+# rows per upsert statement, keeps them under SQLite's host parameter limit
+UPSERT_BATCH_SIZE = 100
+BATCH_SIZE = 500
+
+
+def truncate_hour(value):
+    return value.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def get_row_options(items, index):
+    """
+    Returns {option type: {Product* row id: option id}} for the rows the items use
+
+    Rows are looked up in the option index, rows it doesn't have (inactive
+    ones, in imported history) with one query on the ProductOption view.
+    """
+    row_ids = {MILK_TYPE: {item['milk'] for item in items}}
+    for option_type, _, row_field_name, _ in orders.OPTION_FIELDS:
+        row_ids[option_type] = {option[row_field_name] for item in items for option in item[option_type]}
+
+    row_options = {}
+    missing = []
+    for option_type, used in row_ids.items():
+        known = index.row_options.get(option_type, {})
+        options = row_options[option_type] = {row_id: known[row_id] for row_id in used if row_id in known}
+        if used - options.keys():
+            missing.append(Q(option_type=option_type, row_id__in=used - options.keys()))
+    if missing:
+        rows = models.ProductOption.objects.filter(reduce(operator.or_, missing)).values_list(
+            'option_type', 'row_id', 'option_id')
+        for option_type, row_id, option_id in rows:
+            row_options[option_type][row_id] = option_id
+    return row_options
+
+
+def add_customized_products(customized_products, items):
+    """
+    Adds newly written customized products (with their totals set) to the rollups
+
+    items are the validated payloads they were written from, see
+    orders.create_customized_products. Two statements (more for batches over
+    UPSERT_BATCH_SIZE rollup rows) when the option index knows every row.
+    """
+    row_options = get_row_options(items, option_index.get_index())
+    product_rows = {}
+    option_rows = {}
+    for customized_product, item in zip(customized_products, items):
+        hour = truncate_hour(customized_product.created_at)
+        amounts = product_rows.setdefault(
+            (hour, item['product'], item['size']), {'count': 0, 'total': Decimal(0), 'espresso_shots': 0})
+        amounts['count'] += 1
+        amounts['total'] += customized_product.total
+        amounts['espresso_shots'] += sum(option['quantity'] for option in item['espresso_shots'])
+
+        quantities = {(MILK_TYPE, row_options[MILK_TYPE][item['milk']]): 1}
+        for option_type, _, row_field_name, _ in orders.OPTION_FIELDS:
+            for option in item[option_type]:
+                key = (option_type, row_options[option_type][option[row_field_name]])
+                quantities[key] = quantities.get(key, 0) + option['quantity']
+        for (option_type, option_id), quantity in quantities.items():
+            amounts = option_rows.setdefault(
+                (hour, option_type, option_id, item['product']), {'count': 0, 'quantity': 0})
+            amounts['count'] += 1
+            amounts['quantity'] += quantity
+
+    upsert(models.ProductSalesRollup, PRODUCT_KEY, product_rows)
+    upsert(models.OptionSalesRollup, OPTION_KEY, option_rows)
+
+
+def upsert(model, key_fields, rows):
+    """
+    Adds the amounts of rows ({key: {field: amount}}) to model's rows with the same key, creating missing ones
+    """
+    if not rows:
+        return
+    connection = connections[router.db_for_write(model)]
+    # in key order, so concurrent batches lock the rows they share in the same order
+    rows = sorted(rows.items())
+    amount_fields = list(rows[0][1])
+
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        for key, amounts in rows:
+            lookup = dict(zip(key_fields, key))
+            if not model.objects.filter(**lookup).update(**{
+                    field_name: F(field_name) + amount for field_name, amount in amounts.items()}):
+                model.objects.create(**lookup, **amounts)
+        return
+
+    fields = [model._meta.get_field(field_name) for field_name in list(key_fields) + amount_fields]
+    quote_name = connection.ops.quote_name
+    table = quote_name(model._meta.db_table)
+    sql = 'INSERT INTO {table} ({columns}) VALUES {{values}} ON CONFLICT ({key}) DO UPDATE SET {updates}'.format(
+        table=table,
+        columns=', '.join(quote_name(field.column) for field in fields),
+        key=', '.join(quote_name(field.column) for field in fields[:len(key_fields)]),
+        updates=', '.join(
+            '{column} = {table}.{column} + excluded.{column}'.format(table=table, column=quote_name(field.column))
+            for field in fields[len(key_fields):]))
+    placeholders = '({})'.format(', '.join(['%s'] * len(fields)))
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+            batch = rows[start:start + UPSERT_BATCH_SIZE]
+            params = [
+                field.get_db_prep_save(value, connection)
+                for key, amounts in batch
+                for field, value in zip(fields, list(key) + [amounts[field_name] for field_name in amount_fields])
+            ]
+            cursor.execute(sql.format(values=', '.join([placeholders] * len(batch))), params)
+
+
+def aggregate(customized_product_ids=None):
+    """
+    Returns the rollup rows ({PRODUCT_KEY: amounts}, {OPTION_KEY: amounts}) of customized products (all when None)
+
+    customized_product_ids is a list of ids or a values('pk') queryset.
+    Aggregate queries over the order tables, their amounts are what
+    add_customized_products added for those customized products.
+    """
+    def hour(prefix=''):
+        return TruncHour(prefix + 'created_at', tzinfo=timezone.utc)
+
+    customized_products = models.CustomizedProduct.objects.order_by()
+    options = Q()
+    if customized_product_ids is not None:
+        customized_products = customized_products.filter(pk__in=customized_product_ids)
+        options = Q(customized_product__in=customized_product_ids)
+
+    espresso_shots = {
+        (row['hour'], row['product'], row['size']): row['quantity']
+        for row in models.CustomizedProductEspressoShot.objects.filter(options).order_by().values(
+            hour=hour('customized_product__'),
+            product=F('customized_product__product'),
+            size=F('customized_product__size'),
+        ).annotate(quantity=Sum('quantity'))
+    }
+    product_rows = {
+        (row['hour'], row['product'], row['size']): {
+            'count': row['customized_products'],
+            'total': row['sales'],
+            'espresso_shots': espresso_shots.get((row['hour'], row['product'], row['size']), 0),
+        }
+        for row in customized_products.values(
+            'product', 'size', hour=hour(),
+        ).annotate(customized_products=Count('pk'), sales=Sum('total'))
+    }
+
+    option_rows = {
+        (row['hour'], MILK_TYPE, row['option'], row['product']): {
+            'count': row['customized_products'], 'quantity': row['customized_products']}
+        for row in customized_products.values(
+            'product', hour=hour(), option=F('milk__milk'),
+        ).annotate(customized_products=Count('pk'))
+    }
+    for option_type, through, row_field_name, row_model in orders.OPTION_FIELDS:
+        option_rows.update(
+            ((row['hour'], option_type, row['option'], row['product']), {
+                'count': row['customized_products'], 'quantity': row['option_quantity']})
+            for row in through.objects.filter(options).order_by().values(
+                hour=hour('customized_product__'),
+                option=F('{}__{}'.format(row_field_name, orders.option_field(row_model).name)),
+                product=F('customized_product__product'),
+            ).annotate(
+                customized_products=Count('customized_product', distinct=True),
+                option_quantity=Sum('quantity'))
+        )
+    return product_rows, option_rows
+
+
+def replace(old_rows, new_rows):
+    """
+    Swaps customized products' contribution to the rollups, aggregate() rows from before and after they changed
+
+    For edits outside of orders.create_customized_products (the admin), in
+    the transaction of the edit. Rows whose amounts drop to 0 are kept.
+    """
+    for model, key_fields, old, new in zip(
+            (models.ProductSalesRollup, models.OptionSalesRollup), (PRODUCT_KEY, OPTION_KEY), old_rows, new_rows):
+        rows = {}
+        for key in old.keys() | new.keys():
+            amounts = new.get(key) or dict.fromkeys(old[key], 0)
+            amounts = {
+                field_name: amount - old.get(key, {}).get(field_name, 0) for field_name, amount in amounts.items()}
+            if any(amounts.values()):
+                rows[key] = amounts
+        upsert(model, key_fields, rows)
+
+
+def rebuild():
+    """
+    Recomputes the rollups from the order tables, returns the number of (product, option) rollup rows
+    """
+    with transaction.atomic():
+        models.ProductSalesRollup.objects.all().delete()
+        models.OptionSalesRollup.objects.all().delete()
+        product_rows, option_rows = aggregate()
+        models.ProductSalesRollup.objects.bulk_create((
+            models.ProductSalesRollup(**dict(zip(PRODUCT_KEY, key)), **amounts)
+            for key, amounts in product_rows.items()
+        ), batch_size=BATCH_SIZE)
+        models.OptionSalesRollup.objects.bulk_create((
+            models.OptionSalesRollup(**dict(zip(OPTION_KEY, key)), **amounts)
+            for key, amounts in option_rows.items()
+        ), batch_size=BATCH_SIZE)
+    return len(product_rows), len(option_rows)
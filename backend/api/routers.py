@@ -0,0 +1,115 @@
+"""
+Read replica routing
+
+Replicas are the DATABASES aliases listed in settings.DATABASE_REPLICAS (see
+settings/dev.py). Reads only go to a replica inside replica_reads(), which
+the menu, order history and reporting views enter for safe requests, so the
+admin, validation and everything else keep reading from the primary. Writes
+always go to the primary.
+
+Read-your-writes: a write inside replica_reads() pins the rest of the
+request to the primary, and ReplicaPinningMiddleware keeps a client that
+sent a write on the primary for DATABASE_REPLICA_LAG seconds.
+"""
+import contextlib
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+PIN_COOKIE = 'pin_primary'
+
+_replica_reads = ContextVar('replica_reads', default=False)
+_pinned = ContextVar('pinned', default=False)
+
+
+def get_replicas():
+    return list(getattr(settings, 'DATABASE_REPLICAS', ()))
+
+
+def get_replica():
+    """
+    Returns the alias of a random replica, the primary's when there are none
+    """
+    replicas = get_replicas()
+    return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+
+@contextlib.contextmanager
+def replica_reads(enabled=True):
+    """
+    Sends the reads made inside the block to a replica unless pinned to the primary
+    """
+    token = _replica_reads.set(enabled)
+    # a write inside the block pins the rest of it, not what runs after
+    pinned_token = _pinned.set(_pinned.get())
+    try:
+        yield
+    finally:
+        _pinned.reset(pinned_token)
+        _replica_reads.reset(token)
+
+
+@contextlib.contextmanager
+def primary():
+    """
+    Pins the reads made inside the block to the primary, even inside replica_reads()
+    """
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def pin_cookie_max_age():
+    """
+    Returns how long (seconds) to pin a client after a write, None when there are no replicas
+    """
+    return settings.DATABASE_REPLICA_LAG if get_replicas() else None
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # related objects come from where the instance was loaded
+            return instance._state.db
+        if _replica_reads.get() and not _pinned.get():
+            return get_replica()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if _replica_reads.get():
+            _pinned.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_replicas():
+            return False
+        return None
+
+
+class ReplicaPinningMiddleware:
+    """
+    Keeps clients that sent a write (any unsafe method) on the primary for DATABASE_REPLICA_LAG seconds
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if PIN_COOKIE in request.COOKIES:
+            with primary():
+                response = self.get_response(request)
+        else:
+            response = self.get_response(request)
+
+        max_age = pin_cookie_max_age()
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and max_age:
+            response.set_cookie(PIN_COOKIE, '1', max_age=max_age, httponly=True)
+        return response
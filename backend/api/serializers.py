@@ -1,10 +1,319 @@
+import json
+
 from rest_framework import serializers
 
-from . import models
+from . import metrics, models, option_index, orders, reports, snapshots
+
+
+class TimedDataMixin:
+    """
+    Times serializing to .data for the Server-Timing header and request metrics, see metrics.py
+    """
+    @property
+    def data(self):
+        with metrics.timer('serialize'):
+            return super().data
+
+
+class TimedListSerializer(TimedDataMixin, serializers.ListSerializer):
+    pass
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(TimedDataMixin, serializers.ModelSerializer):
+    """
+    Product with every allowed and default option nested
+
+    Pass fields to render only those fields, the through rows nested under
+    the selected default_* fields then render their product as an id.
+    """
     class Meta:
         model = models.Product
         fields = '__all__'
         depth = 3
+        list_serializer_class = TimedListSerializer
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is None:
+            return
+        for field_name in set(self.fields) - set(fields):
+            self.fields.pop(field_name)
+        for field in self.fields.values():
+            nested = getattr(field, 'child', field)
+            if isinstance(nested, serializers.BaseSerializer) and 'product' in nested.fields:
+                nested.fields['product'] = serializers.PrimaryKeyRelatedField(read_only=True)
+
+
+class OptionSerializer(TimedDataMixin, serializers.ModelSerializer):
+    """
+    Flat serializer for the option lookup tables in the normalized menu, any
+    relations are rendered as ids into the menu's other tables
+    """
+    class Meta:
+        fields = '__all__'
+
+    @classmethod
+    def for_model(cls, option_model):
+        meta = type('Meta', (cls.Meta,), {'model': option_model})
+        return type('{}OptionSerializer'.format(option_model.__name__), (cls,), {'Meta': meta})
+
+
+class ProductOptionSerializer(serializers.ModelSerializer):
+    """
+    Flat serializer for the Product* through rows nested in a normalized menu product
+    """
+    class Meta:
+        exclude = ('product',)
+
+    @classmethod
+    def for_model(cls, through_model):
+        meta = type('Meta', (cls.Meta,), {'model': through_model})
+        return type('{}MenuSerializer'.format(through_model.__name__), (cls,), {'Meta': meta})
+
+
+class ProductRowSerializer(TimedDataMixin, ProductOptionSerializer):
+    """
+    A Product* through row outside of its product (menu changes), with the product's id
+    """
+    class Meta:
+        fields = '__all__'
+        list_serializer_class = TimedListSerializer
+
+
+class MenuProductSerializer(TimedDataMixin, serializers.ModelSerializer):
+    """
+    Product for the normalized menu, refers to options by id instead of nesting them
+
+    Allowed options are listed as the product's through rows (with their pricing
+    and default quantities), defaults are the ids of those rows.
+    """
+    sizes = ProductOptionSerializer.for_model(models.ProductSize)(
+        source='productsize_set', many=True)
+    milks = ProductOptionSerializer.for_model(models.ProductMilk)(
+        source='productmilk_set', many=True)
+    sweeteners = ProductOptionSerializer.for_model(models.ProductSweetener)(
+        source='productsweetener_set', many=True)
+    flavors = ProductOptionSerializer.for_model(models.ProductFlavor)(
+        source='productflavor_set', many=True)
+    espresso_shots = ProductOptionSerializer.for_model(models.ProductEspressoShot)(
+        source='productespressoshot_set', many=True)
+    juices = ProductOptionSerializer.for_model(models.ProductJuice)(
+        source='productjuice_set', many=True)
+    toppings = ProductOptionSerializer.for_model(models.ProductTopping)(
+        source='producttopping_set', many=True)
+    teas = ProductOptionSerializer.for_model(models.ProductTea)(
+        source='producttea_set', many=True)
+
+    class Meta:
+        model = models.Product
+        list_serializer_class = TimedListSerializer
+        fields = (
+            'id',
+            'name',
+            'price',
+            'is_active',
+            'allowed_ice',
+            'default_ice',
+            'allowed_room',
+            'default_room',
+            'allowed_milk_temps',
+            'default_milk_temp',
+            'allowed_milk_foams',
+            'default_milk_foam',
+            'sizes',
+            'default_size',
+            'milks',
+            'default_milk',
+            'sweeteners',
+            'default_sweeteners',
+            'flavors',
+            'default_flavors',
+            'espresso_shots',
+            'default_espresso_shots',
+            'juices',
+            'default_juices',
+            'toppings',
+            'default_toppings',
+            'teas',
+            'default_teas',
+        )
+
+
+def customized_option_serializer(row_field_name):
+    """
+    Builds the serializer for one entry of a CustomizedProduct quantity list,
+    e.g. {"product_flavor": 3, "quantity": 2}
+    """
+    return type('CustomizedOptionSerializer', (serializers.Serializer,), {
+        row_field_name: serializers.IntegerField(),
+        'quantity': serializers.IntegerField(min_value=1),
+    })
+
+
+class CustomizedProductListSerializer(TimedListSerializer):
+    """
+    Validates a batch of customized products together and writes them in bulk
+
+    Items are checked against the in-memory option index, and the batch is
+    rejected unless every item is valid.
+    """
+    def to_internal_value(self, data):
+        # errors are raised from here rather than validate() to keep one error dict per item
+        items = super().to_internal_value(data)
+        index = option_index.get_index()
+        errors = [orders.validate_customized_product(item, index.get(item['product'])) for item in items]
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return items
+
+    def create(self, validated_data):
+        return orders.create_customized_products(validated_data)
+
+
+class CustomizedProductSerializer(TimedDataMixin, serializers.Serializer):
+    """
+    A customized product to be created, options and through rows are given by id
+
+    Ids are checked against the product's allowed options by the list
+    serializer rather than one query per field.
+    """
+    id = serializers.IntegerField(read_only=True)
+    product = serializers.IntegerField()
+    ice = serializers.IntegerField()
+    room = serializers.IntegerField()
+    size = serializers.IntegerField(help_text="ProductSize id")
+    milk = serializers.IntegerField(help_text="ProductMilk id")
+    milk_temp = serializers.IntegerField()
+    milk_foam = serializers.IntegerField()
+    sweeteners = customized_option_serializer('product_sweetener')(many=True, required=False, default=list)
+    espresso_shots = customized_option_serializer('product_espresso_shot')(
+        many=True, required=False, default=list)
+    toppings = customized_option_serializer('product_topping')(many=True, required=False, default=list)
+    flavors = customized_option_serializer('product_flavor')(many=True, required=False, default=list)
+    juices = customized_option_serializer('product_juice')(many=True, required=False, default=list)
+    teas = customized_option_serializer('product_tea')(many=True, required=False, default=list)
+
+    class Meta:
+        list_serializer_class = CustomizedProductListSerializer
+
+    def to_representation(self, instance):
+        return {'id': instance.pk, 'total': str(instance.total)}
+
+
+class QueuedOrderSerializer(serializers.ModelSerializer):
+    """
+    A batch in the order queue (see order_queue.py), ids are its customized products once written
+
+    errors is why a failed batch wasn't written, like the batch endpoint's errors.
+    """
+    status = serializers.SerializerMethodField()
+    ids = serializers.SerializerMethodField()
+    errors = serializers.SerializerMethodField()
+
+    class Meta:
+        model = models.QueuedOrder
+        fields = ('key', 'status', 'item_count', 'created_at', 'processed_at', 'ids', 'errors')
+
+    def get_status(self, instance):
+        if instance.processed_at is None:
+            return 'queued'
+        return 'failed' if instance.error else 'written'
+
+    def get_ids(self, instance):
+        return json.loads(instance.result) if instance.result else None
+
+    def get_errors(self, instance):
+        return json.loads(instance.error) if instance.error else None
+
+
+class DefaultCustomizationSerializer(serializers.ModelSerializer):
+    """
+    A product's default customization in one size, item is the payload to post to order it as-is
+    """
+    snapshot = serializers.SerializerMethodField()
+    item = serializers.SerializerMethodField()
+
+    class Meta:
+        model = models.DefaultCustomization
+        fields = ('product', 'size', 'is_default', 'total', 'updated_at', 'snapshot', 'item')
+
+    def get_snapshot(self, instance):
+        return instance.get_snapshot()
+
+    def get_item(self, instance):
+        return snapshots.to_item(instance.get_snapshot())
+
+
+class DefaultCustomizationParamsSerializer(serializers.Serializer):
+    size = serializers.IntegerField(required=False, help_text="ProductSize id, the product's default size if not given")
+
+
+class MenuChangesParamsSerializer(serializers.Serializer):
+    since = serializers.IntegerField(min_value=0)
+
+
+class ExportParamsSerializer(serializers.Serializer):
+    """
+    Date range of a CustomizedProduct export, start is inclusive and end exclusive
+    """
+    start = serializers.DateTimeField(required=False, input_formats=['iso-8601', '%Y-%m-%d'])
+    end = serializers.DateTimeField(required=False, input_formats=['iso-8601', '%Y-%m-%d'])
+
+
+class OrderHistoryParamsSerializer(ExportParamsSerializer):
+    product = serializers.IntegerField(required=False)
+
+
+class ReportParamsSerializer(OrderHistoryParamsSerializer):
+    """
+    Parameters of the reports (see reports.py), option_type and limit are only used by top-options
+    """
+    option_type = serializers.ChoiceField(choices=sorted(reports.OPTION_MODELS), default='flavors')
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=5)
+
+
+class CustomizedProductHistoryListSerializer(TimedListSerializer):
+    def to_representation(self, data):
+        # snapshots of rows written before them are built together rather than per row
+        return super().to_representation(snapshots.attach(list(data)))
+
+
+class CustomizedProductHistorySerializer(TimedDataMixin, serializers.ModelSerializer):
+    """
+    A customized product as it was ordered, in the same shape CustomizedProductSerializer accepts
+
+    The options are read from the snapshot, so it can be posted again to reorder.
+    """
+    class Meta:
+        model = models.CustomizedProduct
+        list_serializer_class = CustomizedProductHistoryListSerializer
+        fields = (
+            'id',
+            'product',
+            'created_at',
+            'updated_at',
+            'total',
+            'ice',
+            'room',
+            'size',
+            'milk',
+            'milk_temp',
+            'milk_foam',
+        )
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        item = snapshots.to_item(snapshots.attach([instance])[0].get_snapshot())
+        for field_name, _, _, _ in orders.OPTION_FIELDS:
+            data[field_name] = item[field_name]
+        return data
+
+
+class CustomizedProductDetailSerializer(CustomizedProductHistorySerializer):
+    """
+    A customized product with its snapshot: the names and unit prices it was ordered with, for tickets and receipts
+    """
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data['snapshot'] = instance.get_snapshot()
+        return data
@@ -0,0 +1,41 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from . import artifacts, catalog, defaults, metrics, models
+
+
+def catalog_saved_or_deleted(sender, instance, **kwargs):
+    catalog.log_changes(sender, [instance.pk])
+    catalog.catalog_changed()
+
+
+def catalog_m2m_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # e.g. ice.product_set.clear(), post_clear doesn't say which products changed
+        fields = {field.related_model: field.name for field in sender._meta.fields if field.is_relation}
+        pk_set = sender.objects.filter(**{fields[instance._meta.concrete_model]: instance.pk}).values_list(
+            fields[model], flat=True)
+        catalog.log_changes(model, pk_set)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            catalog.log_changes(instance._meta.concrete_model, [instance.pk])
+        elif pk_set:
+            catalog.log_changes(model, pk_set)
+        catalog.catalog_changed()
+
+
+def connect():
+    for model in catalog.CATALOG_MODELS:
+        post_save.connect(catalog_saved_or_deleted, sender=model, dispatch_uid='catalog_saved')
+        post_delete.connect(catalog_saved_or_deleted, sender=model, dispatch_uid='catalog_deleted')
+
+    for model in (models.Product, models.Topping):
+        for field in model._meta.many_to_many:
+            m2m_changed.connect(
+                catalog_m2m_changed,
+                sender=field.remote_field.through,
+                dispatch_uid='catalog_m2m_changed')
+
+    catalog.catalog_committed.connect(artifacts.catalog_committed, dispatch_uid='menu_artifact')
+    catalog.catalog_committed.connect(defaults.catalog_committed, dispatch_uid='default_customizations')
+    connection_created.connect(metrics.connection_created, dispatch_uid='request_metrics')
@@ -0,0 +1,237 @@
+"""
+Customization snapshots of CustomizedProducts
+
+Each customized product keeps a JSON copy of its customization as it was
+ordered in CustomizedProduct.snapshot: the product, choices, size, milk and
+options with their ids, names, quantities and unit prices. Snapshots are
+built for a whole batch with three queries and inserted with the customized
+products, and never follow later catalog changes, so a ticket, receipt or
+reorder is read from a single row. check() (the check_snapshots command)
+compares them in bulk with the relational rows.
+"""
+import json
+import operator
+from decimal import Decimal
+from functools import reduce
+
+from django.db.models import CharField, Q, Value
+from django.db.models.functions import Coalesce
+
+from . import models, orders, pricing
+
+VERSION = 1
+
+CHUNK_SIZE = 2000
+
+# option tables of orders.CHOICE_FIELDS
+CHOICE_MODELS = {
+    'ice': models.IceChoice,
+    'room': models.RoomChoice,
+    'milk_temp': models.TempChoice,
+    'milk_foam': models.FoamChoice,
+}
+
+
+def price(value):
+    return str(Decimal(value).quantize(pricing.CENTS))
+
+
+def build_snapshots(items):
+    """
+    Returns the snapshots (dicts) of validated CustomizedProductSerializer payloads, with the current names and prices
+
+    One query for the products, one for the choices and one for the
+    Product* rows (from the ProductOption view), whatever the batch size.
+    """
+    if not items:
+        return []
+    products = {
+        pk: {'id': pk, 'name': name, 'price': price(product_price)}
+        for pk, name, product_price in models.Product.objects.filter(
+            pk__in={item['product'] for item in items}).values_list('pk', 'name', 'price')
+    }
+
+    choice_querysets = [
+        model.objects.filter(pk__in={item[field_name] for item in items}).annotate(
+            field_name=Value(field_name, output_field=CharField()),
+        ).values_list('pk', 'name', 'field_name')
+        for field_name, model in CHOICE_MODELS.items()
+    ]
+    choices = {
+        (field_name, pk): {'id': pk, 'name': name}
+        for pk, name, field_name in choice_querysets[0].union(*choice_querysets[1:], all=True)
+    }
+
+    row_ids = {field_name: {item[field_name] for item in items} for field_name, _ in orders.PRODUCT_ROW_FIELDS}
+    for field_name, _, row_field_name, _ in orders.OPTION_FIELDS:
+        row_ids[field_name] = {option[row_field_name] for item in items for option in item[field_name]}
+    rows = models.ProductOption.objects.filter(reduce(operator.or_, (
+        Q(option_type=option_type, row_id__in=ids) for option_type, ids in row_ids.items() if ids
+    ))).values_list('option_type', 'row_id', 'option_id', 'name', 'price')
+    rows = {
+        (option_type, row_id): {'id': row_id, 'option_id': option_id, 'name': name, 'price': price(row_price)}
+        for option_type, row_id, option_id, name, row_price in rows
+    }
+
+    snapshots = []
+    for item in items:
+        snapshot = {'version': VERSION, 'product': products[item['product']]}
+        for field_name, _ in orders.CHOICE_FIELDS:
+            snapshot[field_name] = choices[field_name, item[field_name]]
+        for field_name, _ in orders.PRODUCT_ROW_FIELDS:
+            snapshot[field_name] = rows[field_name, item[field_name]]
+        for field_name, _, row_field_name, _ in orders.OPTION_FIELDS:
+            snapshot[field_name] = [
+                dict(rows[field_name, option[row_field_name]], quantity=option['quantity'])
+                for option in item[field_name]
+            ]
+        snapshots.append(snapshot)
+    return snapshots
+
+
+def dumps(snapshot):
+    return json.dumps(snapshot, sort_keys=True, separators=(',', ':'))
+
+
+def total(snapshot):
+    """
+    Returns the price of a snapshot, the same as pricing.compute_totals at the time it was built
+    """
+    amount = sum(Decimal(snapshot[field_name]['price']) for field_name in ('product', 'size', 'milk'))
+    amount += sum(
+        Decimal(option['price']) * option['quantity']
+        for field_name, _, _, _ in orders.OPTION_FIELDS
+        for option in snapshot[field_name]
+    )
+    return amount.quantize(pricing.CENTS)
+
+
+def to_item(snapshot):
+    """
+    Returns a snapshot as a CustomizedProductSerializer payload, e.g. to reorder it
+    """
+    item = {'product': snapshot['product']['id']}
+    for field_name, _ in orders.CHOICE_FIELDS + orders.PRODUCT_ROW_FIELDS:
+        item[field_name] = snapshot[field_name]['id']
+    for field_name, _, row_field_name, _ in orders.OPTION_FIELDS:
+        item[field_name] = [
+            {row_field_name: option['id'], 'quantity': option['quantity']} for option in snapshot[field_name]]
+    return item
+
+
+def load_items(customized_products):
+    """
+    Returns {id: payload} of saved customized products, read from their relational rows with one query
+    """
+    items = {}
+    for customized_product in customized_products:
+        item = items[customized_product.pk] = {'product': customized_product.product_id}
+        for field_name, _ in orders.CHOICE_FIELDS + orders.PRODUCT_ROW_FIELDS:
+            item[field_name] = getattr(customized_product, field_name + '_id')
+        for field_name, _, _, _ in orders.OPTION_FIELDS:
+            item[field_name] = []
+
+    row_field_names = {field_name: row_field_name for field_name, _, row_field_name, _ in orders.OPTION_FIELDS}
+    # values rather than instances, only the FK of the option's type is set
+    options = models.CustomizedProductOption.objects.filter(customized_product_id__in=items).annotate(
+        row_id=Coalesce(*(row_field_name + '_id' for row_field_name in row_field_names.values())),
+    ).order_by('pk').values_list('customized_product_id', 'option_type', 'row_id', 'quantity')
+    for customized_product_id, option_type, row_id, quantity in options:
+        items[customized_product_id][option_type].append(
+            {row_field_names[option_type]: row_id, 'quantity': quantity})
+    return items
+
+
+def build_from_rows(customized_products):
+    """
+    Returns the snapshots of saved customized products from their relational rows and the current catalog
+    """
+    return build_snapshots(list(load_items(customized_products).values()))
+
+
+def attach(customized_products):
+    """
+    Sets (without saving) the snapshots of the customized products written before snapshots
+
+    Rows with a snapshot cost nothing, the others four queries together.
+    """
+    missing = [customized_product for customized_product in customized_products if not customized_product.snapshot]
+    if missing:
+        for customized_product, snapshot in zip(missing, build_from_rows(missing)):
+            customized_product.snapshot = dumps(snapshot)
+    return customized_products
+
+
+def rewrite(customized_products, rebuilt=False):
+    """
+    Rebuilds and saves the snapshots of customized products, e.g. after their options were edited
+
+    rebuilt marks snapshots whose prices aren't the ones of the order (rows
+    written before snapshots), their totals aren't checked.
+    """
+    customized_products = list(customized_products)
+    for customized_product, snapshot in zip(customized_products, build_from_rows(customized_products)):
+        if rebuilt:
+            snapshot['rebuilt'] = True
+        customized_product.snapshot = dumps(snapshot)
+    models.CustomizedProduct.objects.bulk_update(customized_products, ['snapshot'], batch_size=pricing.BATCH_SIZE)
+
+
+def comparable(item):
+    return {
+        key: sorted(value, key=lambda option: sorted(option.items())) if isinstance(value, list) else value
+        for key, value in item.items()
+    }
+
+
+# problems check(repair=True) fixes, a wrong total needs a person to tell whether the total or the prices are right
+REPAIRABLE = ('missing', 'options')
+
+
+def find_problem(customized_product, item):
+    """
+    Returns what is wrong with a customized product's snapshot, None when it matches its payload from load_items
+    """
+    snapshot = customized_product.get_snapshot()
+    if snapshot is None:
+        return 'missing'
+    if comparable(to_item(snapshot)) != comparable(item):
+        return 'options'
+    if not snapshot.get('rebuilt') and total(snapshot) != customized_product.total:
+        return 'total'
+    return None
+
+
+def check(queryset, chunk_size=CHUNK_SIZE, repair=False):
+    """
+    Yields (customized product, problem) for the snapshots that don't match the relational rows
+
+    Rows are read chunk_size at a time with their options, one query per
+    chunk. Problems are 'missing' (written before snapshots),
+    'options' (ids or quantities differ, e.g. edited without the admin) and
+    'total' (the unit prices don't add up to CustomizedProduct.total). Names
+    and prices themselves aren't checked, they may differ from the current
+    catalog. With repair, the REPAIRABLE problems are fixed: 'options' rows
+    like an edit in the admin (repriced, then snapshotted), 'missing' ones
+    get a rebuilt snapshot with the current catalog, their totals are kept.
+    """
+    def check_chunk(chunk):
+        items = load_items(chunk)
+        problems = [(row, find_problem(row, items[row.pk])) for row in chunk]
+        problems = [(customized_product, problem) for customized_product, problem in problems if problem]
+        if repair:
+            edited = [customized_product for customized_product, problem in problems if problem == 'options']
+            pricing.update_totals(customized_product.pk for customized_product in edited)
+            rewrite(edited)
+            rewrite((customized_product for customized_product, problem in problems if problem == 'missing'),
+                    rebuilt=True)
+        return problems
+
+    chunk = []
+    for customized_product in queryset.order_by('pk').iterator(chunk_size=chunk_size):
+        chunk.append(customized_product)
+        if len(chunk) == chunk_size:
+            yield from check_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield from check_chunk(chunk)
@@ -0,0 +1,212 @@
+"""
+Synthetic catalogs and order histories for benchmarks and load tests
+
+Everything is written with bulk inserts, so generating a catalog with
+thousands of products (and their through rows) takes seconds.
+"""
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import catalog, models, option_index, orders
+
+TOPPING_CHOICE_NAMES = ('No', 'Light', 'Regular', 'Extra')
+
+
+def bulk_create(model, objs, batch_size=500):
+    """
+    bulk_create that also sets the pks on backends that can't return them
+
+    Relies on the new rows getting increasing pks after the current max,
+    which holds for a single writer inside a transaction.
+    """
+    objs = list(objs)
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objs, batch_size=batch_size)
+
+    last = model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    model.objects.bulk_create(objs, batch_size=batch_size)
+    for obj, pk in zip(objs, model.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)):
+        obj.pk = pk
+    return objs
+
+
+def create_options(model, prefix, count, **fields):
+    return bulk_create(model, (model(name='{} {}'.format(prefix, i + 1), **fields) for i in range(count)))
+
+
+@transaction.atomic
+def generate_catalog(products=100, sizes=4, milks=8, flavors=20, toppings=20,
+                     flavor_categories=3, topping_categories=4, sweeteners=5, espresso_shots=2,
+                     juices=3, teas=4, seed=0):
+    """
+    Creates products that each allow every generated option, with defaults set
+
+    Returns the created products.
+    """
+    rng = random.Random(seed)
+
+    ice_choices = create_options(models.IceChoice, 'Ice', 3)
+    room_choices = create_options(models.RoomChoice, 'Room', 3)
+    temp_choices = create_options(models.TempChoice, 'Temp', 3)
+    foam_choices = create_options(models.FoamChoice, 'Foam', 3)
+    size_options = create_options(models.Size, 'Size', sizes)
+    milk_options = create_options(models.Milk, 'Milk', milks)
+    sweetener_options = create_options(models.Sweetener, 'Sweetener', sweeteners)
+    espresso_shot_options = create_options(models.EspressoShot, 'Espresso', espresso_shots)
+    juice_options = create_options(models.Juice, 'Juice', juices)
+    tea_options = create_options(models.Tea, 'Tea', teas)
+
+    flavor_category_options = create_options(models.FlavorCategory, 'Flavor Category', flavor_categories)
+    flavor_options = bulk_create(models.Flavor, (
+        models.Flavor(name='Flavor {}'.format(i + 1), category=flavor_category_options[i % flavor_categories])
+        for i in range(flavors)
+    ))
+
+    topping_choices = bulk_create(models.ToppingChoice, (
+        models.ToppingChoice(name=name) for name in TOPPING_CHOICE_NAMES))
+    topping_category_options = create_options(models.ToppingCategory, 'Topping Category', topping_categories)
+    topping_options = bulk_create(models.Topping, (
+        models.Topping(
+            name='Topping {}'.format(i + 1),
+            category=topping_category_options[i % topping_categories],
+            default_choice=topping_choices[2])
+        for i in range(toppings)
+    ))
+    bulk_create(models.Topping.allowed_choices.through, (
+        models.Topping.allowed_choices.through(topping_id=topping.pk, toppingchoice_id=choice.pk)
+        for topping in topping_options
+        for choice in topping_choices
+    ))
+
+    product_objs = bulk_create(models.Product, (
+        models.Product(name='Product {:05d}'.format(i + 1), price=Decimal(rng.randint(200, 600)) / 100)
+        for i in range(products)
+    ))
+
+    for m2m_name, options in (
+            ('allowed_ice', ice_choices),
+            ('allowed_room', room_choices),
+            ('allowed_milk_temps', temp_choices),
+            ('allowed_milk_foams', foam_choices)):
+        m2m_field = models.Product._meta.get_field(m2m_name)
+        through = m2m_field.remote_field.through
+        bulk_create(through, (
+            through(**{'product_id': product.pk, m2m_field.m2m_reverse_name(): option.pk})
+            for product in product_objs
+            for option in options
+        ))
+
+    def create_rows(model, option_field_name, options, **fields):
+        rows = bulk_create(model, (
+            model(product=product, **{option_field_name: option}, **fields)
+            for product in product_objs
+            for option in options
+        ))
+        return {
+            product.pk: rows[i * len(options):(i + 1) * len(options)]
+            for i, product in enumerate(product_objs)
+        }
+
+    product_sizes = bulk_create(models.ProductSize, (
+        models.ProductSize(
+            product=product,
+            size=size,
+            price=Decimal(i) / 2,
+            default_flavor_pumps=2 + i,
+            default_espresso_shots=1 + i // 2,
+            default_tea_quantity=1 + i // 2)
+        for product in product_objs
+        for i, size in enumerate(size_options)
+    ))
+    product_milks = create_rows(models.ProductMilk, 'milk', milk_options, price=Decimal('0.70'))
+    create_rows(models.ProductSweetener, 'sweetener', sweetener_options)
+    product_flavors = create_rows(models.ProductFlavor, 'flavor', flavor_options, price=Decimal('0.50'))
+    product_espresso_shots = create_rows(models.ProductEspressoShot, 'espresso_shot', espresso_shot_options)
+    create_rows(models.ProductJuice, 'juice', juice_options, price=Decimal('0.25'))
+    product_toppings = create_rows(models.ProductTopping, 'topping', topping_options, price=Decimal('0.40'))
+    create_rows(models.ProductTea, 'tea', tea_options, price=Decimal('0.30'))
+
+    for i, product in enumerate(product_objs):
+        product.default_ice = ice_choices[0]
+        product.default_room = room_choices[0]
+        product.default_milk_temp = temp_choices[0]
+        product.default_milk_foam = foam_choices[0]
+        product.default_size = product_sizes[i * sizes] if sizes else None
+        product.default_milk = product_milks[product.pk][0] if milks else None
+    models.Product.objects.bulk_update(
+        product_objs,
+        ['default_ice', 'default_room', 'default_milk_temp', 'default_milk_foam', 'default_size', 'default_milk'],
+        batch_size=500)
+
+    for m2m_name, rows_by_product in (
+            ('default_flavors', product_flavors),
+            ('default_espresso_shots', product_espresso_shots),
+            ('default_toppings', product_toppings)):
+        m2m_field = models.Product._meta.get_field(m2m_name)
+        through = m2m_field.remote_field.through
+        bulk_create(through, (
+            through(**{'product_id': product.pk, m2m_field.m2m_reverse_name(): rows_by_product[product.pk][0].pk})
+            for product in product_objs
+            if rows_by_product[product.pk]
+        ))
+
+    # bulk writes don't send the signals that invalidate the catalog caches
+    catalog.bulk_changed()
+    return product_objs
+
+
+def random_customization(product_id, product_options, rng, max_options=3):
+    """
+    Returns a valid CustomizedProductSerializer payload drawn from the product's allowed options
+    """
+    item = {'product': product_id}
+    for field_name, _ in orders.CHOICE_FIELDS + orders.PRODUCT_ROW_FIELDS:
+        item[field_name] = rng.choice(sorted(product_options[field_name]))
+    for field_name, _, row_field_name, _ in orders.OPTION_FIELDS:
+        allowed = sorted(product_options[field_name])
+        item[field_name] = [
+            {row_field_name: row_id, 'quantity': rng.randint(1, 4)}
+            for row_id in rng.sample(allowed, min(len(allowed), rng.randint(0, max_options)))
+        ]
+    return item
+
+
+def orderable_products(index):
+    """
+    Returns the ids of the products in the option index that have every required option
+    """
+    required = [field_name for field_name, _ in orders.CHOICE_FIELDS + orders.PRODUCT_ROW_FIELDS]
+    return sorted(
+        product_id for product_id, product_options in index.products.items()
+        if all(product_options[field_name] for field_name in required)
+    )
+
+
+def generate_orders(count, days=30, batch_size=500, seed=0):
+    """
+    Creates count random valid customized products spread over the last days
+
+    Returns the ids of the created customized products.
+    """
+    rng = random.Random(seed)
+    index = option_index.get_index()
+    product_ids = orderable_products(index)
+    if not product_ids:
+        raise ValueError("The catalog has no products that can be ordered")
+
+    now = timezone.now()
+    span = int(timedelta(days=days).total_seconds())
+    created = []
+    for start in range(0, count, batch_size):
+        items = []
+        for _ in range(min(batch_size, count - start)):
+            product_id = rng.choice(product_ids)
+            item = random_customization(product_id, index.get(product_id), rng)
+            item['created_at'] = now - timedelta(seconds=rng.randint(0, span))
+            items.append(item)
+        created.extend(customized_product.pk for customized_product in orders.create_customized_products(items))
+    return created
@@ -1,3 +1,1395 @@
-from django.test import TestCase
+import asyncio
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import random
+import runpy
+import tempfile
+import time
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.asgi import ASGIHandler
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.core.servers.basehttp import WSGIServer
+from django.core.signals import request_finished, request_started
+from django.db import connection
+from django.http import HttpResponse
+from django.test import (
+    Client, LiveServerTestCase, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+from django.test.testcases import LiveServerThread, QuietWSGIRequestHandler
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    admin, artifacts, asgi, catalog, catalog_io, defaults, export, loadtest, metrics, models, option_index, order_queue,
+    orders, pricing, reports, rollups, routers, snapshots, synthetic,
+)
+
+
+def run_commit_callbacks():
+    """
+    Runs the on_commit callbacks the TestCase transaction holds back, as its commit would
+
+    E.g. the catalog's, which write the change log and send catalog_committed.
+    """
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for _, callback in callbacks:
+        callback()
+
+
+def create_product(name, price=3):
+    """
+    Creates an active product that allows (and defaults to) one of every option
+    """
+    product = models.Product.objects.create(name=name, price=price)
+
+    ice = models.IceChoice.objects.create(name='Light Ice')
+    room = models.RoomChoice.objects.create(name='No Room')
+    temp = models.TempChoice.objects.create(name='Hot')
+    foam = models.FoamChoice.objects.create(name='Extra Foam')
+    product.allowed_ice.add(ice)
+    product.allowed_room.add(room)
+    product.allowed_milk_temps.add(temp)
+    product.allowed_milk_foams.add(foam)
+
+    product_size = models.ProductSize.objects.create(
+        product=product,
+        size=models.Size.objects.create(name='Grande'),
+        price=1,
+        default_flavor_pumps=4,
+        default_espresso_shots=2,
+        default_tea_quantity=1)
+    product_milk = models.ProductMilk.objects.create(
+        product=product, milk=models.Milk.objects.create(name='Oat'), price='0.70')
+    product_sweetener = models.ProductSweetener.objects.create(
+        product=product, sweetener=models.Sweetener.objects.create(name='Honey'))
+    product_flavor = models.ProductFlavor.objects.create(
+        product=product,
+        flavor=models.Flavor.objects.create(
+            name='Vanilla',
+            category=models.FlavorCategory.objects.create(name='Syrups')),
+        price='0.50')
+    product_espresso_shot = models.ProductEspressoShot.objects.create(
+        product=product, espresso_shot=models.EspressoShot.objects.create(name='Blonde'))
+    product_juice = models.ProductJuice.objects.create(
+        product=product, juice=models.Juice.objects.create(name='Lemonade'), price='0.25')
+    topping = models.Topping.objects.create(
+        name='Whipped Cream',
+        category=models.ToppingCategory.objects.create(name='Cream'),
+        default_choice=models.ToppingChoice.objects.create(name='Regular'))
+    topping.allowed_choices.add(topping.default_choice, models.ToppingChoice.objects.create(name='Extra'))
+    product_topping = models.ProductTopping.objects.create(product=product, topping=topping, price='0.40')
+    product_tea = models.ProductTea.objects.create(
+        product=product, tea=models.Tea.objects.create(name='Chai'), price='0.30')
+
+    product.default_ice = ice
+    product.default_room = room
+    product.default_milk_temp = temp
+    product.default_milk_foam = foam
+    product.default_size = product_size
+    product.default_milk = product_milk
+    product.save()
+    product.default_sweeteners.add(product_sweetener)
+    product.default_flavors.add(product_flavor)
+    product.default_espresso_shots.add(product_espresso_shot)
+    product.default_juices.add(product_juice)
+    product.default_toppings.add(product_topping)
+    product.default_teas.add(product_tea)
+    return product
+
+
+class ProductListAPIViewTestCase(TestCase):
+    # one query for the products plus one per prefetched relation
+    query_budget = 21
+
+    def setUp(self):
+        cache.clear()
+
+    def test_query_count_does_not_grow_with_catalog(self):
+        create_product('Latte')
+        with self.assertNumQueries(self.query_budget):
+            response = self.client.get(reverse('vue_form_products'))
+        self.assertEqual(len(response.json()), 1)
+
+        for i in range(10):
+            create_product('Mocha {}'.format(i))
+        with self.assertNumQueries(self.query_budget):
+            response = self.client.get(reverse('vue_form_products'))
+        self.assertEqual(len(response.json()), 11)
+
+    def test_menu_is_served_from_cache(self):
+        create_product('Latte')
+        first = self.client.get(reverse('vue_form_products'))
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse('vue_form_products'))
+        self.assertEqual(first.content, second.content)
+
+    def test_catalog_changes_invalidate_menu(self):
+        product = create_product('Latte')
+        self.client.get(reverse('vue_form_products'))
+
+        version = catalog.get_version()
+        product_size = product.default_size
+        product_size.price = 2
+        product_size.save()
+        self.assertGreater(catalog.get_version(), version)
+        data = self.client.get(reverse('vue_form_products')).json()
+        self.assertEqual(data[0]['default_size']['price'], '2.00')
+
+        product.allowed_ice.add(models.IceChoice.objects.create(name='Extra Ice'))
+        data = self.client.get(reverse('vue_form_products')).json()
+        self.assertEqual(len(data[0]['allowed_ice']), 2)
+
+        milk = product.default_milk.milk
+        milk.name = 'Oatly'
+        milk.save()
+        data = self.client.get(reverse('vue_form_products')).json()
+        self.assertEqual(data[0]['default_milk']['milk']['name'], 'Oatly')
+
+    def production_settings(self, **environ):
+        with mock.patch.dict(os.environ, DATABASE_URL='sqlite:///prod.sqlite3'):
+            for name in ('DJANGO_CACHE_BACKEND', 'DJANGO_SINGLE_PROCESS'):
+                os.environ.pop(name, None)
+            os.environ.update(environ)
+            return runpy.run_module('backend.settings.prod')
+
+    def test_production_settings_refuse_a_per_process_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.production_settings()
+        self.production_settings(DJANGO_SINGLE_PROCESS='1')
+        memcached = 'django.core.cache.backends.memcached.MemcachedCache'
+        self.assertEqual(
+            self.production_settings(DJANGO_CACHE_BACKEND=memcached)['CACHES']['default']['BACKEND'], memcached)
+
+    def test_sparse_fieldsets_only_query_selected_relations(self):
+        for name in ('Latte', 'Mocha', 'Americano'):
+            create_product(name)
+        # products, then the milk relations that aren't joined in
+        with self.assertNumQueries(4):
+            response = self.client.get(
+                reverse('vue_form_products'), {'fields': 'default_size', 'include': 'milks'})
+        data = response.json()['results']
+        self.assertEqual([product['name'] for product in data], ['Americano', 'Latte', 'Mocha'])
+        self.assertEqual(
+            set(data[0]),
+            {'id', 'name', 'price', 'is_active', 'default_size', 'allowed_milks', 'default_milk',
+             'allowed_milk_temps', 'default_milk_temp', 'allowed_milk_foams', 'default_milk_foam'})
+        self.assertEqual(data[0]['default_size']['size']['name'], 'Grande')
+        self.assertEqual(data[0]['default_size']['product'], data[0]['id'])
+
+        response = self.client.get(reverse('vue_form_products'), {'include': 'cups'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor_pagination_by_name(self):
+        for name in ('Mocha', 'Latte', 'Americano'):
+            create_product(name)
+        names = []
+        url = reverse('vue_form_products') + '?page_size=2&fields=name'
+        while url:
+            page = self.client.get(url).json()
+            names.extend(product['name'] for product in page['results'])
+            url = page['next']
+        self.assertEqual(names, ['Americano', 'Latte', 'Mocha'])
+
+    def test_nested_default_rows_render_their_product(self):
+        product = create_product('Latte')
+        data = self.client.get(reverse('vue_form_products')).json()[0]
+        self.assertEqual(data['default_milk']['product']['id'], product.pk)
+        self.assertEqual(data['default_milk']['milk']['name'], 'Oat')
+        self.assertEqual(data['default_toppings'][0]['topping']['category']['name'], 'Cream')
+        self.assertEqual(len(data['default_toppings'][0]['topping']['allowed_choices']), 2)
+
+
+class MenuArtifactTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        settings_override = override_settings(MENU_ARTIFACTS=True, STATIC_ROOT=self.make_static_root())
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        create_product('Latte')
+
+    def make_static_root(self):
+        static_root = tempfile.TemporaryDirectory()
+        self.addCleanup(static_root.cleanup)
+        return static_root.name
+
+    def test_menu_redirects_to_precompressed_immutable_file(self):
+        response = self.client.get(reverse('vue_form_products'))
+        self.assertEqual(response.status_code, 302)
+        url = response['Location']
+        self.assertRegex(url, r'^/static/menu/products\.[0-9a-f]{12}\.json$')
+
+        # served by WhiteNoise although written after it started
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), catalog.get_menu())
+
+    def test_servers_without_the_file_write_their_own(self):
+        url = self.client.get(reverse('vue_form_products'))['Location']
+        # other servers have a STATIC_ROOT of their own, the URL is shared through the cache
+        with override_settings(STATIC_ROOT=self.make_static_root()):
+            self.assertEqual(Client().get(reverse('vue_form_products'))['Location'], url)
+            self.assertTrue(os.path.isfile(artifacts.artifact_path(url)))
+        with override_settings(STATIC_ROOT=self.make_static_root()):
+            response = Client().get(url, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), catalog.get_menu())
+
+    @override_settings(WHITENOISE_AUTOREFRESH=True)
+    def test_middleware_keeps_the_latest_artifacts(self):
+        middleware = artifacts.WhiteNoiseMiddleware(lambda request: HttpResponse(status=404))
+        urls = []
+        for i in range(artifacts.SERVED_ARTIFACTS + 1):
+            create_product('Mocha {}'.format(i))
+            run_commit_callbacks()
+            urls.append(artifacts.current_artifact_url())
+            response = middleware(RequestFactory().get(urls[-1]))
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(list(middleware.artifacts), urls[1:])
+
+        call_command('write_menu_artifact', prune=1, stdout=io.StringIO())
+        self.assertEqual(middleware(RequestFactory().get(urls[-2])).status_code, 404)
+        self.assertNotIn(urls[-2], middleware.artifacts)
+
+    def test_catalog_commit_writes_a_new_artifact(self):
+        url = self.client.get(reverse('vue_form_products'))['Location']
+        create_product('Mocha')
+        run_commit_callbacks()
+        with self.assertNumQueries(0):
+            new_url = self.client.get(reverse('vue_form_products'))['Location']
+        self.assertNotEqual(new_url, url)
+
+        output = io.StringIO()
+        call_command('write_menu_artifact', prune=1, stdout=output)
+        self.assertEqual(output.getvalue().split('\n')[:2], [new_url, 'Deleted ' + url.rsplit('/', 1)[1]])
+
+
+class MenuAPIViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_shared_options_are_listed_once(self):
+        latte = create_product('Latte')
+        mocha = create_product('Mocha')
+        oat = latte.default_milk.milk
+        mocha_oat = models.ProductMilk.objects.create(product=mocha, milk=oat, price='0.60')
+
+        data = self.client.get(reverse('menu')).json()
+        self.assertEqual([product['name'] for product in data['products']], ['Latte', 'Mocha'])
+        self.assertEqual(data['milks'][str(oat.pk)], {'id': oat.pk, 'name': 'Oat'})
+        self.assertEqual(len(data['milks']), 2)
+
+        mocha_data = data['products'][1]
+        self.assertIn(
+            {'id': mocha_oat.pk, 'milk': oat.pk, 'price': '0.60', 'is_active': True},
+            mocha_data['milks'])
+        self.assertEqual(mocha_data['default_size'], mocha.default_size.pk)
+        self.assertEqual(mocha_data['default_toppings'], [mocha.default_toppings.get().pk])
+
+        topping = data['toppings'][str(mocha.default_toppings.get().topping_id)]
+        for choice_id in topping['allowed_choices']:
+            self.assertIn(str(choice_id), data['topping_choices'])
+
+
+class MenuChangesAPIViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def get_changes(self, since):
+        return self.client.get(reverse('menu_changes'), {'since': since})
+
+    def test_only_changes_since_the_version_are_sent(self):
+        latte = create_product('Latte')
+        mocha = create_product('Mocha')
+        run_commit_callbacks()
+        version = self.client.get(reverse('menu')).json()['version']
+
+        data = self.get_changes(version).json()
+        self.assertEqual(data['version'], version)
+        self.assertEqual((data['products'], data['rows'], data['sizes']), ([], {}, {}))
+
+        product_size = latte.default_size
+        product_size.price = '1.50'
+        product_size.save()
+        run_commit_callbacks()
+        data = self.get_changes(version).json()
+        self.assertEqual(data['products'], [])
+        self.assertEqual(data['rows']['sizes'][0]['price'], '1.50')
+        self.assertEqual(data['rows']['sizes'][0]['product'], latte.pk)
+        self.assertEqual(list(data['sizes']), [str(product_size.size_id)])
+        self.assertEqual(data['milks'], {})
+
+        version = data['version']
+        mocha.is_active = False
+        mocha.save()
+        americano = create_product('Americano')
+        milk = latte.default_milk.milk
+        milk.name = 'Oatly'
+        milk.save()
+        run_commit_callbacks()
+        data = self.get_changes(version).json()
+        self.assertEqual([product['name'] for product in data['products']], ['Americano'])
+        self.assertEqual(data['deactivated_products'], [mocha.pk])
+        # the new product's options come with it
+        self.assertIn(str(americano.default_size.size_id), data['sizes'])
+        self.assertEqual(data['milks'][str(milk.pk)]['name'], 'Oatly')
+        self.assertEqual(data['rows'], {})
+
+        latte.allowed_ice.clear()
+        run_commit_callbacks()
+        data = self.get_changes(data['version']).json()
+        self.assertEqual([product['allowed_ice'] for product in data['products']], [[]])
+
+    def test_changes_are_cached_per_version(self):
+        create_product('Latte')
+        version = self.client.get(reverse('menu')).json()['version']
+        self.get_changes(version)
+        with self.assertNumQueries(0):
+            self.get_changes(version)
+
+    def test_cached_changes_expire(self):
+        create_product('Latte')
+        version = self.client.get(reverse('menu')).json()['version']
+        with mock.patch.object(catalog, 'MENU_CHANGES_TIMEOUT', -1):
+            self.get_changes(version)
+        self.assertIsNone(cache.get('{}:{}'.format(catalog.MENU_CHANGES_KEY, version)))
+
+    def test_unlogged_changes_require_a_full_reload(self):
+        create_product('Latte')
+        run_commit_callbacks()
+        version = catalog.get_changes_version()
+        self.assertEqual(self.get_changes(version + 1).status_code, 410)
+        self.assertEqual(self.get_changes('latest').status_code, 400)
+
+        call_command('prune_catalog_changes', days=0, stdout=io.StringIO())
+        self.assertEqual(self.get_changes(0).status_code, 410)
+        self.assertEqual(self.get_changes(version).status_code, 200)
+
+        catalog.bulk_changed()
+        run_commit_callbacks()
+        self.assertEqual(self.get_changes(version).status_code, 410)
+
+
+def customized_product_data(product):
+    """
+    Returns a valid CustomizedProductSerializer payload using the product's defaults
+    """
+    return {
+        'product': product.pk,
+        'ice': product.default_ice_id,
+        'room': product.default_room_id,
+        'size': product.default_size_id,
+        'milk': product.default_milk_id,
+        'milk_temp': product.default_milk_temp_id,
+        'milk_foam': product.default_milk_foam_id,
+        'sweeteners': [{'product_sweetener': row.pk, 'quantity': 1} for row in product.default_sweeteners.all()],
+        'espresso_shots': [
+            {'product_espresso_shot': row.pk, 'quantity': 2} for row in product.default_espresso_shots.all()],
+        'toppings': [{'product_topping': row.pk, 'quantity': 1} for row in product.default_toppings.all()],
+        'flavors': [{'product_flavor': row.pk, 'quantity': 3} for row in product.default_flavors.all()],
+        'juices': [{'product_juice': row.pk, 'quantity': 1} for row in product.default_juices.all()],
+        'teas': [{'product_tea': row.pk, 'quantity': 1} for row in product.default_teas.all()],
+    }
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ProductAdminTestCase(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', None))
+        self.latte = create_product('Latte')
+        self.url = reverse('admin:api_product_change', args=[self.latte.pk])
+
+    def add_flavors(self, count):
+        category = models.FlavorCategory.objects.create(name='More Syrups')
+        for i in range(count):
+            flavor = models.Flavor.objects.create(name='Flavor {}'.format(i), category=category)
+            models.ProductFlavor.objects.create(product=self.latte, flavor=flavor, price='0.50')
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_the_options(self):
+        self.add_flavors(2)
+        queries = self.count_queries()
+        self.add_flavors(10)
+        self.assertEqual(self.count_queries(), queries)
+
+    def test_large_option_tables_use_autocomplete(self):
+        self.add_flavors(2)
+        with mock.patch.object(admin, 'CHOICES_LIMIT', 2):
+            response = self.client.get(self.url)
+        self.assertContains(response, 'admin-autocomplete')
+        # each of the two rows only renders its selected flavor, plus the default_flavors list
+        self.assertContains(response, 'More Syrups</option>', count=4)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class CustomizedProductAdminTestCase(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', None))
+        self.latte = create_product('Latte')
+        self.url = reverse('admin:api_customizedproduct_changelist')
+
+    def create_orders(self, count):
+        self.client.post(
+            reverse('customized_product_batch'),
+            [customized_product_data(self.latte)] * count,
+            content_type='application/json')
+
+    def test_changelist_query_count_does_not_grow_with_the_rows(self):
+        self.create_orders(2)
+        # session, user, count and page, the options come from the snapshots
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url)
+        self.assertContains(response, 'Vanilla x 3')
+        self.assertContains(response, '7.15')
+
+        self.create_orders(20)
+        with self.assertNumQueries(4):
+            self.client.get(self.url, {'created_at__gte': timezone.now().date().isoformat()})
+
+    def test_unfiltered_count_is_estimated(self):
+        self.create_orders(2)
+        with mock.patch.object(admin, 'estimated_count', return_value=admin.ESTIMATED_COUNT_THRESHOLD):
+            response = self.client.get(self.url)
+            self.assertEqual(response.context['cl'].result_count, admin.ESTIMATED_COUNT_THRESHOLD)
+            # filtered lists are counted exactly
+            response = self.client.get(self.url, {'created_at__gte': timezone.now().date().isoformat()})
+            self.assertEqual(response.context['cl'].result_count, 2)
+
+
+class CustomizedProductBatchAPIViewTestCase(TestCase):
+    def test_creates_batch(self):
+        latte = create_product('Latte')
+        mocha = create_product('Mocha')
+        data = [customized_product_data(latte), customized_product_data(mocha), customized_product_data(latte)]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('customized_product_batch'), data, content_type='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+        ids = [item['id'] for item in response.json()]
+        self.assertEqual(len(ids), 3)
+        # every option of the batch goes into the options table in one statement
+        option_inserts = [
+            query for query in queries if query['sql'].startswith('INSERT INTO "api_customizedproductoption"')]
+        self.assertEqual(len(option_inserts), 1)
+        self.assertEqual(response.json()[0]['total'], '7.15')
+
+        customized_product = models.CustomizedProduct.objects.get(pk=ids[1])
+        self.assertEqual(customized_product.product, mocha)
+        self.assertEqual(customized_product.size, mocha.default_size)
+        flavor = customized_product.options.get(option_type='flavors')
+        self.assertEqual(flavor.product_flavor, mocha.default_flavors.get())
+        self.assertEqual(flavor.quantity, 3)
+        self.assertEqual(list(customized_product.flavors.all()), [mocha.default_flavors.get()])
+        self.assertEqual(models.CustomizedProductTopping.objects.count(), 3)
+        self.assertEqual(models.CustomizedProductFlavor.objects.get(pk=flavor.pk).quantity, 3)
+
+    def test_rejects_whole_batch_when_an_item_is_invalid(self):
+        latte = create_product('Latte')
+        mocha = create_product('Mocha')
+        invalid = customized_product_data(latte)
+        invalid['milk'] = mocha.default_milk_id
+        invalid['flavors'] = [{'product_flavor': mocha.default_flavors.get().pk, 'quantity': 1}]
+
+        response = self.client.post(
+            reverse('customized_product_batch'),
+            [customized_product_data(mocha), invalid],
+            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()
+        self.assertEqual(errors[0], {})
+        self.assertEqual(set(errors[1]), {'milk', 'flavors'})
+        self.assertFalse(models.CustomizedProduct.objects.exists())
+
+    def test_rejects_inactive_options(self):
+        latte = create_product('Latte')
+        for product_topping in models.ProductTopping.objects.filter(product=latte):
+            product_topping.is_active = False
+            product_topping.save()
+
+        response = self.client.post(
+            reverse('customized_product_batch'), [customized_product_data(latte)], content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('toppings', response.json()[0])
+
+
+@override_settings(ALLOWED_HOSTS=[loadtest.HOST, 'testserver'])
+class NativeASGITestCase(TransactionTestCase):
+    # the native handlers use the database from the thread pool
+    def setUp(self):
+        cache.clear()
+        asgi.menu.clear()
+        asgi.normalized_menu.clear()
+        self.application = asgi.get_application(ASGIHandler())
+        self.latte = create_product('Latte')
+
+    def tearDown(self):
+        cache.clear()
+
+    def request(self, application, method, path, data=None, headers=()):
+        body = b''
+        if data is not None:
+            body = data if isinstance(data, bytes) else json.dumps(data).encode('utf-8')
+            headers = (('Content-Type', 'application/json'),) + tuple(headers)
+        return async_to_sync(loadtest.call_asgi)(application, method, path, body, headers)
+
+    def test_menus_match_django(self):
+        for url_name in ('vue_form_products', 'menu'):
+            status, content = self.request(self.application, 'GET', reverse(url_name))
+            self.assertEqual(status, 200)
+            self.assertEqual(content, self.client.get(reverse(url_name)).content)
+
+    def test_menu_snapshot_is_refreshed(self):
+        self.request(self.application, 'GET', reverse('menu'))
+        models.Product.objects.create(name='Mocha', price=4)
+        with mock.patch.object(asgi.normalized_menu, 'max_age', 0):
+            _, content = self.request(self.application, 'GET', reverse('menu'))
+        self.assertIn(b'Mocha', content)
+
+    def test_menu_snapshot_renders_once_for_concurrent_requests(self):
+        rendered = []
+        signals_sent = []
+
+        def render():
+            rendered.append(signals_sent[:])
+            time.sleep(0.05)
+            return b'menu'
+
+        def record(signal, **kwargs):
+            signals_sent.append(signal)
+
+        snapshot = asgi.MenuSnapshot(render)
+        for signal in (request_started, request_finished):
+            signal.connect(record)
+            self.addCleanup(signal.disconnect, record)
+
+        async def get_menus():
+            return await asyncio.gather(*(snapshot.get() for _ in range(3)))
+        self.assertEqual(async_to_sync(get_menus)(), [b'menu'] * 3)
+        # the render's connection is managed like a request's
+        self.assertEqual(rendered, [[request_started]])
+        self.assertEqual(signals_sent, [request_started, request_finished])
+
+    def test_create_customized_products(self):
+        status, content = self.request(
+            self.application, 'POST', reverse('customized_product_batch'), [customized_product_data(self.latte)] * 2)
+        self.assertEqual(status, 201)
+        self.assertEqual([item['total'] for item in json.loads(content.decode())], ['7.15', '7.15'])
+        self.assertEqual(models.CustomizedProduct.objects.count(), 2)
+
+        data = customized_product_data(self.latte)
+        data['ice'] = 0
+        status, content = self.request(self.application, 'POST', reverse('customized_product_batch'), [data])
+        self.assertEqual(status, 400)
+        django_response = self.client.post(reverse('customized_product_batch'), [data], content_type='application/json')
+        self.assertEqual(json.loads(content.decode()), django_response.json())
+
+        status, _ = self.request(self.application, 'POST', reverse('customized_product_batch'), b'[{')
+        self.assertEqual(status, 400)
+
+    @override_settings(ORDER_QUEUE=True)
+    def test_order_queue_goes_to_django(self):
+        status, content = self.request(
+            self.application, 'POST', reverse('customized_product_batch'), [customized_product_data(self.latte)],
+            headers=(('Idempotency-Key', 'order-1'),))
+        self.assertEqual(status, 202, content)
+        self.assertEqual(models.QueuedOrder.objects.get().key, 'order-1')
+        self.assertFalse(models.CustomizedProduct.objects.exists())
+
+    def test_unhandled_requests_go_to_django(self):
+        django_paths = []
+        django_application = ASGIHandler()
+
+        async def recording_application(scope, receive, send):
+            django_paths.append(scope['path'])
+            await django_application(scope, receive, send)
+
+        application = asgi.get_application(recording_application)
+        self.request(application, 'GET', reverse('menu'))
+        # sessions need DRF's CSRF checks
+        self.request(
+            application, 'POST', reverse('customized_product_batch'), [customized_product_data(self.latte)],
+            headers=(('Cookie', 'sessionid=abc'),))
+        self.request(application, 'GET', reverse('order_history'))
+        self.assertEqual(django_paths, [reverse('customized_product_batch'), reverse('order_history')])
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTestCase(TestCase):
+    def test_router(self):
+        self.assertEqual(models.Product.objects.all().db, 'default')
+        with routers.replica_reads():
+            self.assertEqual(models.Product.objects.all().db, 'replica')
+            with routers.primary():
+                self.assertEqual(models.Product.objects.all().db, 'default')
+            # read-your-writes for the rest of the block
+            models.Size.objects.create(name='Venti')
+            self.assertEqual(models.Product.objects.all().db, 'default')
+        with routers.replica_reads():
+            self.assertEqual(models.Product.objects.all().db, 'replica')
+
+    def test_views_read_from_replicas_until_the_client_writes(self):
+        latte = create_product('Latte')
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', None))
+        # the mirrored test database stands in for the replica
+        with mock.patch.object(routers, 'get_replica', return_value='default') as get_replica:
+            self.client.get(reverse('order_history'))
+            self.assertTrue(get_replica.called)
+
+            response = self.client.post(
+                reverse('customized_product_batch'), [customized_product_data(latte)], content_type='application/json')
+            self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], settings.DATABASE_REPLICA_LAG)
+            get_replica.reset_mock()
+            response = self.client.get(reverse('order_history'))
+            self.assertEqual(len(response.json()['results']), 1)
+            self.assertFalse(get_replica.called)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry.clear()
+
+    def test_server_timing_header(self):
+        create_product('Latte')
+        response = self.client.get(reverse('vue_form_products'), {'fields': 'name'})
+        timings = dict(entry.split(';', 1) for entry in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timings), {'db', 'serialize', 'render', 'total'})
+        self.assertIn('desc="1 queries"', timings['db'])
+
+    def test_prometheus_histograms(self):
+        create_product('Latte')
+        self.client.get(reverse('vue_form_products'))
+        self.client.get(reverse('vue_form_products'))
+        self.client.get(reverse('menu'))
+
+        response = self.client.get(reverse('metrics'))
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.content.decode().splitlines()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', lines)
+        self.assertIn('http_request_duration_seconds_count{endpoint="vue_form_products",method="GET"} 2', lines)
+        self.assertIn('http_request_render_seconds_count{endpoint="menu",method="GET"} 1', lines)
+        # the second request is served from the cache
+        self.assertIn('http_request_db_queries_bucket{endpoint="vue_form_products",method="GET",le="0"} 1', lines)
+        self.assertFalse([line for line in lines if 'endpoint="metrics"' in line])
+
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 404)
+
+
+class PricingTestCase(TestCase):
+    def test_compute_totals_with_fixed_query_count(self):
+        latte = create_product('Latte')
+        mocha = create_product('Mocha', price=4)
+        response = self.client.post(
+            reverse('customized_product_batch'),
+            [customized_product_data(latte), customized_product_data(mocha)] * 5,
+            content_type='application/json')
+        ids = [item['id'] for item in response.json()]
+
+        with self.assertNumQueries(2):
+            totals = pricing.compute_totals(ids)
+        # base + size + milk + 3 flavor pumps + topping + juice + tea
+        self.assertEqual(totals[ids[0]], Decimal('7.15'))
+        self.assertEqual(totals[ids[1]], Decimal('8.15'))
+        self.assertEqual(
+            dict(models.CustomizedProduct.objects.filter(pk__in=ids).values_list('pk', 'total')), totals)
+
+    def test_totals_keep_the_price_at_order_time(self):
+        latte = create_product('Latte')
+        response = self.client.post(
+            reverse('customized_product_batch'), [customized_product_data(latte)], content_type='application/json')
+        models.Product.objects.filter(pk=latte.pk).update(price=10)
+        customized_product = models.CustomizedProduct.objects.get(pk=response.json()[0]['id'])
+        self.assertEqual(customized_product.total, Decimal('7.15'))
+
+
+class RollupsTestCase(TestCase):
+    def tearDown(self):
+        cache.clear()
+
+    def rollup_rows(self):
+        return (
+            sorted(models.ProductSalesRollup.objects.values_list(
+                'hour', 'product', 'size', 'count', 'total', 'espresso_shots')),
+            sorted(models.OptionSalesRollup.objects.values_list(
+                'hour', 'option_type', 'option_id', 'product', 'count', 'quantity')),
+        )
+
+    def test_order_writes_update_the_rollups(self):
+        product = create_product('Latte')
+        data = customized_product_data(product)
+        self.client.post(reverse('customized_product_batch'), [data, data], content_type='application/json')
+
+        rollup = models.ProductSalesRollup.objects.get()
+        self.assertEqual((rollup.product, rollup.size, rollup.count), (product, product.default_size, 2))
+        self.assertEqual(rollup.total, sum(models.CustomizedProduct.objects.values_list('total', flat=True)))
+        self.assertEqual(rollup.espresso_shots, 4)
+        self.assertEqual(rollup.hour, rollups.truncate_hour(models.CustomizedProduct.objects.first().created_at))
+
+        milk = models.OptionSalesRollup.objects.get(option_type='milk')
+        self.assertEqual((milk.option_id, milk.count, milk.quantity), (product.default_milk.milk_id, 2, 2))
+        flavor = models.OptionSalesRollup.objects.get(option_type='flavors')
+        self.assertEqual(
+            (flavor.option_id, flavor.count, flavor.quantity), (product.default_flavors.get().flavor_id, 2, 6))
+
+    def test_rows_missing_from_the_index_are_read_in_one_query(self):
+        product = create_product('Latte')
+        items = [customized_product_data(product)]
+        empty = option_index.OptionIndex(None, {}, {})
+        with self.assertNumQueries(1):
+            row_options = rollups.get_row_options(items, empty)
+        self.assertEqual(row_options['milk'], {product.default_milk_id: product.default_milk.milk_id})
+        self.assertEqual(
+            row_options['flavors'], {product.default_flavors.get().pk: product.default_flavors.get().flavor_id})
+
+    def test_rebuild_matches_the_incremental_rollups(self):
+        synthetic.generate_catalog(products=3, sizes=2, milks=2, flavors=4, toppings=3, seed=1)
+        synthetic.generate_orders(60, days=1, batch_size=25)
+        incremental = self.rollup_rows()
+        self.assertTrue(incremental[0])
+
+        output = io.StringIO()
+        call_command('rebuild_rollups', stdout=output)
+        self.assertEqual(self.rollup_rows(), incremental)
+        self.assertEqual(
+            output.getvalue().strip(),
+            '{} product and {} option rollup rows'.format(len(incremental[0]), len(incremental[1])))
+
+    def admin_form_data(self, response):
+        """
+        The POST data of an admin change form as rendered
+        """
+        data = {}
+        forms = [response.context['adminform'].form]
+        for inline in response.context['inline_admin_formsets']:
+            forms.append(inline.formset.management_form)
+            forms.extend(inline.formset.forms)
+        for form in forms:
+            for name, field in form.fields.items():
+                value = form[name].value()
+                if value is None or value is False:
+                    continue
+                if isinstance(value, datetime.datetime):
+                    data[form.add_prefix(name) + '_0'] = value.date().isoformat()
+                    data[form.add_prefix(name) + '_1'] = value.time().isoformat()
+                else:
+                    data[form.add_prefix(name)] = value
+        return data
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_edits_update_the_rollups(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', None))
+        product = create_product('Latte')
+        data = customized_product_data(product)
+        self.client.post(reverse('customized_product_batch'), [data, data], content_type='application/json')
+        customized_product = models.CustomizedProduct.objects.first()
+
+        url = reverse('admin:api_customizedproduct_change', args=[customized_product.pk])
+        form_data = self.admin_form_data(self.client.get(url))
+        # the flavors inline comes first
+        form_data['options-0-quantity'] = 5
+        response = self.client.post(url, form_data)
+        self.assertEqual(response.status_code, 302, response.context and response.context['errors'])
+        self.assertEqual(customized_product.options.get(option_type='flavors').quantity, 5)
+        edited = self.rollup_rows()
+        flavor = models.OptionSalesRollup.objects.get(option_type='flavors')
+        self.assertEqual((flavor.count, flavor.quantity), (2, 8))
+        rollups.rebuild()
+        self.assertEqual(self.rollup_rows(), edited)
+
+
+class ReportsTestCase(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', None))
+
+    def tearDown(self):
+        cache.clear()
+
+    def get_report(self, name, **params):
+        response = self.client.get(reverse('report', args=[name]), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_reports(self):
+        product = create_product('Latte')
+        data = customized_product_data(product)
+        self.client.post(reverse('customized_product_batch'), [data, data], content_type='application/json')
+        size = product.default_size
+
+        [flavor] = self.get_report('top-options', option_type='flavors')
+        self.assertEqual(
+            (flavor['name'], flavor['rank'], flavor['customized_products'], flavor['units']),
+            (product.default_flavors.get().flavor.name, 1, 2, 6))
+        [row] = self.get_report('revenue-by-size')
+        self.assertEqual((row['size'], row['customized_products'], row['revenue_share']), (size.pk, 2, 1.0))
+        self.assertEqual(
+            Decimal(str(row['revenue'])), sum(models.CustomizedProduct.objects.values_list('total', flat=True)))
+        [milk] = self.get_report('milk-mix')
+        self.assertEqual((milk['name'], milk['customized_products_share']), (product.default_milk.milk.name, 1.0))
+        [row] = self.get_report('espresso-shots', product=product.pk)
+        self.assertEqual(
+            (row['default_espresso_shots'], row['average_espresso_shots']), (size.default_espresso_shots, 2.0))
+        self.assertEqual(self.get_report('espresso-shots', start='2000-01-01', end='2000-01-02'), [])
+
+    def test_reports_are_cached(self):
+        product = create_product('Latte')
+        self.client.post(
+            reverse('customized_product_batch'), [customized_product_data(product)], content_type='application/json')
+        rows = reports.get_report('milk-mix', {})
+        with self.assertNumQueries(0):
+            self.assertEqual(reports.get_report('milk-mix', {}), rows)
+        self.assertNotEqual(reports.get_report('milk-mix', {'product': product.pk + 1}), rows)
+
+    def test_unknown_report_and_permissions(self):
+        self.assertEqual(self.client.get(reverse('report', args=['nope'])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('report', args=['milk-mix']), {'limit': 0}).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('report', args=['milk-mix'])).status_code, 403)
+
+
+class CatalogIOTestCase(TestCase):
+    def tearDown(self):
+        cache.clear()
+
+    def import_catalog(self, document, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            json.dump(document, f)
+            f.flush()
+            output = io.StringIO()
+            call_command('import_catalog', f.name, *args, stdout=output)
+        return output.getvalue()
+
+    def test_export_round_trips(self):
+        create_product('Latte')
+        document = json.loads(json.dumps(catalog_io.export_catalog()))
+        [entry] = document['products']
+        self.assertEqual((entry['default_size'], entry['default_flavors']), ('Grande', [['Syrups', 'Vanilla']]))
+        self.assertEqual(catalog_io.import_catalog(document), [])
+
+    def test_import(self):
+        latte = create_product('Latte')
+        document = json.loads(json.dumps(catalog_io.export_catalog()))
+        document['sizes'].append('Venti')
+        entry = document['products'][0]
+        entry['price'] = '3.25'
+        entry['sizes'].append({'size': 'Venti', 'price': '1.50', 'default_espresso_shots': 3})
+        entry['default_size'] = 'Venti'
+        entry['teas'] = entry['default_teas'] = []
+        document['products'].append(dict(entry, name='Mocha'))
+        changes = models.CatalogChange.objects.count()
+
+        output = self.import_catalog(document, '--dry-run')
+        self.assertIn('~ product Latte: price 3.00 -> 3.25', output)
+        self.assertIn('~ product Latte: default_size Grande -> Venti', output)
+        self.assertIn('~ producttea Latte/Chai: is_active True -> False', output)
+        self.assertIn('+ product Mocha', output)
+        self.assertIn('(dry run, nothing saved)', output)
+        self.assertEqual(models.Product.objects.count(), 1)
+        self.assertEqual(models.CatalogChange.objects.count(), changes)
+
+        self.import_catalog(document)
+        latte.refresh_from_db()
+        self.assertEqual((latte.price, latte.default_size.size.name), (Decimal('3.25'), 'Venti'))
+        self.assertFalse(latte.producttea_set.get().is_active)
+        mocha = models.Product.objects.get(name='Mocha')
+        self.assertEqual(mocha.productsize_set.count(), 2)
+        self.assertEqual(mocha.default_flavors.get().product, mocha)
+        # logged once committed
+        self.assertFalse(models.CatalogChange.objects.filter(model='product', object_id=mocha.pk).exists())
+        run_commit_callbacks()
+        self.assertTrue(models.CatalogChange.objects.filter(model='product', object_id=mocha.pk).exists())
+        self.assertEqual(catalog_io.import_catalog(document), [])
+
+    def test_unknown_options_abort_the_import(self):
+        with self.assertRaisesMessage(CommandError, 'Unknown size Venti'):
+            self.import_catalog({'products': [{'name': 'Latte', 'price': '3.00', 'sizes': [{'size': 'Venti'}]}]})
+        self.assertFalse(models.Product.objects.exists())
+
+
+class OptionIndexTestCase(TestCase):
+    def test_index_is_rebuilt_after_catalog_changes(self):
+        latte = create_product('Latte')
+        index = option_index.get_index()
+        self.assertIn(latte.default_milk_id, index.get(latte.pk)['milk'])
+        self.assertEqual(
+            index.topping_choices[latte.default_toppings.get().pk],
+            set(latte.default_toppings.get().topping.allowed_choices.values_list('pk', flat=True)))
+        with self.assertNumQueries(0):
+            self.assertIs(option_index.get_index(), index)
+
+        extra_ice = models.IceChoice.objects.create(name='Extra Ice')
+        latte.allowed_ice.add(extra_ice)
+        index = option_index.get_index()
+        self.assertIn(extra_ice.pk, index.get(latte.pk)['ice'])
+
+        latte.is_active = False
+        latte.save()
+        self.assertIsNone(option_index.get_index().get(latte.pk))
+
+    def test_build_index_reads_every_through_row_in_one_query(self):
+        latte = create_product('Latte')
+        create_product('Mocha')
+        # products, one per allowed_* M2M, the through rows, topping choices and product toppings
+        with self.assertNumQueries(1 + len(orders.CHOICE_FIELDS) + 1 + 2):
+            index = option_index.build_index()
+        self.assertEqual(index.get(latte.pk)['flavors'], {latte.default_flavors.get().pk})
+        self.assertEqual(index.row_options['size'][latte.default_size_id], latte.default_size.size_id)
+
+        row = models.ProductOption.objects.get(option_type='teas', row_id=latte.default_teas.get().pk)
+        self.assertEqual(row.product, latte)
+        self.assertEqual(row.price, latte.default_teas.get().price)
+        self.assertEqual(models.ProductOption.objects.get(pk='sweeteners:{}'.format(
+            latte.default_sweeteners.get().pk)).price, 0)
+
+    def test_index_is_immutable(self):
+        create_product('Latte')
+        index = option_index.get_index()
+        with self.assertRaises(AttributeError):
+            index.products = {}
+        with self.assertRaises(TypeError):
+            index.products[0] = {}
+
+
+class CustomizedProductExportTestCase(TestCase):
+    def setUp(self):
+        latte = create_product('Latte')
+        self.client.post(
+            reverse('customized_product_batch'),
+            [customized_product_data(latte)] * 5,
+            content_type='application/json')
+
+    def test_streams_ndjson(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get(reverse('customized_product_export'), {'start': '2000-01-01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['product'], 'Latte')
+        self.assertEqual(rows[0]['flavors'], [
+            {'id': models.ProductFlavor.objects.get().pk, 'name': 'Vanilla', 'quantity': 3}])
+
+        response = self.client.get(reverse('customized_product_export'), {'end': '2000-01-01'})
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+    def test_requires_staff(self):
+        response = self.client.get(reverse('customized_product_export'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_command_writes_csv_in_chunks(self):
+        output = io.StringIO()
+        # only the customized products, rendered from their snapshots
+        with self.assertNumQueries(1):
+            call_command('export_orders', format='csv', chunk_size=2, stdout=output)
+        rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['toppings'], 'Whipped Cream x 1')
+        self.assertEqual(rows[0]['total'], '7.15')
+
+
+class OrderHistoryAPIViewTestCase(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', None))
+
+    def test_staff_only(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('order_history')).status_code, 403)
+
+    def test_keyset_pagination_newest_first(self):
+        latte = create_product('Latte')
+        mocha = create_product('Mocha')
+        response = self.client.post(
+            reverse('customized_product_batch'),
+            [customized_product_data(latte), customized_product_data(mocha)] * 3,
+            content_type='application/json')
+        ids = [item['id'] for item in response.json()]
+        # ties on created_at are broken by id
+        now = timezone.now()
+        models.CustomizedProduct.objects.filter(pk__in=ids[:4]).update(created_at=now)
+        models.CustomizedProduct.objects.filter(pk__in=ids[4:]).update(created_at=now + timezone.timedelta(1))
+
+        seen = []
+        url = reverse('order_history') + '?page_size=4'
+        while url:
+            page = self.client.get(url).json()
+            seen.extend(item['id'] for item in page['results'])
+            url = page['next']
+        self.assertEqual(seen, ids[4:][::-1] + ids[:4][::-1])
+
+        page = self.client.get(reverse('order_history'), {'product': mocha.pk}).json()
+        self.assertEqual([item['id'] for item in page['results']], [ids[5], ids[3], ids[1]])
+        self.assertEqual(page['results'][0]['flavors'], [
+            {'product_flavor': mocha.default_flavors.get().pk, 'quantity': 3}])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('order_history'), {'cursor': 'nope'})
+        self.assertEqual(response.status_code, 404)
+
+
+class SnapshotsTestCase(TestCase):
+    def create_orders(self, *products):
+        response = self.client.post(
+            reverse('customized_product_batch'),
+            [customized_product_data(product) for product in products],
+            content_type='application/json')
+        return [item['id'] for item in response.json()]
+
+    def test_snapshot_keeps_the_names_and_prices_of_the_order(self):
+        latte = create_product('Latte')
+        [customized_product_id] = self.create_orders(latte)
+        product_flavor = latte.default_flavors.get()
+        product_flavor.price = '0.90'
+        product_flavor.save()
+        models.Flavor.objects.filter(pk=product_flavor.flavor_id).update(name='Vanilla Bean')
+
+        url = reverse('customized_product', args=[customized_product_id])
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', None))
+        # session, user and the customized product
+        with self.assertNumQueries(3):
+            data = self.client.get(url).json()
+        self.assertEqual(data['total'], '7.15')
+        self.assertEqual(data['snapshot']['flavors'], [{
+            'id': product_flavor.pk,
+            'option_id': product_flavor.flavor_id,
+            'name': 'Vanilla',
+            'price': '0.50',
+            'quantity': 3,
+        }])
+        self.assertEqual(data['snapshot']['size']['name'], 'Grande')
+        self.assertEqual(snapshots.total(data['snapshot']), Decimal('7.15'))
+
+        # the snapshot is a valid payload to reorder with the current prices
+        response = self.client.post(
+            reverse('customized_product_batch'), [snapshots.to_item(data['snapshot'])],
+            content_type='application/json')
+        self.assertEqual(response.json()[0]['total'], '8.35')
+
+    def test_rows_written_before_snapshots_are_read_from_the_relational_rows(self):
+        latte = create_product('Latte')
+        ids = self.create_orders(latte, latte)
+        models.CustomizedProduct.objects.filter(pk=ids[0]).update(snapshot='')
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', None))
+        page = self.client.get(reverse('order_history')).json()
+        self.assertEqual(page['results'][0]['flavors'], page['results'][1]['flavors'])
+        rows = list(export.iter_ndjson(export.export_queryset()))
+        self.assertEqual(len(rows), 1)
+
+    def test_check_command_reports_and_repairs_mismatches(self):
+        latte = create_product('Latte')
+        mocha = create_product('Mocha')
+        ids = self.create_orders(latte, mocha, latte)
+        call_command('check_snapshots', stdout=io.StringIO())
+
+        models.CustomizedProduct.objects.filter(pk=ids[0]).update(snapshot='')
+        models.CustomizedProductOption.objects.filter(customized_product=ids[1], option_type='flavors').update(
+            quantity=4)
+        models.CustomizedProduct.objects.filter(pk=ids[2]).update(total='1.00')
+        output = io.StringIO()
+        with self.assertRaisesMessage(CommandError, "3 of 3 snapshots didn't match"):
+            call_command('check_snapshots', chunk_size=2, stdout=output)
+        self.assertEqual(
+            output.getvalue().splitlines(), ['{} missing'.format(ids[0]), '{} options'.format(ids[1]),
+                                             '{} total'.format(ids[2])])
+
+        output = io.StringIO()
+        # a wrong total is only reported, the others are rebuilt (and repriced) from the relational rows
+        with self.assertRaisesMessage(CommandError, "3 of 3 snapshots didn't match, 2 repaired"):
+            call_command('check_snapshots', repair=True, stdout=output)
+        customized_product = models.CustomizedProduct.objects.get(pk=ids[1])
+        self.assertEqual(customized_product.get_snapshot()['flavors'][0]['quantity'], 4)
+        self.assertEqual(customized_product.total, Decimal('7.65'))
+        with self.assertRaisesMessage(CommandError, "1 of 3 snapshots didn't match"):
+            call_command('check_snapshots', stdout=output)
+
+        models.CustomizedProduct.objects.filter(pk=ids[2]).update(total='7.15')
+        output = io.StringIO()
+        call_command('check_snapshots', stdout=output)
+        self.assertEqual(output.getvalue(), "0 of 3 snapshots didn't match\n")
+
+
+@override_settings(ORDER_QUEUE=True)
+class OrderQueueTestCase(TestCase):
+    def setUp(self):
+        self.staff = Client()
+        self.staff.force_login(User.objects.create_superuser('admin', 'admin@example.com', None))
+
+    def enqueue(self, data, key='order-1'):
+        return self.client.post(
+            reverse('customized_product_batch'), data, content_type='application/json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_batch_is_acknowledged_then_written_by_the_worker(self):
+        latte = create_product('Latte')
+        mocha = create_product('Mocha')
+        data = [customized_product_data(latte), customized_product_data(mocha)]
+
+        response = self.enqueue(data)
+        self.assertEqual(response.status_code, 202, response.content)
+        self.assertEqual(response.json()['status'], 'queued')
+        self.assertEqual(response['Location'], reverse('queued_order', args=['order-1']))
+        self.assertFalse(models.CustomizedProduct.objects.exists())
+        # a retry gets the same entry back, the batch is queued once
+        self.assertEqual(self.enqueue(data).json(), response.json())
+        self.assertEqual(self.enqueue(data[:1]).status_code, 422)
+        self.assertEqual(self.enqueue(data, key='order-2').status_code, 202)
+
+        output = io.StringIO()
+        call_command('drain_order_queue', once=True, stdout=output)
+        self.assertEqual(output.getvalue(), "Drained 2 batches (4 customized products, 0 batches failed)\n")
+        # the status is for staff, clients retry with the same key
+        self.assertEqual(self.client.get(response['Location']).status_code, 403)
+        status = self.staff.get(response['Location']).json()
+        self.assertEqual(status['status'], 'written')
+        self.assertEqual(
+            [models.CustomizedProduct.objects.get(pk=pk).total for pk in status['ids']],
+            [Decimal('7.15'), Decimal('7.15')])
+        self.assertEqual(self.enqueue(data).json()['ids'], status['ids'])
+        self.assertEqual(models.CustomizedProduct.objects.count(), 4)
+
+        call_command('prune_order_queue', hours=0, stdout=io.StringIO())
+        self.assertFalse(models.QueuedOrder.objects.exists())
+
+    def test_rejects_invalid_batches_keys_and_a_full_queue(self):
+        latte = create_product('Latte')
+        data = [customized_product_data(latte)]
+        self.assertEqual(self.enqueue(data, key='').status_code, 400)
+        self.assertEqual(self.enqueue(data, key='no spaces').status_code, 400)
+        data[0]['milk'] = 0
+        self.assertEqual(self.enqueue(data).status_code, 400)
+        self.assertFalse(models.QueuedOrder.objects.exists())
+
+        with override_settings(ORDER_QUEUE_MAX_DEPTH=1):
+            self.assertEqual(self.enqueue([customized_product_data(latte)]).status_code, 202)
+            response = self.enqueue([customized_product_data(latte)], key='order-2')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(order_queue.RETRY_AFTER))
+
+    def test_batches_invalid_at_drain_time_fail_alone(self):
+        latte = create_product('Latte')
+        mocha = create_product('Mocha')
+        self.enqueue([customized_product_data(latte)], key='latte')
+        self.enqueue([customized_product_data(mocha)], key='mocha')
+        self.enqueue([customized_product_data(latte)], key='latte-2')
+        mocha.is_active = False
+        mocha.save()
+
+        self.assertEqual(order_queue.drain(), (3, 2, 1))
+        data = self.staff.get(reverse('queued_order', args=['mocha'])).json()
+        self.assertEqual(data['status'], 'failed')
+        self.assertIn('product', data['errors'][0])
+        self.assertEqual(self.staff.get(reverse('queued_order', args=['latte-2'])).json()['status'], 'written')
+        self.assertEqual(models.CustomizedProduct.objects.count(), 2)
+
+        # a row missing although the index allows it fails only its own batch
+        self.enqueue([customized_product_data(latte)], key='latte-3')
+        self.enqueue([customized_product_data(latte)], key='latte-4')
+        models.QueuedOrder.objects.filter(key='latte-3').update(
+            items=json.dumps([dict(customized_product_data(latte), milk=0)]))
+        with mock.patch.object(orders, 'validate_customized_product', return_value={}):
+            self.assertEqual(order_queue.drain(), (2, 1, 1))
+        self.assertIn('KeyError', models.QueuedOrder.objects.get(key='latte-3').error)
+        self.assertEqual(order_queue.drain(), (0, 0, 0))
+
+    def test_metrics(self):
+        latte = create_product('Latte')
+        self.enqueue([customized_product_data(latte)] * 3)
+        lines = self.client.get(reverse('metrics')).content.decode().splitlines()
+        self.assertIn('order_queue_pending_batches 1', lines)
+        self.assertIn('order_queue_pending_items 3', lines)
+
+        order_queue.drain()
+        self.assertEqual(order_queue.get_stats()['pending_items'], 0)
+        self.assertEqual(order_queue.get_stats()['drained_items_per_second'], 3 / order_queue.DRAIN_RATE_WINDOW)
+
+
+class DefaultCustomizationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.latte = create_product('Latte')
+        self.tall = models.ProductSize.objects.create(
+            product=self.latte, size=models.Size.objects.create(name='Tall'), default_espresso_shots=1)
+        self.mocha = create_product('Mocha')
+        run_commit_callbacks()
+
+    def get(self, product, **params):
+        return self.client.get(reverse('default_customization', args=[product.pk]), params)
+
+    def test_lookup_resolves_the_size_quantities_and_price(self):
+        with self.assertNumQueries(1):
+            data = self.get(self.latte).json()
+        self.assertTrue(data['is_default'])
+        self.assertEqual(data['size'], self.latte.default_size_id)
+        self.assertEqual(data['total'], '7.65')
+        self.assertEqual(data['item']['flavors'], [
+            {'product_flavor': self.latte.default_flavors.get().pk, 'quantity': 4}])
+        self.assertEqual(data['snapshot']['flavors'][0]['name'], 'Vanilla')
+
+        response = self.client.post(
+            reverse('customized_product_batch'), [data['item']], content_type='application/json')
+        self.assertEqual(response.json()[0]['total'], '7.65')
+
+        # no pumps and no tea in a tall
+        data = self.get(self.latte, size=self.tall.pk).json()
+        self.assertEqual((data['is_default'], data['total']), (False, '4.35'))
+        self.assertEqual((data['item']['flavors'], data['item']['teas']), ([], []))
+        self.assertEqual(data['item']['espresso_shots'][0]['quantity'], 1)
+        self.assertEqual(self.get(self.latte, size=self.mocha.default_size_id).status_code, 404)
+        self.assertEqual(defaults.get_default(self.mocha.pk).total, Decimal('7.65'))
+
+    def test_catalog_changes_refresh_the_changed_products(self):
+        mocha_default = defaults.get_default(self.mocha.pk)
+        self.tall.default_flavor_pumps = 2
+        self.tall.save()
+        flavor = models.Flavor.objects.get(pk=self.latte.default_flavors.get().flavor_id)
+        flavor.name = 'Vanilla Bean'
+        flavor.save()
+        run_commit_callbacks()
+
+        data = self.get(self.latte, size=self.tall.pk).json()
+        self.assertEqual(data['total'], '5.35')
+        self.assertEqual(data['snapshot']['flavors'][0]['name'], 'Vanilla Bean')
+        # rebuilt only for the latte
+        self.assertEqual(defaults.get_default(self.mocha.pk).pk, mocha_default.pk)
+
+        self.mocha.is_active = False
+        self.mocha.save()
+        # deleted rows rebuild every product
+        models.ProductJuice.objects.filter(product=self.latte).delete()
+        run_commit_callbacks()
+        self.assertIsNone(defaults.get_default(self.mocha.pk))
+        self.assertEqual(self.get(self.latte).json()['total'], '7.40')
+
+        output = io.StringIO()
+        call_command('rebuild_default_customizations', stdout=output)
+        self.assertEqual(output.getvalue(), "2 default customizations\n")
+
+
+class SerialLiveServerThread(LiveServerThread):
+    """
+    Live server that answers one request at a time
+
+    SQLite's shared in-memory test database answers concurrent connections
+    with "database table is locked", which no busy timeout retries.
+    """
+    def _create_server(self):
+        return WSGIServer((self.host, self.port), QuietWSGIRequestHandler, allow_reuse_address=False)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class LoadTestTestCase(LiveServerTestCase):
+    # the clients are still concurrent, their requests wait for the server
+    server_thread_class = SerialLiveServerThread
+
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@example.com', None)
+        self.latte = create_product('Latte')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_mix_against_a_server(self):
+        output = io.StringIO()
+        call_command(
+            'loadtest', url=self.live_server_url, mix='products=3,orders=1,admin=1', requests=40, concurrency=4,
+            batch_size=2, stdout=output, stderr=io.StringIO())
+        [result] = json.loads(output.getvalue())['results']
+        self.assertEqual((result['scenario'], result['target']), ('mix', 'http'))
+        self.assertEqual(result['requests'], 40)
+        self.assertEqual(result['errors'], 0, result)
+        self.assertEqual(set(result['endpoints']), {'products', 'orders', 'admin'})
+        for name, status in (('products', '200'), ('orders', '201'), ('admin', '200')):
+            endpoint = result['endpoints'][name]
+            self.assertEqual(endpoint['statuses'], {status: endpoint['requests']})
+        self.assertEqual(set(result['endpoints']['admin']['latency_ms']), {'p50', 'p95', 'p99', 'max'})
+        # plus the warm-up requests
+        self.assertEqual(
+            models.CustomizedProduct.objects.count(), (result['endpoints']['orders']['requests'] + 1) * 2)
+        self.assertFalse(Session.objects.exists())
+
+
+class LoadTestCompareTestCase(SimpleTestCase):
+    def test_compare(self):
+        def document(requests_per_second, p95, errors):
+            endpoint = {
+                'requests_per_second': requests_per_second,
+                'error_rate': errors,
+                'latency_ms': {'p50': 10, 'p95': p95, 'p99': 40, 'max': 50},
+            }
+            return {'results': [dict(endpoint, scenario='mix', target='http', endpoints={'orders': endpoint})]}
+
+        lines = loadtest.compare(document(100, 20, 0), document(80, 30, 0.01))
+        self.assertEqual(lines[0], (
+            'mix http all: req/s 100 -> 80 (-20% worse), p50 ms 10 -> 10 (+0%), p95 ms 20 -> 30 (+50% worse), '
+            'p99 ms 40 -> 40 (+0%), errors 0 -> 0.01'))
+        self.assertEqual(lines[1].split(':')[0], 'mix http orders')
+
+
+class SyntheticDataTestCase(TestCase):
+    def tearDown(self):
+        cache.clear()
+
+    def test_generated_catalog_and_orders_are_valid(self):
+        products = synthetic.generate_catalog(products=3, sizes=2, milks=2, flavors=4, toppings=3, seed=1)
+        self.assertEqual(models.Product.objects.count(), 3)
+        self.assertEqual(models.ProductFlavor.objects.filter(product=products[0]).count(), 4)
+        product = models.Product.objects.get(pk=products[0].pk)
+        self.assertEqual(product.default_size.product_id, product.pk)
+        self.assertEqual(product.default_flavors.get().product_id, product.pk)
+
+        ids = synthetic.generate_orders(20, days=2, batch_size=8)
+        self.assertEqual(models.CustomizedProduct.objects.filter(pk__in=ids).count(), 20)
+        self.assertEqual(dict(models.CustomizedProduct.objects.values_list('pk', 'total')), pricing.compute_totals(ids))
+        self.assertFalse(models.CustomizedProduct.objects.filter(
+            created_at__lt=timezone.now() - timezone.timedelta(days=2, seconds=1)).exists())
+
+        # the generated payloads pass the API validation
+        index = option_index.get_index()
+        response = self.client.post(
+            reverse('customized_product_batch'),
+            [synthetic.random_customization(product.pk, index.get(product.pk), random.Random(0))],
+            content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_options_need_a_category(self):
+        with self.assertRaisesMessage(CommandError, '--flavors needs at least one of --flavor-categories'):
+            call_command('generate_catalog', products=1, flavor_categories=0, stdout=io.StringIO())
+        call_command('generate_catalog', products=1, flavors=0, flavor_categories=0, stdout=io.StringIO())
+        self.assertFalse(models.Flavor.objects.exists())
+
+    @override_settings(
+        ALLOWED_HOSTS=['localhost'], STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_benchmark_command(self):
+        User.objects.create_user('benchmark')
+        cache.set('unrelated', 1)
+        version = catalog.get_version()
+        output = io.StringIO()
+        call_command('benchmark', scales='2', repeat=1, orders_per_product=2, stdout=output, stderr=io.StringIO())
+        results = json.loads(output.getvalue())['results']
+        self.assertIn('admin_product_change', [result['name'] for result in results])
+        self.assertTrue(all(result['status'] < 400 and result['queries'] for result in results))
+        # the benchmark data is rolled back
+        self.assertFalse(models.Product.objects.exists())
+        self.assertEqual(User.objects.count(), 1)
+        # without clearing a cache other servers may share
+        self.assertEqual(cache.get('unrelated'), 1)
+        self.assertGreater(catalog.get_version(), version)
+        self.assertEqual(json.loads(catalog.get_menu()), [])
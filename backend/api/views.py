@@ -1,13 +1,357 @@
-from rest_framework import generics
+import base64
+import re
 
-from . import models, serializers
+from django.db.models import Q
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.dateparse import parse_datetime
+from rest_framework import exceptions, generics, pagination, permissions, status, views
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
+from . import (
+    artifacts, catalog, defaults, export, metrics, models, order_queue, renderers, reports, routers, serializers,
+)
 
-class ProductListAPIView(generics.ListAPIView):
+# option groups for ProductListAPIView's include= parameter
+PRODUCT_OPTION_GROUPS = {
+    'ice': ('allowed_ice', 'default_ice'),
+    'room': ('allowed_room', 'default_room'),
+    'milks': (
+        'allowed_milks',
+        'default_milk',
+        'allowed_milk_temps',
+        'default_milk_temp',
+        'allowed_milk_foams',
+        'default_milk_foam',
+    ),
+    'sizes': ('allowed_sizes', 'default_size'),
+    'sweeteners': ('allowed_sweeteners', 'default_sweeteners'),
+    'flavors': ('allowed_flavors', 'default_flavors'),
+    'espresso_shots': ('allowed_espresso_shots', 'default_espresso_shots'),
+    'juices': ('allowed_juices', 'default_juices'),
+    'toppings': ('allowed_toppings', 'default_toppings'),
+    'teas': ('allowed_teas', 'default_teas'),
+}
+# always rendered when fields= or include= is used
+PRODUCT_BASE_FIELDS = ('id', 'name', 'price', 'is_active')
+IDEMPOTENCY_KEY_RE = re.compile(r'[\w-]{1,100}', re.ASCII)
+
+
+class ReplicaReadMixin:
+    """
+    Reads of GET/HEAD requests go to a read replica, see routers.py
+    """
+    def dispatch(self, request, *args, **kwargs):
+        with routers.replica_reads(request.method in permissions.SAFE_METHODS):
+            return super().dispatch(request, *args, **kwargs)
+
+
+class ProductCursorPagination(pagination.CursorPagination):
+    ordering = 'name'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+
+class CreatedAtKeysetPagination(pagination.BasePagination):
+    """
+    Newest first keyset pagination on (created_at, id)
+
+    The cursor holds the created_at and id of the last row of the previous
+    page, so every page is an index range scan no matter how deep it is.
+    """
+    page_size = 50
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            created_at, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+
+        page = list(queryset.order_by('-created_at', '-pk')[:page_size + 1])
+        self.next_row = page[page_size - 1] if len(page) > page_size else None
+        return page[:page_size]
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def encode_cursor(self, row):
+        position = '{}|{}'.format(row.created_at.isoformat(), row.pk)
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            created_at = parse_datetime(created_at)
+            pk = int(pk)
+        except ValueError:
+            raise exceptions.NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise exceptions.NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+    def get_next_link(self):
+        if self.next_row is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, self.encode_cursor(self.next_row))
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+
+class ProductListAPIView(ReplicaReadMixin, generics.ListAPIView):
+    """
+    Lists the active products
+
+    Without query parameters this is the full menu as a plain list, served
+    from the versioned menu cache. Passing cursor/page_size pages through the
+    products by name, fields= (product fields) and include= (option groups,
+    see PRODUCT_OPTION_GROUPS) limit what is serialized and queried.
+    """
     serializer_class = serializers.ProductSerializer
+    pagination_class = ProductCursorPagination
+    query_params = ('cursor', 'page_size', 'fields', 'include')
 
     def get_queryset(self):
         """
         This view should return a list of all the currently active products.
         """
-        return models.Product.objects.filter(is_active=True).order_by('name')
+        return catalog.menu_queryset(self.get_fields())
+
+    def get_fields(self):
+        """
+        Returns the product fields selected with fields=/include=, None for all of them
+        """
+        fields = self.request.query_params.get('fields')
+        include = self.request.query_params.get('include')
+        if fields is None and include is None:
+            return None
+
+        selected = set(PRODUCT_BASE_FIELDS)
+        if fields:
+            selected.update(fields.split(','))
+        for group in include.split(',') if include else ():
+            if group not in PRODUCT_OPTION_GROUPS:
+                raise exceptions.ValidationError({'include': ['Unknown option group "{}".'.format(group)]})
+            selected.update(PRODUCT_OPTION_GROUPS[group])
+
+        product_fields = models.Product._meta.concrete_fields + models.Product._meta.many_to_many
+        unknown = selected - {field.name for field in product_fields}
+        if unknown:
+            raise exceptions.ValidationError(
+                {'fields': ['Unknown field "{}".'.format(field_name) for field_name in sorted(unknown)]})
+        return selected
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs['fields'] = self.get_fields()
+        return super().get_serializer(*args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        if not any(param in request.query_params for param in self.query_params):
+            if settings.MENU_ARTIFACTS:
+                # the static file of the current catalog version, see artifacts.py
+                return HttpResponseRedirect(artifacts.get_menu_artifact_url())
+            # served from the versioned menu cache, see catalog.get_menu
+            return HttpResponse(catalog.get_menu(), content_type='application/json')
+        return super().list(request, *args, **kwargs)
+
+
+class MenuAPIView(ReplicaReadMixin, views.APIView):
+    """
+    Normalized menu, each option is listed once in an id-keyed table and
+    products refer to them by id
+    """
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(catalog.get_normalized_menu(), content_type='application/json')
+
+
+class MenuChangesAPIView(ReplicaReadMixin, views.APIView):
+    """
+    What changed in the normalized menu since the client's ?since=<menu version>
+
+    Responds 410 Gone when the changes since then aren't logged anymore, the
+    client reloads the full menu then. See catalog.build_menu_changes.
+    """
+    def get(self, request, *args, **kwargs):
+        params = serializers.MenuChangesParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        content = catalog.get_menu_changes(params.validated_data['since'])
+        if content is None:
+            return Response(
+                {'detail': 'The changes since this version are not available, reload the menu.'},
+                status=status.HTTP_410_GONE)
+        return HttpResponse(content, content_type='application/json')
+
+
+class DefaultCustomizationAPIView(ReplicaReadMixin, generics.RetrieveAPIView):
+    """
+    A product's default customization in its default size or ?size=<ProductSize id>, see defaults.py
+    """
+    serializer_class = serializers.DefaultCustomizationSerializer
+
+    def get_object(self):
+        params = serializers.DefaultCustomizationParamsSerializer(data=self.request.query_params)
+        params.is_valid(raise_exception=True)
+        default = defaults.get_default(self.kwargs['pk'], params.validated_data.get('size'))
+        if default is None:
+            raise exceptions.NotFound()
+        return default
+
+
+class CustomizedProductBatchAPIView(generics.CreateAPIView):
+    """
+    Creates a list of customized products, all or nothing
+
+    Every item is validated against its product's allowed options before
+    anything is written, then the batch is inserted with bulk writes.
+
+    With settings.ORDER_QUEUE the valid batch is queued instead (see
+    order_queue.py) under the request's Idempotency-Key header, and the
+    response is 202 with the queued batch, whose status staff can read at
+    its Location.
+    """
+    serializer_class = serializers.CustomizedProductSerializer
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        if settings.ORDER_QUEUE:
+            return self.enqueue(request, serializer.validated_data)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def enqueue(self, request, items):
+        key = request.headers.get('Idempotency-Key', '')
+        if not IDEMPOTENCY_KEY_RE.fullmatch(key):
+            raise exceptions.ValidationError(
+                {'Idempotency-Key': ['Send a unique key of up to 100 letters, digits, "-" and "_" (e.g. a UUID).']})
+        try:
+            entry, created = order_queue.enqueue(key, items)
+        except order_queue.QueueFull:
+            return Response(
+                {'detail': 'Too many orders are waiting to be written, retry later.'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': str(order_queue.RETRY_AFTER)})
+        except order_queue.KeyReused:
+            return Response(
+                {'detail': 'This Idempotency-Key was already used for a different batch.'},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        return Response(
+            serializers.QueuedOrderSerializer(entry).data,
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Location': reverse('queued_order', args=[key])})
+
+
+class QueuedOrderAPIView(generics.RetrieveAPIView):
+    """
+    A batch queued by CustomizedProductBatchAPIView, by Idempotency-Key, with its ids once written
+
+    For staff, clients get the same by retrying the POST with the same key and batch.
+    """
+    permission_classes = (permissions.IsAdminUser,)
+    queryset = models.QueuedOrder.objects.all()
+    serializer_class = serializers.QueuedOrderSerializer
+    lookup_field = 'key'
+
+
+class CustomizedProductExportAPIView(ReplicaReadMixin, views.APIView):
+    """
+    Streams the customized products created in a date range as NDJSON (default) or CSV
+
+    ?start=2020-04-01&end=2020-05-01&format=csv
+    """
+    permission_classes = (permissions.IsAdminUser,)
+    renderer_classes = (renderers.NDJSONRenderer, renderers.CSVRenderer)
+
+    def get(self, request, *args, **kwargs):
+        params = serializers.ExportParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        # bound now, the rows are read after dispatch() returns
+        queryset = export.export_queryset(**params.validated_data)
+        queryset = queryset.using(queryset.db)
+
+        if request.accepted_renderer.format == 'csv':
+            rows = export.iter_csv(queryset)
+        else:
+            rows = export.iter_ndjson(queryset)
+        response = StreamingHttpResponse(rows, content_type=request.accepted_renderer.media_type)
+        response['Content-Disposition'] = 'attachment; filename="customized_products.{}"'.format(
+            request.accepted_renderer.format)
+        return response
+
+
+class OrderHistoryAPIView(ReplicaReadMixin, generics.ListAPIView):
+    """
+    Lists customized products newest first, optionally for a time range (?start=&end=) and ?product=
+    """
+    permission_classes = (permissions.IsAdminUser,)
+    serializer_class = serializers.CustomizedProductHistorySerializer
+    pagination_class = CreatedAtKeysetPagination
+
+    def get_queryset(self):
+        params = serializers.OrderHistoryParamsSerializer(data=self.request.query_params)
+        params.is_valid(raise_exception=True)
+        queryset = models.CustomizedProduct.objects.all()
+        if 'start' in params.validated_data:
+            queryset = queryset.filter(created_at__gte=params.validated_data['start'])
+        if 'end' in params.validated_data:
+            queryset = queryset.filter(created_at__lt=params.validated_data['end'])
+        if 'product' in params.validated_data:
+            queryset = queryset.filter(product_id=params.validated_data['product'])
+        return queryset
+
+
+class CustomizedProductAPIView(ReplicaReadMixin, generics.RetrieveAPIView):
+    """
+    One customized product with its snapshot, read from its row alone (tickets, receipts, reorders)
+    """
+    permission_classes = (permissions.IsAdminUser,)
+    queryset = models.CustomizedProduct.objects.all()
+    serializer_class = serializers.CustomizedProductDetailSerializer
+
+
+class ReportAPIView(ReplicaReadMixin, views.APIView):
+    """
+    Sales report over the rollups, cached, see reports.py for the available ones
+
+    /api/reports/top-options/?start=2020-04-01&end=2020-05-01&option_type=toppings&limit=3
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, name, *args, **kwargs):
+        if name not in reports.REPORTS:
+            raise exceptions.NotFound()
+        params = serializers.ReportParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        return Response({'results': reports.get_report(name, params.validated_data)})
+
+
+class MetricsAPIView(views.APIView):
+    """
+    Request metrics of this process in the Prometheus text format, see metrics.py
+
+    Only answers the addresses in settings.METRICS_ALLOWED_IPS (404 otherwise).
+    """
+    authentication_classes = ()
+    permission_classes = ()
+
+    def get(self, request, *args, **kwargs):
+        if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+            raise exceptions.NotFound()
+        content = metrics.registry.render()
+        if settings.ORDER_QUEUE:
+            content += order_queue.render_metrics()
+        return HttpResponse(content, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -2,6 +2,8 @@
 ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+The menu and order endpoints are answered by the native async handlers in
+backend/api/asgi.py, everything else by Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -11,6 +13,12 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+# same default as wsgi.py
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings.prod')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported once get_asgi_application() has set Django up
+from .api.asgi import get_application  # noqa: E402
+
+application = get_application(django_application)
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 
 import os
 
+import dj_database_url
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 SETTINGS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 BASE_DIR = os.path.dirname(SETTINGS_DIR)
@@ -44,9 +46,11 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'backend.api.artifacts.WhiteNoiseMiddleware',
+    'backend.api.metrics.ServerTimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'backend.api.routers.ReplicaPinningMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -84,6 +88,46 @@ DATABASES = {
     }
 }
 
+# Read replicas, comma separated URLs (e.g. sqlite:////path/to/replica.sqlite3)
+# named replica1, replica2... The menu, order history and reporting views
+# read from them, see api/routers.py. Tests use them as mirrors of default.
+DATABASE_REPLICAS = {
+    'replica{}'.format(i + 1): dict(dj_database_url.parse(url), TEST={'MIRROR': 'default'})
+    for i, url in enumerate(url for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url)
+}
+DATABASES.update(DATABASE_REPLICAS)
+
+DATABASE_ROUTERS = ['backend.api.routers.ReplicaRouter']
+
+# Seconds a client keeps reading from the primary after sending a write,
+# should cover the replication lag
+DATABASE_REPLICA_LAG = int(os.getenv('DATABASE_REPLICA_LAG', 5))
+
+# Clients allowed to scrape /api/metrics (see api/metrics.py)
+METRICS_ALLOWED_IPS = os.getenv('DJANGO_METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
+# Seconds the reports (see api/reports.py) are cached
+REPORTS_CACHE_TIMEOUT = int(os.getenv('DJANGO_REPORTS_CACHE_TIMEOUT', 300))
+
+# Write-behind order ingestion (see api/order_queue.py): order batches are
+# queued and acknowledged at once, the drain_order_queue worker writes them
+ORDER_QUEUE = bool(os.getenv('DJANGO_ORDER_QUEUE', ''))
+# pending batches past which new ones are refused with a 503
+ORDER_QUEUE_MAX_DEPTH = int(os.getenv('DJANGO_ORDER_QUEUE_MAX_DEPTH', 10000))
+# queued batches the worker writes per transaction
+ORDER_QUEUE_BATCH_SIZE = int(os.getenv('DJANGO_ORDER_QUEUE_BATCH_SIZE', 100))
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# holds the catalog version and the rendered menu (see api/catalog.py)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -136,6 +180,12 @@ STATICFILES_DIRS = []
 
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
+# Redirect /api/products/ to the menu written as a hashed, precompressed file
+# in STATIC_ROOT/MENU_ARTIFACT_DIR after every catalog change (see
+# api/artifacts.py and the write_menu_artifact command)
+MENU_ARTIFACTS = bool(os.getenv('DJANGO_MENU_ARTIFACTS', ''))
+MENU_ARTIFACT_DIR = 'menu'
+
 # Insert Whitenoise Middleware at top but below Security Middleware
 # MIDDLEWARE.insert(1, 'whitenoise.middleware.WhiteNoiseMiddleware',)
 # http://whitenoise.evans.io/en/stable/django.html#make-sure-staticfiles-is-configured-correctly
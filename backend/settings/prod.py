@@ -3,6 +3,7 @@
 import os
 
 import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 
 from .dev import *
 
@@ -14,6 +15,30 @@ DATABASES = {
         default=os.getenv('DATABASE_URL')
     )
 }
+DATABASES.update(DATABASE_REPLICAS)
+
+
+#########
+# CACHE #
+#########
+# The catalog version lives in the cache and must be shared by every worker,
+# a worker with a cache of its own would keep serving (and validating orders
+# against) the catalog it first saw. A per-process cache has to be asked for
+# with DJANGO_SINGLE_PROCESS=1.
+PER_PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('DJANGO_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('DJANGO_CACHE_LOCATION', ''),
+    }
+}
+if CACHES['default']['BACKEND'] in PER_PROCESS_CACHES and not os.getenv('DJANGO_SINGLE_PROCESS'):
+    raise ImproperlyConfigured(
+        "Set DJANGO_CACHE_BACKEND and DJANGO_CACHE_LOCATION to a cache shared by the workers (e.g. memcached), "
+        "or DJANGO_SINGLE_PROCESS=1 to run a single process with its own cache")
 
 
 ############
@@ -23,4 +23,34 @@ urlpatterns = [
     path('api/products/',
          views.ProductListAPIView.as_view(),
          name='vue_form_products'),
+    path('api/products/<int:pk>/default-customization/',
+         views.DefaultCustomizationAPIView.as_view(),
+         name='default_customization'),
+    path('api/v2/menu/',
+         views.MenuAPIView.as_view(),
+         name='menu'),
+    path('api/v2/menu/changes/',
+         views.MenuChangesAPIView.as_view(),
+         name='menu_changes'),
+    path('api/customized-products/batch/',
+         views.CustomizedProductBatchAPIView.as_view(),
+         name='customized_product_batch'),
+    path('api/customized-products/queue/<str:key>/',
+         views.QueuedOrderAPIView.as_view(),
+         name='queued_order'),
+    path('api/customized-products/export/',
+         views.CustomizedProductExportAPIView.as_view(),
+         name='customized_product_export'),
+    path('api/customized-products/',
+         views.OrderHistoryAPIView.as_view(),
+         name='order_history'),
+    path('api/customized-products/<int:pk>/',
+         views.CustomizedProductAPIView.as_view(),
+         name='customized_product'),
+    path('api/reports/<slug:name>/',
+         views.ReportAPIView.as_view(),
+         name='report'),
+    path('api/metrics',
+         views.MetricsAPIView.as_view(),
+         name='metrics'),
 ]